@@ -0,0 +1,353 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Benchmarks of the plugin hooks against the local emulator.
+
+Measures setup_adapter cold start, get_account_info and meter_billing
+for 1 to 1000 dimensions with cold and warm caches, and meter_billing
+with a growing number of concurrent callers. A cold run starts without
+cached metadata, tokens, resource uri or kept alive connections, a warm
+run reuses them.
+
+The results are written as JSON, comparing them with the results of an
+earlier run reports the scenarios whose latency regressed:
+
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --compare results.json
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from csp_billing_adapter_microsoft import (
+    __version__,
+    emulator,
+    plugin,
+    transport
+)
+
+DIMENSION_COUNTS = (1, 10, 100, 1000)
+CONCURRENCY_LEVELS = (1, 2, 4, 8, 16)
+PERCENTILES = (50, 95, 99)
+# Dimensions per meter_billing call in the concurrency sweep
+SWEEP_DIMENSIONS = 25
+
+BASE_CONFIG = {
+    'api': 'emulated',
+    'product_code': 'offer:publisher:plan:sku',
+    'billing_interval': 'monthly'
+}
+
+# Each meter_billing call bills a different hour so that no usage is
+# reported as already submitted
+_hours = itertools.count()
+_now = datetime.datetime.now(datetime.timezone.utc)
+
+
+def percentile(samples: list, percent: float):
+    """Return the nearest rank percentile of the samples."""
+    ordered = sorted(samples)
+    rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(name: str, samples: list, **params):
+    """Return the result of a scenario from its latencies in seconds."""
+    result = {'name': name}
+    result.update(params)
+    result['iterations'] = len(samples)
+    for percent in PERCENTILES:
+        result[f'p{percent}'] = percentile(samples, percent)
+    result['mean'] = sum(samples) / len(samples)
+    result['min'] = min(samples)
+    result['max'] = max(samples)
+    return result
+
+
+def get_result_key(result: dict):
+    """Return what identifies a scenario across runs."""
+    return tuple(
+        (name, value) for name, value in sorted(result.items())
+        if name in ('name', 'cache', 'dimensions', 'concurrency')
+    )
+
+
+def reset(cold: bool):
+    """Drop the plugin caches and connections for a cold run."""
+    plugin._accepted_index.clear()
+    if not cold:
+        return
+
+    plugin._token_cache.clear()
+    plugin._metering_context.clear()
+    plugin._metadata_cache.clear()
+    plugin._compute_fingerprint = None
+    transport.get_transport().close()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def meter(config: dict, dimensions: dict):
+    """Bill the dimensions for a new hour and check they were accepted."""
+    timestamp = _now - datetime.timedelta(hours=next(_hours))
+    status = plugin.meter_billing(config, dimensions, timestamp, False)
+    failed = [
+        name for name, value in status.items()
+        if value['status'] != 'submitted'
+    ]
+    if failed or len(status) != len(dimensions):
+        raise RuntimeError(f'Usage not submitted: {failed or status}')
+
+
+def get_dimensions(count: int, prefix: str = 'dim'):
+    return {f'{prefix}_{index}': index + 1 for index in range(count)}
+
+
+def bench_setup(config: dict, iterations: int):
+    samples = []
+    for _ in range(iterations):
+        reset(cold=True)
+        samples.append(timed(plugin.setup_adapter, config))
+    results = [summarize('setup_adapter', samples, cache='cold')]
+
+    prefetch_config = dict(config)
+    prefetch_config['microsoft'] = dict(config['microsoft'], prefetch=True)
+    samples = []
+    for _ in range(iterations):
+        reset(cold=True)
+        samples.append(timed(plugin.setup_adapter, prefetch_config))
+    results.append(
+        summarize('setup_adapter_prefetch', samples, cache='cold')
+    )
+    return results
+
+
+def bench_account_info(config: dict, iterations: int):
+    results = []
+    for cache in ('cold', 'warm'):
+        samples = []
+        plugin.get_account_info(config)
+        for _ in range(iterations):
+            reset(cold=cache == 'cold')
+            samples.append(timed(plugin.get_account_info, config))
+        results.append(summarize('get_account_info', samples, cache=cache))
+    return results
+
+
+def bench_meter_billing(config: dict, iterations: int, counts: tuple):
+    results = []
+    for count in counts:
+        dimensions = get_dimensions(count)
+        for cache in ('cold', 'warm'):
+            meter(config, dimensions)
+            samples = []
+            for _ in range(iterations):
+                reset(cold=cache == 'cold')
+                samples.append(timed(meter, config, dimensions))
+            results.append(summarize(
+                'meter_billing',
+                samples,
+                cache=cache,
+                dimensions=count
+            ))
+    return results
+
+
+def bench_concurrency(config: dict, iterations: int, levels: tuple):
+    """
+    Run meter_billing from several threads at once with warm caches.
+
+    Each thread bills its own dimensions. The throughput is the number
+    of calls completed per second.
+    """
+    results = []
+    reset(cold=False)
+    meter(config, get_dimensions(SWEEP_DIMENSIONS))
+
+    for level in levels:
+        def _worker(worker):
+            dimensions = get_dimensions(SWEEP_DIMENSIONS, f'w{worker}')
+            return [
+                timed(meter, config, dimensions) for _ in range(iterations)
+            ]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as executor:
+            samples = list(itertools.chain.from_iterable(
+                executor.map(_worker, range(level))
+            ))
+        elapsed = time.perf_counter() - start
+
+        result = summarize(
+            'meter_billing_concurrent',
+            samples,
+            cache='warm',
+            dimensions=SWEEP_DIMENSIONS,
+            concurrency=level
+        )
+        result['throughput'] = len(samples) / elapsed
+        results.append(result)
+    return results
+
+
+def compare(results: list, baseline: dict, tolerance: float):
+    """
+    Print the change of each scenario against the baseline results.
+
+    Return the scenarios whose p50 or p95 grew by more than tolerance.
+    """
+    previous = {
+        get_result_key(result): result for result in baseline['results']
+    }
+    regressions = []
+    for result in results:
+        before = previous.get(get_result_key(result))
+        if not before:
+            continue
+
+        changes = {
+            stat: result[stat] / before[stat] - 1
+            for stat in ('p50', 'p95')
+            if before[stat] > 0
+        }
+        regressed = any(change > tolerance for change in changes.values())
+        print('{:<60} {}{}'.format(
+            describe(result),
+            ' '.join(
+                f'{stat} {change:+.1%}' for stat, change in changes.items()
+            ),
+            '  REGRESSION' if regressed else ''
+        ))
+        if regressed:
+            regressions.append(result)
+    return regressions
+
+
+def describe(result: dict):
+    params = ', '.join(
+        f'{name}={result[name]}'
+        for name in ('cache', 'dimensions', 'concurrency')
+        if name in result
+    )
+    return f"{result['name']} ({params})"
+
+
+def print_results(results: list):
+    print('{:<60} {:>9} {:>9} {:>9}'.format('scenario', 'p50', 'p95', 'p99'))
+    for result in results:
+        print('{:<60} {:>8.2f}ms {:>7.2f}ms {:>7.2f}ms'.format(
+            describe(result),
+            *(result[f'p{percent}'] * 1000 for percent in PERCENTILES)
+        ))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', help='File the results are written to')
+    parser.add_argument('--compare', help='Results of an earlier run')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Allowed growth of p50 and p95 when comparing, 0.2 is 20%%'
+    )
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument(
+        '--dimensions',
+        type=int,
+        nargs='+',
+        default=DIMENSION_COUNTS
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        nargs='+',
+        default=CONCURRENCY_LEVELS
+    )
+    parser.add_argument(
+        '--latency',
+        help='Latency of the emulated endpoints, for example fixed:0.005'
+    )
+    options = parser.parse_args(args)
+    try:
+        latency = options.latency and emulator._parse_latency(options.latency)
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+
+    logging.getLogger('CSPBillingAdapter').setLevel(logging.CRITICAL)
+    os.environ.pop('EXTENSION_RESOURCE_ID', None)
+    os.environ.pop('PLAN_ID', None)
+
+    behavior = emulator.Behavior(latency=latency)
+    with emulator.Emulator(
+        behaviors=dict.fromkeys(emulator.ENDPOINTS, behavior)
+    ) as server:
+        config = dict(BASE_CONFIG, microsoft=server.get_settings())
+        plugin._configure(config)
+
+        results = bench_setup(config, options.iterations)
+        results += bench_account_info(config, options.iterations)
+        results += bench_meter_billing(
+            config,
+            options.iterations,
+            options.dimensions
+        )
+        results += bench_concurrency(
+            config,
+            options.iterations,
+            options.concurrency
+        )
+        requests = dict(server.requests)
+
+    print_results(results)
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'latency': options.latency,
+        'requests': requests,
+        'results': results
+    }
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if options.compare:
+        with open(options.compare) as baseline:
+            baseline = json.load(baseline)
+        if compare(results, baseline, options.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,533 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+asyncio variants of the plugin hooks.
+
+meter_billing, meter_billing_bulk and get_account_info can be awaited
+from an event loop without tying up a thread per request, the requests
+are sent with the async transport. They share the configuration,
+caches, retry policy, outbox and accepted usage index of the plugin
+module, which is set up as usual with setup_adapter.
+
+The outbox, the disk cache and the shared token store use blocking
+file I/O and locks. With one of them configured the calls using them
+run in the default executor, so the event loop is not blocked.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import urllib.error
+import urllib.request
+import uuid
+
+from datetime import datetime
+
+from csp_billing_adapter.config import Config
+import csp_billing_adapter.exceptions as cba_exceptions
+
+from csp_billing_adapter_microsoft import (
+    idempotency,
+    plugin,
+    retry,
+    single_flight,
+    transport
+)
+
+log = logging.getLogger('CSPBillingAdapter')
+
+# Requests in flight, shared by the tasks sending the same request
+_single_flight = single_flight.AsyncSingleFlight()
+
+
+async def _run_in_executor(func, *args):
+    """Call func in the default executor with the current context."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None,
+        contextvars.copy_context().run,
+        func,
+        *args
+    )
+
+
+async def _run_io(func, *args):
+    """
+    Call func, which may use the outbox, the disk cache or the token
+    store. It runs in the default executor when one is configured.
+    """
+    if plugin._outbox or plugin._disk_cache or plugin._token_store:
+        return await _run_in_executor(func, *args)
+    return func(*args)
+
+
+async def meter_billing(
+    config: Config,
+    dimensions: dict,
+    timestamp: datetime,
+    dry_run: bool,
+    customer_id: str = None
+):
+    """Process a metered billing, see plugin.meter_billing."""
+    with plugin._trace(
+        'meter_billing',
+        dimensions=len(dimensions),
+        dry_run=dry_run
+    ), retry.deadline(plugin._billing_deadline):
+        try:
+            return await _meter_billing(
+                config,
+                dimensions,
+                timestamp,
+                dry_run
+            )
+        except retry.DeadlineExceeded as error:
+            return plugin._create_failed_status(dimensions, error)
+
+
+async def _meter_billing(
+    config: Config,
+    dimensions: dict,
+    timestamp: datetime,
+    dry_run: bool = False
+):
+    usage = plugin._create_usage_list(
+        dimensions,
+        timestamp,
+        config,
+        await _get_metering_context(config)
+    )
+    status = await _meter_usage(config, usage, dry_run)
+    if status:
+        return status
+
+    log.info(
+        'Nothing to meter bill: No dimensions have non zero quantity values'
+    )
+    return status
+
+
+async def meter_billing_bulk(
+    config: Config,
+    records: list,
+    dry_run: bool = False
+):
+    """Process the metered billing of many resources, see the plugin."""
+    usage = plugin._create_bulk_usage_list(records, config)
+
+    with plugin._trace(
+        'meter_billing_bulk',
+        events=len(usage),
+        dry_run=dry_run
+    ), retry.deadline(plugin._billing_deadline):
+        try:
+            status = await _meter_usage(
+                config,
+                usage,
+                dry_run,
+                idempotency.get_event_key
+            )
+        except retry.DeadlineExceeded as error:
+            status = plugin._create_failed_status(
+                {idempotency.get_event_key(event): None for event in usage},
+                error
+            )
+
+    return plugin._group_status_by_resource(status)
+
+
+async def _meter_usage(
+    config: Config,
+    usage: list,
+    dry_run: bool = False,
+    key=plugin._get_dimension
+):
+    """Submit the usage events, see plugin._meter_usage."""
+    use_outbox = plugin._outbox and not dry_run
+
+    if use_outbox:
+        await _run_in_executor(plugin._start_submission, usage)
+
+    try:
+        status, usage_to_submit = plugin._get_accepted_status(usage, key)
+        if len(usage_to_submit) > 0:
+            status.update(await _submit_batches(
+                config,
+                usage_to_submit,
+                await _get_msi_token(config),
+                key
+            ))
+    finally:
+        if use_outbox:
+            await _run_in_executor(plugin._end_submission, usage)
+
+    if use_outbox:
+        await _replay_outbox(config)
+
+    return status
+
+
+async def _submit_batches(
+    config: Config,
+    usage: list,
+    token: str,
+    key=plugin._get_dimension
+):
+    """Submit the usage in concurrent batches and merge their status."""
+    batches = [
+        usage[index:index + plugin._batch_size]
+        for index in range(0, len(usage), plugin._batch_size)
+    ]
+    workers = asyncio.Semaphore(plugin._batch_workers)
+
+    async def _submit(batch):
+        async with workers:
+            return await _submit_usage(config, batch, token, key)
+
+    status = {}
+    for batch_status in await asyncio.gather(
+        *(_submit(batch) for batch in batches)
+    ):
+        status.update(batch_status)
+    return status
+
+
+async def _replay_outbox(config: Config):
+    """Submit the usage events still pending in the outbox."""
+    if not plugin._outbox:
+        return
+
+    replayed = 0
+    token = None
+    with plugin._trace('replay_outbox') as span:
+        try:
+            with contextlib.closing(plugin._outbox.iter_pending(
+                plugin._batch_size * plugin._batch_workers
+            )) as pending:
+                # The pending events are read from disk in the executor
+                while True:
+                    usage = await _run_in_executor(next, pending, None)
+                    if usage is None:
+                        break
+
+                    # Stop once the deadline ran out
+                    retry.get_remaining()
+                    usage = await _run_in_executor(
+                        plugin._prepare_replay,
+                        usage
+                    )
+                    if not usage:
+                        continue
+
+                    token = token or await _get_msi_token(config)
+                    await _run_in_executor(
+                        plugin._settle_replay,
+                        usage,
+                        await _submit_batches(
+                            config,
+                            usage,
+                            token,
+                            idempotency.get_event_key
+                        )
+                    )
+                    replayed += len(usage)
+        except cba_exceptions.CSPBillingAdapterException as error:
+            log.warning('Unable to replay pending usage events: %s', error)
+        span.set_attribute('events', replayed)
+
+    if replayed:
+        log.info('Replayed %d pending usage events', replayed)
+
+
+async def _submit_usage(
+    config: Config,
+    usage: list,
+    token: str,
+    key=plugin._get_dimension
+):
+    """Submit one batch of usage events, see plugin._submit_usage."""
+    status = {}
+    attempt = 1
+    correlation_id = str(uuid.uuid4())
+
+    with plugin._trace(
+        'submit_batch',
+        correlation_id=correlation_id,
+        events=len(usage)
+    ) as span:
+        while True:
+            span.set_attribute('attempts', attempt)
+            try:
+                response = await _post_usage(
+                    config,
+                    usage,
+                    token,
+                    correlation_id
+                )
+            except (urllib.error.URLError, retry.DeadlineExceeded) as error:
+                status.update(
+                    plugin._create_failed_usage_status(usage, error, key)
+                )
+                return status
+
+            # Settling may drop the managed identity from the disk cache
+            settled_status, usage, delay = await _run_io(
+                plugin._settle_attempt,
+                usage,
+                response,
+                attempt,
+                key
+            )
+            status.update(settled_status)
+            if not usage:
+                return status
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def _post_usage(
+    config: Config,
+    usage: list,
+    token: str,
+    correlation_id: str = None
+):
+    """Post usage events to the batchUsageEvent API and return the result."""
+    data_request = plugin._create_usage_request(usage, token, correlation_id)
+
+    async def _refresh_token():
+        # The cached token was rejected, fetch a new one
+        # before trying again.
+        await _run_io(plugin._invalidate_msi_token, config)
+        data_request.add_header('authorization', await _get_msi_token(config))
+
+    async def _submit():
+        if plugin._rate_limiter:
+            await plugin._rate_limiter.acquire_async()
+        try:
+            with await _urlopen(data_request, 'marketplace') as response:
+                result = json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as error:
+            plugin._update_rate_limit(error=error)
+            raise
+        plugin._update_rate_limit(result)
+        return result
+
+    return await plugin._retry_policy.call_async(
+        _submit,
+        on_unauthorized=_refresh_token
+    )
+
+
+async def get_account_info(config: Config):
+    """Return a dictionary with account information, see the plugin hook."""
+    with plugin._trace('get_account_info'):
+        account_info = await _get_metadata()
+    account_info['cloud_provider'] = plugin.get_csp_name(config)
+
+    return account_info
+
+
+async def _urlopen(request: urllib.request.Request, endpoint: str):
+    """Send the request through the async transport, see plugin._urlopen."""
+    timeout = plugin._timeouts[endpoint]
+    remaining = retry.get_remaining()
+    if remaining is not None:
+        timeout = transport.Timeout(
+            min(timeout.connect, remaining),
+            min(timeout.read, remaining)
+        )
+
+    async def _open():
+        with plugin._guard_circuit(endpoint):
+            return await transport.get_async_transport().open(
+                request,
+                timeout
+            )
+
+    with plugin._trace_request(endpoint, request):
+        if plugin._metrics:
+            return await plugin._metrics.call_async(
+                endpoint,
+                plugin._get_operation(endpoint, request.full_url),
+                request,
+                _open
+            )
+        return await _open()
+
+
+async def _get_metadata():
+    """
+    Return a dict containing compute, network and signature information.
+
+    The instance metadata and the attested document are fetched
+    concurrently.
+    """
+    instance = asyncio.ensure_future(_get_instance_metadata())
+    signature = asyncio.ensure_future(_get_signature())
+    await asyncio.wait([instance, signature])
+
+    return plugin._build_metadata(instance, signature)
+
+
+async def _get_instance_metadata():
+    metadata = await _get_cached_metadata(
+        plugin._get_instance_metadata_url(),
+        plugin._instance_metadata_ttl
+    )
+    await _run_io(plugin._check_compute, metadata)
+    return metadata
+
+
+async def _get_signature():
+    return await _get_cached_metadata(
+        plugin._get_signature_url(),
+        plugin._attested_data_ttl,
+        plugin._get_attested_data_lifetime
+    )
+
+
+async def _get_cached_metadata(url: str, ttl: float, get_lifetime=None):
+    """Return the metadata document at url, see the plugin function."""
+    document = await _run_io(plugin._get_cached_document, url)
+    if document is not None:
+        return document
+
+    document = json.loads(await _fetch_metadata(url))
+    await _run_io(plugin._cache_document, url, document, ttl, get_lifetime)
+    return document
+
+
+async def _fetch_metadata(url: str):
+    """
+    Return the response of the metadata request.
+
+    Concurrent requests for the same url share a single request.
+    """
+    return await _single_flight.do(
+        ('imds', url),
+        lambda: _send_metadata(url)
+    )
+
+
+async def _send_metadata(url: str):
+    data_request = plugin._create_metadata_request(url)
+
+    async def _fetch():
+        with await _urlopen(data_request, 'imds') as value:
+            return value.read().decode("utf-8")
+
+    try:
+        return await plugin._retry_policy.call_async(_fetch)
+    except urllib.error.URLError as error:
+        log.error('Failed to retrieve metadata for: %s: %s', url, str(error))
+        return "{}"
+
+
+async def _get_msi_token(config: Config):
+    """Get the MSI token for the Billing API, see the plugin function."""
+    identity = plugin._get_token_identity(config)
+    token = await _run_io(plugin._get_cached_msi_token, identity)
+    plugin._record_cache('token', bool(token))
+    if token:
+        return token
+
+    with plugin._trace('msi_token', identity=identity):
+        return await _single_flight.do(
+            ('token', identity),
+            lambda: _refresh_msi_token(identity)
+        )
+
+
+async def _refresh_msi_token(identity: str):
+    if plugin._token_store:
+        return await _run_in_executor(plugin._refresh_msi_token, identity)
+
+    token = await _run_io(plugin._get_cached_msi_token, identity)
+    if token:
+        return token
+
+    try:
+        token, expires_on = plugin._parse_msi_token(
+            await _fetch_metadata(plugin._get_msi_token_url(identity))
+        )
+    except ValueError as error:
+        log.error('Unable to acquire an MSI token %s:', str(error))
+        raise cba_exceptions.CSPBillingAdapterException from error
+
+    await _run_io(plugin._cache_msi_token, identity, token, expires_on)
+    return token
+
+
+async def _get_metering_context(config: Config):
+    """Return the resource uri and plan id, see the plugin function."""
+    source = plugin._get_metering_source(config)
+    context = plugin._get_cached_metering_context(source)
+    if context:
+        return context
+
+    resource_uri, plan_id = source[:2]
+    if resource_uri is None or plan_id is None:
+        # if not present, it is running on a VM
+        with plugin._trace('resolve_resource') as span:
+            resource_uri = plugin._get_managed_by(
+                await _get_managed_identity()
+            )
+            span.set_attribute('resource_uri', resource_uri)
+        plan_id = plugin._get_plan_id(config)
+
+    return plugin._cache_metering_context(source, resource_uri, plan_id)
+
+
+async def _get_managed_identity():
+    url, identity = await _run_io(
+        plugin._lookup_managed_identity,
+        await _get_instance_metadata()
+    )
+    if identity is not None:
+        return identity
+
+    data_request = plugin._create_managed_identity_request(
+        url,
+        await _get_msi_token({'api': '1'})
+    )
+
+    async def _refresh_token():
+        await _run_io(plugin._invalidate_msi_token, {'api': '1'})
+        data_request.add_header(
+            'authorization',
+            await _get_msi_token({'api': '1'})
+        )
+
+    async def _fetch():
+        with await _urlopen(data_request, 'arm') as value:
+            return json.loads(value.read().decode("utf-8"))
+
+    def _send():
+        return plugin._retry_policy.call_async(
+            _fetch,
+            on_unauthorized=_refresh_token
+        )
+
+    try:
+        identity = await _single_flight.do(('arm', url), _send)
+    except urllib.error.URLError as error:
+        return plugin._managed_identity_failed(url, error)
+
+    await _run_io(plugin._cache_managed_identity, url, identity)
+    return identity
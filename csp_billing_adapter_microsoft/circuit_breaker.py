@@ -0,0 +1,182 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Circuit breakers for the endpoints the plugin sends requests to.
+
+A breaker is closed while the endpoint works. It opens when the share
+of failed requests within the sliding window reaches the failure rate,
+requests are then refused right away instead of waiting for timeouts
+and retries. Once the reset timeout has passed the breaker is half open
+and lets a single trial request through, the breaker closes if it
+succeeds and opens again otherwise.
+"""
+
+import collections
+import logging
+import threading
+import time
+import urllib.error
+
+log = logging.getLogger('CSPBillingAdapter')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+DEFAULT_FAILURE_RATE = 0.5
+DEFAULT_MINIMUM_CALLS = 5
+DEFAULT_WINDOW = 60
+DEFAULT_RESET_TIMEOUT = 30
+
+
+class CircuitOpenError(urllib.error.URLError):
+    """The request was refused because the circuit of its endpoint is open."""
+
+
+def is_failure(error: urllib.error.URLError):
+    """
+    Return True if the error means the endpoint is not working.
+
+    Connection errors, timeouts and server errors count as failures.
+    Other responses, throttling included, show the endpoint is up.
+    """
+    code = getattr(error, 'code', None)
+    return code is None or code == 408 or code >= 500
+
+
+class CircuitBreaker:
+    """Track the outcome of the requests to one endpoint."""
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate: float = DEFAULT_FAILURE_RATE,
+        minimum_calls: int = DEFAULT_MINIMUM_CALLS,
+        window: float = DEFAULT_WINDOW,
+        reset_timeout: float = DEFAULT_RESET_TIMEOUT
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.minimum_calls = max(int(minimum_calls), 1)
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        # Monotonic time and outcome of the calls in the window
+        self._calls = collections.deque()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self._calls and self._calls[0][0] <= now - self.window:
+            _, failed = self._calls.popleft()
+            self._failures -= failed
+
+    def _set_state(self, state: str, now: float):
+        if state == OPEN:
+            self._opened_at = now
+        elif state == CLOSED:
+            self._calls.clear()
+            self._failures = 0
+
+        if state != self.state:
+            self.state = state
+            if state == OPEN:
+                log.warning(
+                    'Circuit for %s opened, requests are refused for '
+                    '%.0f seconds',
+                    self.name,
+                    self.reset_timeout
+                )
+            else:
+                log.info('Circuit for %s is %s', self.name, state)
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if a request may not be sent now.
+
+        While half open only a single trial request is let through.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (
+                self.state == OPEN
+                and now - self._opened_at >= self.reset_timeout
+            ):
+                self._set_state(HALF_OPEN, now)
+
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+
+        raise CircuitOpenError(f'Circuit for {self.name} is open')
+
+    def on_success(self):
+        """Record a request that reached the endpoint."""
+        self._record(False)
+
+    def on_failure(self):
+        """Record a request that failed to reach the endpoint."""
+        self._record(True)
+
+    def on_abort(self):
+        """Release the trial of a request that finished without outcome."""
+        with self._lock:
+            self._trial = False
+
+    def _record(self, failed: bool):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                if self._trial:
+                    self._trial = False
+                    self._set_state(OPEN if failed else CLOSED, now)
+                return
+            if self.state == OPEN:
+                # Sent before the circuit opened
+                return
+
+            self._prune(now)
+            self._calls.append((now, failed))
+            self._failures += failed
+            if (
+                failed
+                and len(self._calls) >= self.minimum_calls
+                and self._failures / len(self._calls) >= self.failure_rate
+            ):
+                self._set_state(OPEN, now)
+
+    def get_state(self):
+        """Return the current state of the breaker."""
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            retry_in = 0
+            if self.state == OPEN:
+                retry_in = max(
+                    self.reset_timeout - (now - self._opened_at),
+                    0
+                )
+            return {
+                'state': self.state,
+                'calls': len(self._calls),
+                'failures': self._failures,
+                'retry_in': retry_in
+            }
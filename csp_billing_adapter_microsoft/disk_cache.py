@@ -0,0 +1,100 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+File backed cache shared by adapter processes.
+
+Each entry is a JSON file holding the value and the epoch time it
+expires at. Entries are written to a temporary file that is renamed
+into place, so readers never see a partial entry. Expired, unreadable
+or corrupt entries are treated as missing.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+log = logging.getLogger('CSPBillingAdapter')
+
+
+class DiskCache:
+    """Store JSON values with a TTL as files in a directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _get_path(self, name: str):
+        digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{digest}.json')
+
+    def get(self, name: str):
+        """
+        Return the value and the epoch time it expires at.
+
+        None is returned for missing, expired or corrupt entries.
+        """
+        path = self._get_path(name)
+        try:
+            with open(path, 'r', encoding='utf-8') as entry_file:
+                entry = json.load(entry_file)
+            expires_at = float(entry['expires_at'])
+            value = entry['value']
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            log.warning('Ignoring corrupt cache entry %s: %s', path, error)
+            return None
+
+        if expires_at <= time.time():
+            return None
+
+        return value, expires_at
+
+    def set(self, name: str, value, ttl: float):
+        """Store the value for ttl seconds, errors are logged."""
+        if ttl <= 0:
+            return
+
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(
+                dir=self.directory,
+                prefix='.',
+                suffix='.tmp'
+            )
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as entry_file:
+                    json.dump(
+                        {'expires_at': time.time() + ttl, 'value': value},
+                        entry_file
+                    )
+                os.replace(temp_path, self._get_path(name))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except (OSError, TypeError, ValueError) as error:
+            log.warning('Unable to write cache entry %s: %s', name, error)
+
+    def delete(self, name: str):
+        try:
+            os.unlink(self._get_path(name))
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            log.warning('Unable to delete cache entry %s: %s', name, error)
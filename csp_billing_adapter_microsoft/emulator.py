@@ -0,0 +1,495 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Local stand-in for the Azure endpoints used by the plugin.
+
+The emulator is an HTTP server answering the IMDS versions, instance,
+attested document and MSI token requests, the resource group lookup of
+the resource manager and the batchUsageEvent requests of the
+marketplace metering API. Pointing the metadata_url,
+managed_identity_url and marketplace_url settings at it runs the plugin
+against real sockets.
+
+The behavior of each endpoint is set with a Behavior: a latency
+distribution and the share of requests answered with a throttling
+(429) or server (5xx) error, whose connection is reset, or, for the
+marketplace, whose usage events are reported as duplicates. The
+endpoints are versions, instance, attested, token, arm and marketplace.
+
+Run it standalone with python -m csp_billing_adapter_microsoft.emulator.
+"""
+
+import argparse
+import json
+import logging
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+log = logging.getLogger('CSPBillingAdapter')
+
+ENDPOINTS = (
+    'versions',
+    'instance',
+    'attested',
+    'token',
+    'arm',
+    'marketplace'
+)
+# Seconds the server takes at most to notice it was stopped
+POLL_INTERVAL = 0.05
+API_VERSIONS = ['2019-03-11', '2020-09-01', '2021-02-01']
+RESOURCE_GROUP_PATH = re.compile(
+    r'^/subscriptions/([^/]+)/resourceGroups/([^/]+)$'
+)
+
+
+def fixed(seconds: float):
+    """Return a latency distribution that always takes seconds."""
+    return lambda rng: seconds
+
+
+def uniform(low: float, high: float):
+    """Return a latency distribution uniform between low and high."""
+    return lambda rng: rng.uniform(low, high)
+
+
+def exponential(mean: float):
+    """Return an exponential latency distribution with the given mean."""
+    return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0
+
+
+def lognormal(median: float, sigma: float):
+    """
+    Return a log-normal latency distribution.
+
+    Most requests take about median seconds with a long tail of slow
+    ones, the tail grows with sigma.
+    """
+    return lambda rng: median * rng.lognormvariate(0, sigma)
+
+
+class Behavior:
+    """
+    How an endpoint answers.
+
+    latency is a distribution returned by fixed, uniform, exponential
+    or lognormal, or None. The rates are the share of requests, between
+    0 and 1, that are throttled, fail with error_status, have their
+    connection reset or, for the marketplace, get duplicate results.
+    """
+
+    def __init__(
+        self,
+        latency=None,
+        throttle_rate: float = 0,
+        retry_after: float = None,
+        error_rate: float = 0,
+        error_status: int = 503,
+        reset_rate: float = 0,
+        duplicate_rate: float = 0
+    ):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.reset_rate = reset_rate
+        self.duplicate_rate = duplicate_rate
+
+
+class Emulator:
+    """
+    Serve the emulated endpoints from a background thread.
+
+    Use it as a context manager or call start and stop. The default
+    port 0 picks a free port, see url.
+    """
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        behaviors: dict = None,
+        seed: int = None,
+        subscription_id: str = 'sub',
+        resource_group: str = 'group',
+        managed_by: str = None,
+        token_lifetime: int = 3600
+    ):
+        self.behaviors = dict(behaviors or {})
+        self.subscription_id = subscription_id
+        self.resource_group = resource_group
+        self.managed_by = managed_by or (
+            f'/subscriptions/{subscription_id}/resourceGroups/'
+            f'{resource_group}/providers/Microsoft.Solutions/'
+            f'applications/emulated'
+        )
+        self.token_lifetime = token_lifetime
+        # Requests received by endpoint
+        self.requests = dict.fromkeys(ENDPOINTS, 0)
+        # Usage event id by resource, plan, dimension and hour
+        self.accepted = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.emulator = self
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def get_settings(self):
+        """Return the microsoft config settings that use the emulator."""
+        return {
+            'metadata_url': f'{self.url}/metadata/',
+            'managed_identity_url': f'{self.url}/subscriptions/',
+            'marketplace_url': f'{self.url}/api/'
+        }
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            args=(POLL_INTERVAL,),
+            name='azure-emulator',
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _roll(self, rate: float):
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def _get_latency(self, behavior: Behavior):
+        if not behavior.latency:
+            return 0
+        with self._lock:
+            return max(behavior.latency(self._random), 0)
+
+    def _count(self, endpoint: str):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def _get_instance(self):
+        return {
+            'compute': {
+                'vmId': str(uuid.uuid5(uuid.NAMESPACE_URL, self.url)),
+                'subscriptionId': self.subscription_id,
+                'resourceGroupName': self.resource_group,
+                'location': 'westeurope',
+                'vmSize': 'Standard_D2s_v3'
+            },
+            'network': {'interface': []}
+        }
+
+    def _get_attested(self):
+        return {
+            'encoding': 'pkcs7',
+            'signature': 'ZW11bGF0ZWQ='
+        }
+
+    def _get_token(self):
+        now = int(time.time())
+        return {
+            'access_token': uuid.uuid4().hex,
+            'expires_in': str(self.token_lifetime),
+            'expires_on': str(now + self.token_lifetime),
+            'not_before': str(now),
+            'resource': 'https://management.azure.com/',
+            'token_type': 'Bearer'
+        }
+
+    def _get_resource_group(self, subscription_id, resource_group):
+        return {
+            'id': (
+                f'/subscriptions/{subscription_id}/'
+                f'resourceGroups/{resource_group}'
+            ),
+            'name': resource_group,
+            'managedBy': self.managed_by
+        }
+
+    def _submit_usage(self, usage: list, duplicates: bool):
+        """Return the batchUsageEvent result for the usage events."""
+        results = []
+        for event in usage:
+            key = (
+                event.get('resourceUri'),
+                event.get('planId'),
+                event.get('dimension'),
+                event.get('effectiveStartTime')
+            )
+            with self._lock:
+                usage_event_id = self.accepted.get(key)
+                # Injected duplicates look as if sent by another client
+                duplicate = usage_event_id is not None or duplicates
+                if usage_event_id is None:
+                    usage_event_id = self.accepted[key] = str(uuid.uuid4())
+
+            result = dict(event, messageTime=_now())
+            if duplicate:
+                result.update({
+                    'status': 'Duplicate',
+                    'error': {
+                        'code': 'Conflict',
+                        'message': 'This usage event already exist.',
+                        'additionalInfo': {
+                            'acceptedMessage': dict(
+                                event,
+                                usageEventId=usage_event_id,
+                                status='Accepted'
+                            )
+                        }
+                    }
+                })
+            else:
+                result.update({
+                    'usageEventId': usage_event_id,
+                    'status': 'Accepted'
+                })
+            results.append(result)
+
+        return {'count': len(results), 'result': results}
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this delayed
+    # acks add 40ms to every response on a kept alive connection
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        log.debug('Emulator: ' + format, *args)
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        emulator = self.server.emulator
+        parts = urlsplit(self.path)
+        # The plugin joins the managed identity url with an extra slash
+        path = re.sub('/+', '/', parts.path)
+        query = parse_qs(parts.query)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        endpoint, respond = self._route(emulator, path, query, body)
+        if endpoint is None:
+            return respond()
+
+        emulator._count(endpoint)
+        behavior = emulator.behaviors.get(endpoint) or Behavior()
+        time.sleep(emulator._get_latency(behavior))
+
+        if emulator._roll(behavior.reset_rate):
+            return self._reset()
+        if emulator._roll(behavior.throttle_rate):
+            headers = {}
+            if behavior.retry_after is not None:
+                headers['Retry-After'] = str(behavior.retry_after)
+            return self._send(429, {'error': 'Too Many Requests'}, headers)
+        if emulator._roll(behavior.error_rate):
+            return self._send(
+                behavior.error_status,
+                {'error': 'Service Unavailable'}
+            )
+
+        duplicates = emulator._roll(behavior.duplicate_rate)
+        return respond(duplicates)
+
+    def _route(self, emulator, path, query, body):
+        """Return the endpoint name and a function sending its answer."""
+        if path.startswith('/metadata/'):
+            if self.headers.get('Metadata', '').lower() != 'true':
+                return None, lambda: self._send(
+                    400,
+                    {'error': 'Required metadata header not specified'}
+                )
+
+        if path == '/metadata/versions':
+            return 'versions', lambda *_: self._send(
+                200,
+                {'apiVersions': API_VERSIONS}
+            )
+        if path == '/metadata/instance':
+            return 'instance', lambda *_: self._send(
+                200,
+                emulator._get_instance()
+            )
+        if path == '/metadata/attested/document':
+            return 'attested', lambda *_: self._send(
+                200,
+                emulator._get_attested()
+            )
+        if path == '/metadata/identity/oauth2/token':
+            if 'resource' not in query:
+                return None, lambda: self._send(
+                    400,
+                    {'error': 'invalid_request'}
+                )
+            return 'token', lambda *_: self._send(
+                200,
+                emulator._get_token()
+            )
+
+        match = RESOURCE_GROUP_PATH.match(path)
+        if match:
+            return 'arm', lambda *_: self._send_authorized(
+                lambda: emulator._get_resource_group(*match.groups())
+            )
+
+        if path == '/api/batchUsageEvent' and self.command == 'POST':
+            def _submit(duplicates=False):
+                try:
+                    usage = json.loads(body)['request']
+                except (ValueError, KeyError, TypeError):
+                    return self._send(400, {'error': 'Bad request'})
+                return self._send_authorized(
+                    lambda: emulator._submit_usage(usage, duplicates)
+                )
+            return 'marketplace', _submit
+
+        return None, lambda: self._send(404, {'error': 'Not found'})
+
+    def _send_authorized(self, get_body):
+        if not self.headers.get('authorization', '').startswith('Bearer '):
+            return self._send(401, {'error': 'Unauthorized'})
+        return self._send(200, get_body())
+
+    def _send(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _reset(self):
+        """Close the connection with a reset, without a response."""
+        self.connection.setsockopt(
+            socket.SOL_SOCKET,
+            socket.SO_LINGER,
+            struct.pack('ii', 1, 0)
+        )
+        self.close_connection = True
+        # The reset is sent once the handler released the socket
+        self.connection.close()
+
+
+def _parse_latency(value: str):
+    """Parse a latency distribution given as name:arg[,arg]."""
+    name, _, args = value.partition(':')
+    distributions = {
+        'fixed': fixed,
+        'uniform': uniform,
+        'exponential': exponential,
+        'lognormal': lognormal
+    }
+    try:
+        return distributions[name](*(float(arg) for arg in args.split(',')))
+    except (KeyError, TypeError, ValueError):
+        raise argparse.ArgumentTypeError(
+            f'Invalid latency {value}, expected for example fixed:0.05, '
+            'uniform:0.01,0.1, exponential:0.05 or lognormal:0.05,0.5'
+        )
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Emulate the Azure endpoints used by the plugin.'
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument(
+        '--endpoint',
+        choices=ENDPOINTS,
+        action='append',
+        help='Endpoint the fault options apply to, all when not given'
+    )
+    parser.add_argument('--latency', type=_parse_latency)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--retry-after', type=float)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--reset-rate', type=float, default=0)
+    parser.add_argument('--duplicate-rate', type=float, default=0)
+    options = parser.parse_args(args)
+
+    behavior = Behavior(
+        latency=options.latency,
+        throttle_rate=options.throttle_rate,
+        retry_after=options.retry_after,
+        error_rate=options.error_rate,
+        error_status=options.error_status,
+        reset_rate=options.reset_rate,
+        duplicate_rate=options.duplicate_rate
+    )
+    emulator = Emulator(
+        options.host,
+        options.port,
+        behaviors=dict.fromkeys(options.endpoint or ENDPOINTS, behavior),
+        seed=options.seed
+    )
+
+    print('Add to the microsoft section of the adapter config:')
+    for name, value in emulator.get_settings().items():
+        print(f'  {name}: {value}')
+
+    emulator.start()
+    try:
+        emulator._thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Index of the usage events accepted by the marketplace.
+
+The marketplace accepts a single usage event per resource, plan,
+dimension and hour. Keeping the accepted ones lets the plugin answer
+a repeated report without sending it. Entries are evicted once their
+hour is past the window in which the marketplace accepts usage.
+"""
+
+import threading
+
+from datetime import datetime, timedelta, timezone
+
+# Usage older than this is no longer accepted by the marketplace
+ACCEPTANCE_WINDOW = timedelta(hours=24)
+
+
+def get_hour_bucket(value):
+    """
+    Return the UTC hour the time falls in as an ISO 8601 string.
+
+    Values are datetimes or strings in ISO format, naive times are
+    taken as UTC. Strings that can not be parsed are returned as is.
+    """
+    if isinstance(value, str):
+        try:
+            # fromisoformat only accepts the Z suffix from Python 3.11
+            value = datetime.fromisoformat(
+                value[:-1] + '+00:00' if value.endswith('Z') else value
+            )
+        except ValueError:
+            return value
+
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+
+    value = value.astimezone(timezone.utc).replace(
+        minute=0,
+        second=0,
+        microsecond=0
+    )
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def get_event_key(event: dict):
+    """Return the key the marketplace deduplicates a usage event on."""
+    return (
+        event.get('resourceUri'),
+        event.get('planId'),
+        event.get('dimension'),
+        get_hour_bucket(event.get('effectiveStartTime'))
+    )
+
+
+class AcceptedIndex:
+    """Map the keys of accepted usage events to their usageEventId."""
+
+    def __init__(self, window: timedelta = ACCEPTANCE_WINDOW):
+        self.window = window
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._evicted_before = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, event: dict):
+        """Return the usageEventId the event was accepted with or None."""
+        with self._lock:
+            return self._entries.get(get_event_key(event))
+
+    def add(self, event: dict, usage_event_id: str):
+        """Record an accepted event and evict the expired entries."""
+        with self._lock:
+            self._entries[get_event_key(event)] = usage_event_id
+            self._evict()
+
+    def _evict(self):
+        oldest = get_hour_bucket(datetime.now(timezone.utc) - self.window)
+        if oldest == self._evicted_before:
+            # Nothing expired since the last eviction
+            return
+
+        self._evicted_before = oldest
+        # Hour buckets sort in time order as ISO strings
+        self._entries = {
+            key: usage_event_id
+            for key, usage_event_id in self._entries.items()
+            if key[3] >= oldest
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,380 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Metrics of the requests sent by the plugin.
+
+A Registry holds counters, gauges and histograms with labels and renders
+them in the Prometheus text exposition format, or as a dict. Metrics
+defines the ones recorded by the plugin: the latency, status and
+retries of every request by endpoint and operation, the cache lookups
+and the status of the submitted usage events.
+
+Metrics are only recorded when enabled in the config, otherwise the
+plugin skips them after checking that none are configured.
+"""
+
+import contextlib
+import math
+import threading
+import time
+import urllib.error
+
+from csp_billing_adapter_microsoft import circuit_breaker
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+)
+PREFIX = 'csp_billing_adapter_microsoft_'
+# Request attribute counting the times it was sent
+ATTEMPTS_ATTRIBUTE = '_metrics_attempts'
+
+
+def _format_value(value: float):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str):
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def _format_labels(labels: dict):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        f'{name}="{_escape(value)}"' for name, value in labels.items()
+    ) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _get_labels(self, values: tuple):
+        return dict(zip(self.labelnames, values))
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._values.items(), key=lambda item: item[0])
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}'
+        ]
+        for values, value in self._items():
+            lines.extend(self._render_sample(self._get_labels(values), value))
+        return lines
+
+    def _render_sample(self, labels: dict, value):
+        return [
+            f'{self.name}{_format_labels(labels)} {_format_value(value)}'
+        ]
+
+    def snapshot(self):
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'samples': [
+                {'labels': self._get_labels(values), 'value': value}
+                for values, value in self._items()
+            ]
+        }
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+
+class Gauge(_Metric):
+    """A value that is set to the current state."""
+
+    type = 'gauge'
+
+    def set(self, *labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+    def get(self, *labels):
+        with self._lock:
+            return self._values.get(labels)
+
+
+class Histogram(_Metric):
+    """Counts of observed values by upper bound, with their sum."""
+
+    type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets=DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, *labels, value: float):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = {
+                    'buckets': [0] * len(self.buckets),
+                    'sum': 0,
+                    'count': 0
+                }
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts['buckets'][index] += 1
+                    break
+            counts['sum'] += value
+            counts['count'] += 1
+
+    def _items(self):
+        with self._lock:
+            return [
+                (values, {
+                    'buckets': list(counts['buckets']),
+                    'sum': counts['sum'],
+                    'count': counts['count']
+                })
+                for values, counts in sorted(self._values.items())
+            ]
+
+    def _get_cumulative(self, counts: dict):
+        total = 0
+        cumulative = {}
+        for bound, count in zip(self.buckets, counts['buckets']):
+            total += count
+            cumulative[bound] = total
+        return cumulative
+
+    def _render_sample(self, labels: dict, counts: dict):
+        lines = [
+            f'{self.name}_bucket'
+            f'{_format_labels(dict(labels, le=_format_value(bound)))} '
+            f'{total}'
+            for bound, total in self._get_cumulative(counts).items()
+        ]
+        lines.append(
+            f'{self.name}_sum{_format_labels(labels)} '
+            f'{_format_value(counts["sum"])}'
+        )
+        lines.append(
+            f'{self.name}_count{_format_labels(labels)} {counts["count"]}'
+        )
+        return lines
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        for sample in snapshot['samples']:
+            counts = sample['value']
+            sample['value'] = {
+                'count': counts['count'],
+                'sum': counts['sum'],
+                'buckets': {
+                    _format_value(bound): total
+                    for bound, total in self._get_cumulative(counts).items()
+                }
+            }
+        return snapshot
+
+
+class Registry:
+    """A set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'Duplicate metric: {metric.name}')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets=DEFAULT_BUCKETS
+    ):
+        return self._add(
+            Histogram(name, documentation, labelnames, buckets)
+        )
+
+    def add_collector(self, collect):
+        """Call collect to update gauges before the metrics are read."""
+        self._collectors.append(collect)
+
+    def _collect(self):
+        for collect in self._collectors:
+            collect()
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        self._collect()
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Return the metrics as a dict by name."""
+        self._collect()
+        return {
+            name: metric.snapshot() for name, metric in self._metrics.items()
+        }
+
+
+class Metrics:
+    """The metrics recorded by the plugin."""
+
+    def __init__(self, registry: Registry = None, buckets=DEFAULT_BUCKETS):
+        self.registry = registry or Registry()
+        self.request_duration = self.registry.histogram(
+            f'{PREFIX}request_duration_seconds',
+            'Duration of the requests sent',
+            ('endpoint', 'operation'),
+            buckets
+        )
+        self.requests = self.registry.counter(
+            f'{PREFIX}requests_total',
+            'Requests sent by response status, error or circuit_open',
+            ('endpoint', 'operation', 'status')
+        )
+        self.retries = self.registry.counter(
+            f'{PREFIX}retries_total',
+            'Requests sent again after a failed attempt',
+            ('endpoint', 'operation')
+        )
+        self.cache_lookups = self.registry.counter(
+            f'{PREFIX}cache_lookups_total',
+            'Cache lookups by cache and result, hit or miss',
+            ('cache', 'result')
+        )
+        self.usage_events = self.registry.counter(
+            f'{PREFIX}usage_events_total',
+            'Usage event results returned by the marketplace by status',
+            ('status',)
+        )
+        self.circuit_open = self.registry.gauge(
+            f'{PREFIX}circuit_open',
+            'Whether the circuit of the endpoint is open or half open',
+            ('endpoint',)
+        )
+        self.rate_limit = self.registry.gauge(
+            f'{PREFIX}marketplace_rate_limit',
+            'Current marketplace requests per second limit'
+        )
+
+    @contextlib.contextmanager
+    def _observe_request(self, endpoint: str, operation: str, request):
+        attempts = getattr(request, ATTEMPTS_ATTRIBUTE, 0)
+        setattr(request, ATTEMPTS_ATTRIBUTE, attempts + 1)
+        if attempts:
+            self.retries.inc(endpoint, operation)
+
+        observation = {'status': 'error'}
+        start = time.perf_counter()
+        try:
+            yield observation
+        except urllib.error.HTTPError as error:
+            observation['status'] = str(error.code)
+            raise
+        except circuit_breaker.CircuitOpenError:
+            observation['status'] = 'circuit_open'
+            raise
+        finally:
+            self.request_duration.observe(
+                endpoint,
+                operation,
+                value=time.perf_counter() - start
+            )
+            self.requests.inc(endpoint, operation, observation['status'])
+
+    def call(self, endpoint: str, operation: str, request, open_request):
+        """
+        Return the response of open_request for the request.
+
+        Its duration and status are recorded, a request sent before
+        counts as a retry.
+        """
+        with self._observe_request(endpoint, operation, request) as observed:
+            response = open_request()
+            observed['status'] = str(response.getcode())
+            return response
+
+    async def call_async(
+        self,
+        endpoint: str,
+        operation: str,
+        request,
+        open_request
+    ):
+        """Await the response of open_request, see call."""
+        with self._observe_request(endpoint, operation, request) as observed:
+            response = await open_request()
+            observed['status'] = str(response.getcode())
+            return response
+
+    def record_cache(self, cache: str, hit: bool):
+        self.cache_lookups.inc(cache, 'hit' if hit else 'miss')
+
+    def get_cache_hit_ratios(self):
+        """Return the share of hits of each cache looked up."""
+        lookups = {}
+        for sample in self.cache_lookups.snapshot()['samples']:
+            labels = sample['labels']
+            counts = lookups.setdefault(labels['cache'], {})
+            counts[labels['result']] = sample['value']
+        return {
+            cache: counts.get('hit', 0) / sum(counts.values())
+            for cache, counts in lookups.items()
+        }
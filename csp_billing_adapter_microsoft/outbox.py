@@ -0,0 +1,217 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Durable outbox for usage events.
+
+Usage events are appended to a write ahead log before they are
+submitted and acknowledged once they are settled. Events that were
+never acknowledged, because the adapter stopped while submitting them,
+are replayed later. Events are keyed like the marketplace deduplicates
+them, by resource, plan, dimension and hour.
+
+The log is a JSON lines file of add and ack records. Reading it only
+keeps the event keys and file offsets in memory, the events are read
+back one at a time. The log is rewritten with just the pending events
+once enough of its records have been acknowledged.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from csp_billing_adapter_microsoft.idempotency import get_event_key
+
+log = logging.getLogger('CSPBillingAdapter')
+
+DEFAULT_COMPACT_THRESHOLD = 1000
+
+
+class Outbox:
+    """
+    A write ahead log of usage events pending submission.
+
+    Every add or ack call is written with a single fsync.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compact_threshold: int = DEFAULT_COMPACT_THRESHOLD
+    ):
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self._acked = None
+        # Pending events being read, the log is not compacted meanwhile
+        self._readers = 0
+
+    def _append(self, records):
+        os.makedirs(
+            os.path.dirname(os.path.abspath(self.path)),
+            exist_ok=True
+        )
+        fd = os.open(
+            self.path,
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o600
+        )
+        with os.fdopen(fd, 'a', encoding='utf-8') as log_file:
+            for record in records:
+                log_file.write(json.dumps(record) + '\n')
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+    def _scan(self):
+        """
+        Return the file offset of every pending event by key.
+
+        Lines that can not be parsed, such as a record cut short by a
+        crash, are skipped.
+        """
+        pending = {}
+        acked = 0
+        try:
+            with open(self.path, 'rb') as log_file:
+                offset = 0
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                        # Keys are written as JSON lists
+                        key = tuple(record['key'])
+                        if record['op'] == 'add':
+                            pending[key] = offset
+                        elif record['op'] == 'ack':
+                            acked += 1
+                            pending.pop(key, None)
+                    except (ValueError, KeyError, TypeError):
+                        log.warning(
+                            'Skipping invalid outbox record at %d in %s',
+                            offset,
+                            self.path
+                        )
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+
+        self._acked = acked
+        return pending
+
+    def _read_events(self, offsets):
+        if not offsets:
+            return
+
+        with open(self.path, 'rb') as log_file:
+            for offset in offsets:
+                log_file.seek(offset)
+                yield json.loads(log_file.readline())['event']
+
+    def add(self, events: list):
+        """Persist the usage events before they are submitted."""
+        if not events:
+            return
+
+        with self._lock:
+            self._append(
+                {'op': 'add', 'key': get_event_key(event), 'event': event}
+                for event in events
+            )
+
+    def ack(self, events: list):
+        """Mark the usage events as settled by the marketplace."""
+        if not events:
+            return
+
+        with self._lock:
+            self._append(
+                {'op': 'ack', 'key': get_event_key(event)}
+                for event in events
+            )
+            if self._acked is None:
+                self._scan()
+            else:
+                self._acked += len(events)
+
+            if self._acked >= self.compact_threshold and not self._readers:
+                self._compact()
+
+    def iter_pending(self, batch_size: int):
+        """
+        Yield lists of at most batch_size pending usage events.
+
+        The pending events are determined when iteration starts.
+        """
+        with self._lock:
+            pending = self._scan()
+            self._readers += 1
+
+        try:
+            batch = []
+            for event in self._read_events(sorted(pending.values())):
+                batch.append(event)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+            if batch:
+                yield batch
+        finally:
+            with self._lock:
+                self._readers -= 1
+
+    def compact(self):
+        """Rewrite the log with only the pending events."""
+        with self._lock:
+            if not self._readers:
+                self._compact()
+
+    def _compact(self):
+        if not os.path.exists(self.path):
+            return
+
+        pending = self._scan()
+        temp_path = f'{self.path}.tmp'
+        fd = os.open(
+            temp_path,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+            0o600
+        )
+        with os.fdopen(fd, 'w', encoding='utf-8') as log_file:
+            for event in self._read_events(sorted(pending.values())):
+                log_file.write(json.dumps({
+                    'op': 'add',
+                    'key': get_event_key(event),
+                    'event': event
+                }) + '\n')
+            log_file.flush()
+            os.fsync(log_file.fileno())
+
+        os.replace(temp_path, self.path)
+        self._fsync_dir()
+        self._acked = 0
+        log.debug(
+            'Compacted outbox %s, %d events pending',
+            self.path,
+            len(pending)
+        )
+
+    def _fsync_dir(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -17,47 +17,248 @@
 """
 Implements the CSP hook functions for Microsoft Azure AWS. This handles the
 metered billing of product usage in the Azure.
+
+The hook functions are safe to call from several threads at once. The
+module caches are shared by all threads, and identical metadata, token
+and managed identity requests that are in flight at the same time are
+sent once with the result shared by the callers.
 """
 
+import base64
+import contextlib
+import contextvars
+import copy
+import hashlib
 import json
 import logging
 import os
+import re
+import sys
+import threading
+import time
+import urllib.parse
 import urllib.request
 import urllib.error
 import uuid
 
-from datetime import datetime
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 import csp_billing_adapter
 import csp_billing_adapter.exceptions as cba_exceptions
 
 from csp_billing_adapter.config import Config
-from csp_billing_adapter_microsoft import __version__
+from csp_billing_adapter_microsoft import (
+    __version__,
+    circuit_breaker,
+    disk_cache,
+    idempotency,
+    metrics,
+    outbox,
+    profiling,
+    rate_limit,
+    retry,
+    single_flight,
+    token_store,
+    tracing,
+    transport
+)
 
 log = logging.getLogger('CSPBillingAdapter')
 
 METADATA_URL = 'http://169.254.169.254/metadata/'
 # We want the attested data, this is the version that supports that endpoint
 REQUIRED_METADATA_VERSION = '2020-09-01'
-SIGNATURE_URL = (
-    f"{METADATA_URL}attested/document?api-version={REQUIRED_METADATA_VERSION}"
-)
 METADATA_HEADER = {'Metadata': 'True'}
 TOKEN_API_VERSION = '2018-02-01'
 TOKEN_RESOURCE = 'https://management.azure.com/'
 MANAGED_IDENTITY_URL = 'https://management.azure.com/subscriptions/'
 MANAGED_IDENTITY_VERSION = '2019-10-01'
+MARKETPLACE_URL = 'https://marketplaceapi.microsoft.com/api/'
+MARKETPLACE_API_VERSION = '2018-08-31'
+# Metrics operation of the IMDS requests by url path marker
+METADATA_OPERATIONS = (
+    ('identity/oauth2/token', 'token'),
+    ('attested/', 'attested'),
+    ('instance', 'instance'),
+    ('versions', 'versions')
+)
+ENDPOINT_OPERATIONS = {
+    'arm': 'managed_identity',
+    'marketplace': 'batch_usage'
+}
+# Refresh cached MSI tokens this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 300
+# Default seconds instance metadata and attested documents are reused
+DEFAULT_INSTANCE_METADATA_TTL = 300
+DEFAULT_ATTESTED_DATA_TTL = 300
+# Stop reusing an attested document this many seconds before it expires
+ATTESTED_EXPIRY_MARGIN = 60
+# The signed attested data holds its validity as "expiresOn":"<date>"
+ATTESTED_EXPIRES_ON = re.compile(rb'"expiresOn"\s*:\s*"([^"]+)"')
+ATTESTED_DATE_FORMAT = '%m/%d/%y %H:%M:%S %z'
+# Seconds the IMDS versions and the managed identity are kept on disk
+VERSIONS_TTL = 86400
+MANAGED_IDENTITY_TTL = 86400
+# Default connect and read timeouts in seconds per endpoint
+DEFAULT_TIMEOUTS = {
+    'imds': transport.Timeout(2, 10),
+    'arm': transport.Timeout(5, 30),
+    'marketplace': transport.Timeout(5, 30)
+}
+# Seconds one meter_billing call may take, including retries
+DEFAULT_BILLING_DEADLINE = 120
+# The batchUsageEvent API accepts at most 25 usage events per request
+MAX_BATCH_SIZE = 25
+DEFAULT_BATCH_WORKERS = 4
+DEFAULT_MARKETPLACE_BURST = 4
+
+# Ways to merge the quantities reported for a dimension within an hour
+MERGE_POLICIES = ('sum', 'max', 'last')
+DEFAULT_MERGE_POLICY = 'sum'
+
+# Report name and module attribute of the functions wrapped when
+# profiling is enabled, the hooks are profiled through the functions
+# doing their work as pluggy keeps a reference to the hooks
+PROFILED_FUNCTIONS = (
+    ('meter_billing', '_meter_billing'),
+    ('get_account_info', '_get_metadata'),
+    ('_create_usage_list', '_create_usage_list'),
+    ('_create_status_dict', '_create_status_dict')
+)
+
+# Usage event statuses that mean the resource we meter against is wrong
+RESOURCE_ERROR_STATUSES = (
+    'ResourceNotFound',
+    'ResourceNotAuthorized',
+    'ResourceNotActive'
+)
+# Usage event error codes that may be accepted when submitted again
+RETRIABLE_USAGE_ERROR_CODES = (
+    'BadGateway',
+    'GatewayTimeout',
+    'InternalServerError',
+    'RequestTimeout',
+    'ServiceUnavailable',
+    'TooManyRequests'
+)
+
+# Usage of one resource for meter_billing_bulk
+UsageRecord = namedtuple(
+    'UsageRecord',
+    ['resource_uri', 'plan_id', 'dimensions', 'timestamp']
+)
+
+# MSI tokens cached per identity: {identity: (token, expires_on)}
+_token_cache = {}
+# Resolved metering context: {source: (resource_uri, plan_id)}
+_metering_context = {}
+# Metadata documents by url: {url: (expires_at, document)}
+_metadata_cache = {}
+# Hash of the compute identity last seen in the instance metadata
+_compute_fingerprint = None
+# Retry policy for all outbound requests, configured at setup
+_retry_policy = retry.RetryPolicy()
+# Timeouts per endpoint and billing deadline, configured at setup
+_timeouts = dict(DEFAULT_TIMEOUTS)
+_billing_deadline = DEFAULT_BILLING_DEADLINE
+# Seconds metadata documents are reused, configured at setup
+_instance_metadata_ttl = DEFAULT_INSTANCE_METADATA_TTL
+_attested_data_ttl = DEFAULT_ATTESTED_DATA_TTL
+# Usage events per batch request and batches sent concurrently
+_batch_size = MAX_BATCH_SIZE
+_batch_workers = DEFAULT_BATCH_WORKERS
+# Write ahead log of usage events pending submission, if configured
+_outbox = None
+# Keys of the usage events being submitted, these are not replayed
+_in_flight = Counter()
+_in_flight_lock = threading.Lock()
+# Usage events the marketplace accepted within its acceptance window
+_accepted_index = idempotency.AcceptedIndex()
+# Cache shared with other adapter processes, if configured
+_disk_cache = None
+# Limits the marketplace requests, if configured
+_rate_limiter = None
+# Circuit breaker by endpoint, if configured
+_circuit_breakers = {}
+# Records request metrics, if enabled
+_metrics = None
+# Traces the phases of the hooks, if enabled
+_tracer = None
+# Returned instead of a span when tracing is disabled
+_NO_SPAN = contextlib.nullcontext(tracing.NOOP_SPAN)
+
+_profiler = None
+# Functions replaced by their profiled wrapper by module and attribute
+_unprofiled = {}
+# Base urls of the endpoints, configurable to point at an emulator
+_metadata_url = METADATA_URL
+_managed_identity_url = MANAGED_IDENTITY_URL
+_marketplace_url = MARKETPLACE_URL
+# Merge policy by dimension, configured at setup
+_merge_policies = {}
+# MSI token store shared with other adapter processes, if configured
+_token_store = None
+# Requests in flight, shared by the threads sending the same request
+_single_flight = single_flight.SingleFlight()
+_compute_lock = threading.Lock()
 
 
 @csp_billing_adapter.hookimpl
 def setup_adapter(config: Config):
     """Handle any plugin specific setup at adapter start"""
+    _configure(config)
+
     is_available = _is_required_metadata_version_available()
     if not is_available:
         raise cba_exceptions.CSPMetadataRetrievalError(
             "Running in Azure context with insufficient IMDS API version"
         )
 
+    if _get_setting(config, 'prefetch', False):
+        _prefetch(config)
+
+    if _outbox:
+        _outbox.compact()
+        with retry.deadline(_billing_deadline):
+            _replay_outbox(config)
+
+
+def _prefetch(config: Config):
+    """
+    Populate the caches used by get_account_info and meter_billing.
+
+    The instance metadata, the attested document and the MSI token are
+    fetched concurrently, the resource uri is resolved once they are
+    available. Failures are logged and left to the regular calls.
+    """
+    def _warm(name, func, *args):
+        try:
+            func(*args)
+        except Exception as error:
+            log.warning('Unable to prefetch %s: %s', name, error)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                _warm,
+                name,
+                func,
+                *args
+            )
+            for name, func, *args in (
+                ('instance metadata', _get_instance_metadata),
+                ('attested document', _get_signature),
+                ('MSI token', _get_msi_token, config)
+            )
+        ]
+        for future in futures:
+            future.result()
+
+    _warm('metering context', _get_metering_context, config)
+
 
 @csp_billing_adapter.hookimpl(trylast=True)
 def meter_billing(
@@ -68,95 +269,1153 @@ def meter_billing(
     customer_id: str = None
 ):
     """
-    Process a metered billing based on the dimensions provided
+    Process a metered billing based on the dimensions provided
+
+    All dimensions with a non zero quantity are submitted with the
+    batchUsageEvent API, in concurrent batches of at most 25 usage
+    events. Throttling, server and connection errors are retried
+    following the configured retry policy, a rejected token is
+    refreshed once. If a request still fails the dimensions in its
+    batch are reported as failed. If the billing deadline runs out
+    the dimensions not settled yet are reported as failed.
+    """
+    with _trace(
+        'meter_billing',
+        dimensions=len(dimensions),
+        dry_run=dry_run
+    ), retry.deadline(_billing_deadline):
+        try:
+            return _meter_billing(config, dimensions, timestamp, dry_run)
+        except retry.DeadlineExceeded as error:
+            return _create_failed_status(dimensions, error)
+
+
+def _meter_billing(
+    config: Config,
+    dimensions: dict,
+    timestamp: datetime,
+    dry_run: bool = False
+):
+    """
+    Submit the usage for the dimensions and return the status dict.
+
+    Usage the marketplace accepted before is reported as submitted
+    without sending it again. Usage lists larger than the batch size
+    are split into batches that are submitted concurrently. With an
+    outbox configured the usage is persisted while it is submitted and
+    pending usage from earlier calls that did not complete is replayed
+    afterwards, except for dry runs.
+    """
+    usage = _create_usage_list(dimensions, timestamp, config)
+    status = _meter_usage(config, usage, dry_run)
+    if status:
+        return status
+
+    log.info(
+        'Nothing to meter bill: No dimensions have non zero quantity values'
+    )
+    return status
+
+
+def meter_billing_bulk(
+    config: Config,
+    records: list,
+    dry_run: bool = False
+):
+    """
+    Process the metered billing of many resources at once
+
+    Each record is a UsageRecord, or a sequence of the same values,
+    with the resource uri, the plan id, the dimensions and the
+    timestamp of the usage. The usage events of all records are packed
+    in batchUsageEvent requests of up to 25 events that are submitted
+    concurrently, as in meter_billing. Usage for the same resource,
+    plan, dimension and hour is merged following the merge policy of
+    the dimension, the usage of several hours is submitted separately.
+
+    Return the status of each hour, the effectiveStartTime of its usage
+    event, by dimension and resource uri.
+    """
+    usage = _create_bulk_usage_list(records, config)
+
+    with _trace(
+        'meter_billing_bulk',
+        events=len(usage),
+        dry_run=dry_run
+    ), retry.deadline(_billing_deadline):
+        try:
+            status = _meter_usage(
+                config,
+                usage,
+                dry_run,
+                idempotency.get_event_key
+            )
+        except retry.DeadlineExceeded as error:
+            status = _create_failed_status(
+                {idempotency.get_event_key(event): None for event in usage},
+                error
+            )
+
+    if not status:
+        log.info(
+            'Nothing to meter bill: '
+            'No dimensions have non zero quantity values'
+        )
+    return _group_status_by_resource(status)
+
+
+def _create_bulk_usage_list(records: list, config: Config):
+    """Create the usage list for the records of meter_billing_bulk."""
+    usage = []
+    for record in records:
+        resource_uri, plan_id, dimensions, timestamp = record
+        usage += _create_usage_list(
+            dimensions,
+            timestamp,
+            config,
+            (resource_uri, plan_id)
+        )
+
+    return _coalesce_usage(usage)
+
+
+def _coalesce_usage(usage: list):
+    """
+    Merge the usage events for the same resource, plan, dimension and
+    hour following the merge policy of the dimension.
+    """
+    merged = {}
+    for event in usage:
+        key = idempotency.get_event_key(event)
+        if key in merged:
+            merged[key] = dict(
+                merged[key],
+                quantity=_merge_quantity(
+                    event['dimension'],
+                    merged[key]['quantity'],
+                    event['quantity']
+                )
+            )
+        else:
+            merged[key] = event
+    return list(merged.values())
+
+
+def _merge_quantity(dimension: str, previous, current):
+    """Merge a quantity with the one reported before in the same hour."""
+    policy = _merge_policies.get(dimension, DEFAULT_MERGE_POLICY)
+    if policy == 'max':
+        return max(previous, current)
+    if policy == 'last':
+        return current
+    return previous + current
+
+
+def _group_status_by_resource(status: dict):
+    """
+    Turn a status dict by usage event key into nested dicts by resource
+    uri, dimension and hour.
+    """
+    grouped = {}
+    for (resource_uri, _, dimension, hour), dim_status in status.items():
+        grouped.setdefault(resource_uri, {}).setdefault(
+            dimension,
+            {}
+        )[hour] = dim_status
+    return grouped
+
+
+def _meter_usage(
+    config: Config,
+    usage: list,
+    dry_run: bool = False,
+    key=None
+):
+    """
+    Submit the usage events and return their status by key.
+
+    The key function returns the status key of a usage event or of a
+    result, the dimension by default.
+
+    With an outbox the usage is only kept pending while it is being
+    submitted. Once its status is returned, failed usage is up to the
+    caller to submit again, so only usage of calls that did not
+    complete, such as after a crash, is replayed. Pending usage for the
+    same hour is replaced by the new usage.
+    """
+    key = key or _get_dimension
+    use_outbox = _outbox and not dry_run
+
+    if use_outbox:
+        _start_submission(usage)
+
+    try:
+        status, usage_to_submit = _get_accepted_status(usage, key)
+        if len(usage_to_submit) > 0:
+            status.update(_submit_batches(
+                config,
+                usage_to_submit,
+                _get_msi_token(config),
+                key
+            ))
+    finally:
+        if use_outbox:
+            _end_submission(usage)
+
+    if use_outbox:
+        _replay_outbox(config)
+
+    return status
+
+
+def _set_in_flight(usage: list, in_flight: bool):
+    """
+    Mark the usage events as being submitted, or no longer, so the
+    outbox replay of other calls leaves them alone.
+    """
+    keys = [idempotency.get_event_key(event) for event in usage]
+    with _in_flight_lock:
+        if in_flight:
+            _in_flight.update(keys)
+        else:
+            _in_flight.subtract(keys)
+            for key in keys:
+                if _in_flight[key] <= 0:
+                    del _in_flight[key]
+
+
+def _start_submission(usage: list):
+    """Persist the usage in the outbox while it is being submitted."""
+    _set_in_flight(usage, True)
+    try:
+        _outbox.add(usage)
+    except BaseException:
+        _set_in_flight(usage, False)
+        raise
+
+
+def _end_submission(usage: list):
+    """Acknowledge the usage in the outbox once its status is known."""
+    try:
+        _outbox.ack(usage)
+    finally:
+        _set_in_flight(usage, False)
+
+
+def _select_replay(usage: list):
+    """
+    Split pending usage events into the ones to replay and the stale
+    ones.
+
+    Events another call is submitting are left out. Events of an
+    earlier hour are stale, the adapter reports usage it got no status
+    for again on its next billing cycle, possibly in a later hour, so
+    replaying them too could bill the usage twice.
+    """
+    hour = idempotency.get_hour_bucket(datetime.now(timezone.utc))
+    replay = []
+    stale = []
+    with _in_flight_lock:
+        for event in usage:
+            event_key = idempotency.get_event_key(event)
+            if event_key in _in_flight:
+                continue
+            if event_key[3] == hour:
+                replay.append(event)
+            else:
+                stale.append(event)
+    return replay, stale
+
+
+def _prepare_replay(usage: list):
+    """
+    Return the pending usage events to replay and drop the stale ones
+    from the outbox, see _select_replay.
+    """
+    usage, stale = _select_replay(usage)
+    if stale:
+        log.warning(
+            'Dropping %d pending usage events of past hours',
+            len(stale)
+        )
+        _outbox.ack(stale)
+    return usage
+
+
+def _settle_replay(usage: list, status: dict):
+    """
+    Acknowledge the replayed usage events reported as submitted, the
+    status dict is keyed by usage event key.
+    """
+    _outbox.ack([
+        event for event in usage
+        if status.get(
+            idempotency.get_event_key(event),
+            {}
+        ).get('status') == 'submitted'
+    ])
+
+
+def _get_dimension(item: dict):
+    """Return the dimension of a usage event or result."""
+    return item.get('dimension')
+
+
+def _get_accepted_status(usage: list, key=_get_dimension):
+    """
+    Split the usage into events accepted before and events to submit.
+
+    Return a status dict for the accepted events and the list of the
+    others.
+    """
+    status = {}
+    usage_to_submit = []
+    for event in usage:
+        usage_event_id = _accepted_index.get(event)
+        if usage_event_id:
+            log.info(
+                'Metered billing record already added with ID %s:',
+                usage_event_id
+            )
+            status[key(event)] = {
+                "record_id": usage_event_id,
+                "status": "submitted"
+            }
+        else:
+            usage_to_submit.append(event)
+
+    return status, usage_to_submit
+
+
+def _submit_batches(
+    config: Config,
+    usage: list,
+    token: str,
+    key=_get_dimension
+):
+    """Submit the usage in concurrent batches and merge their status."""
+    batches = [
+        usage[index:index + _batch_size]
+        for index in range(0, len(usage), _batch_size)
+    ]
+
+    if len(batches) == 1:
+        return _submit_usage(config, batches[0], token, key)
+
+    status = {}
+    with ThreadPoolExecutor(
+        max_workers=min(_batch_workers, len(batches))
+    ) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                _submit_usage,
+                config,
+                batch,
+                token,
+                key
+            )
+            for batch in batches
+        ]
+        for future in futures:
+            status.update(future.result())
+
+    return status
+
+
+def _replay_outbox(config: Config):
+    """
+    Submit the usage events still pending in the outbox.
+
+    These were left by calls that did not complete, their status was
+    never returned. Events are read back and submitted a few batches
+    at a time. Only events of the current hour that no other call is
+    submitting are replayed, events of earlier hours are dropped, see
+    _select_replay. Events that fail again stay pending for the next
+    replay within their hour.
+    """
+    if not _outbox:
+        return
+
+    replayed = 0
+    token = None
+    with _trace('replay_outbox') as span:
+        try:
+            with contextlib.closing(_outbox.iter_pending(
+                _batch_size * _batch_workers
+            )) as pending:
+                for usage in pending:
+                    # Stop once the deadline ran out
+                    retry.get_remaining()
+                    usage = _prepare_replay(usage)
+                    if not usage:
+                        continue
+
+                    token = token or _get_msi_token(config)
+                    # Pending events may be for several resources
+                    _settle_replay(usage, _submit_batches(
+                        config,
+                        usage,
+                        token,
+                        idempotency.get_event_key
+                    ))
+                    replayed += len(usage)
+        except cba_exceptions.CSPBillingAdapterException as error:
+            log.warning('Unable to replay pending usage events: %s', error)
+        span.set_attribute('events', replayed)
+
+    if replayed:
+        log.info('Replayed %d pending usage events', replayed)
+
+
+def _submit_usage(
+    config: Config,
+    usage: list,
+    token: str,
+    key=_get_dimension
+):
+    """
+    Submit one batch of usage events and return its status dict.
+
+    Usage events rejected with a retriable error code are submitted
+    again in a smaller batch, following the retry policy, while the
+    results for the other events are kept. If the deadline runs out
+    only the events not settled yet are reported as failed. All
+    requests for the batch share one correlation id.
+    """
+    status = {}
+    attempt = 1
+    correlation_id = str(uuid.uuid4())
+
+    with _trace(
+        'submit_batch',
+        correlation_id=correlation_id,
+        events=len(usage)
+    ) as span:
+        while True:
+            span.set_attribute('attempts', attempt)
+            try:
+                response = _post_usage(config, usage, token, correlation_id)
+            except (urllib.error.URLError, retry.DeadlineExceeded) as error:
+                status.update(_create_failed_usage_status(usage, error, key))
+                return status
+
+            settled_status, usage, delay = _settle_attempt(
+                usage,
+                response,
+                attempt,
+                key
+            )
+            status.update(settled_status)
+            if not usage:
+                return status
+
+            time.sleep(delay)
+            attempt += 1
+
+
+def _settle_attempt(
+    usage: list,
+    response: dict,
+    attempt: int,
+    key=_get_dimension
+):
+    """
+    Settle the response to an attempt at submitting a batch and decide
+    on the next one.
+
+    Return the status dict of the usage events that are done, the
+    usage events to submit again and the seconds to wait before that.
+    Rejected usage events that may be accepted later are submitted
+    again following the retry policy. If the retry would start after
+    the deadline they are reported as failed.
+    """
+    retry_usage, settled_status = _settle_usage(usage, response, key)
+    if retry_usage:
+        try:
+            delay = _retry_policy.get_wait(
+                attempt,
+                f'{len(retry_usage)} usage events rejected'
+            )
+        except retry.DeadlineExceeded as error:
+            # Keep the results of the settled usage events
+            settled_status.update(
+                _create_failed_usage_status(retry_usage, error, key)
+            )
+            return settled_status, [], None
+
+        if delay is not None:
+            return settled_status, retry_usage, delay
+
+    status = {}
+    if response and (response.get("count", 0) > 0):
+        status = _create_status_dict(response, key)
+    return status, [], None
+
+
+def _settle_usage(usage: list, response: dict, key=_get_dimension):
+    """
+    Record the results of a batchUsageEvent response.
+
+    Accepted usage events are added to the index. Return the usage
+    events that may be accepted when submitted again and the status
+    dict of the others.
+    """
+    results = response.get("result", []) if response else []
+    if _metrics:
+        for resp in results:
+            _metrics.usage_events.inc(resp.get("status", "unknown"))
+
+    if any(resp.get("status") in RESOURCE_ERROR_STATUSES
+           for resp in results):
+        # The resource may have been replaced, resolve it again
+        # on the next billing cycle.
+        _invalidate_metering_context()
+
+    retry_keys = {
+        key(resp) for resp in results
+        if _is_retriable_usage_result(resp)
+    }
+    _record_accepted_usage(usage, results, key)
+
+    retry_usage = [event for event in usage if key(event) in retry_keys]
+    settled_status = _create_status_dict({
+        "result": [
+            resp for resp in results if key(resp) not in retry_keys
+        ]
+    }, key)
+    return retry_usage, settled_status
+
+
+def _record_accepted_usage(usage: list, results: list, key=_get_dimension):
+    """Add the usage events the marketplace accepted to the index."""
+    events = {key(event): event for event in usage}
+    for resp in results:
+        event = events.get(key(resp))
+        if not event:
+            continue
+
+        if resp.get("status") == "Accepted":
+            usage_event_id = resp.get("usageEventId")
+        elif resp.get("status") == "Duplicate":
+            usage_event_id = (resp.get("error") or {}).get(
+                "additionalInfo", {}
+            ).get("acceptedMessage", {}).get("usageEventId")
+        else:
+            continue
+
+        if usage_event_id:
+            _accepted_index.add(event, usage_event_id)
+
+
+def _post_usage(
+    config: Config,
+    usage: list,
+    token: str,
+    correlation_id: str = None
+):
+    """Post usage events to the batchUsageEvent API and return the result."""
+    data_request = _create_usage_request(usage, token, correlation_id)
+    log.debug(
+        'Submitting %d usage events with correlation id %s',
+        len(usage),
+        data_request.get_header('X-ms-correlationid')
+    )
+
+    def _refresh_token():
+        # The cached token was rejected, fetch a new one
+        # before trying again.
+        _invalidate_msi_token(config)
+        data_request.add_header('authorization', _get_msi_token(config))
+
+    def _submit():
+        if _rate_limiter:
+            _rate_limiter.acquire()
+        try:
+            with _urlopen(data_request, 'marketplace') as url_open_return:
+                response = json.loads(url_open_return.read().decode("utf-8"))
+        except urllib.error.HTTPError as error:
+            _update_rate_limit(error=error)
+            raise
+        _update_rate_limit(response)
+        return response
+
+    return _retry_policy.call(_submit, on_unauthorized=_refresh_token)
+
+
+def _update_rate_limit(response: dict = None, error=None):
+    """
+    Adapt the marketplace rate limit to the outcome of a request.
+
+    The rate is lowered when the request or any of its usage events
+    was throttled and raised again otherwise.
+    """
+    if not _rate_limiter:
+        return
+
+    if error is not None:
+        if getattr(error, 'code', None) == 429:
+            _rate_limiter.on_throttled(retry.get_retry_after(error))
+        return
+
+    if any(
+        (resp.get("error") or {}).get("code") == 'TooManyRequests'
+        for resp in (response or {}).get("result", [])
+    ):
+        _rate_limiter.on_throttled()
+    else:
+        _rate_limiter.on_success()
+
+
+def get_rate_limit_state():
+    """
+    Return the state of the marketplace rate limiter or None if rate
+    limiting is not configured.
+    """
+    if _rate_limiter:
+        return _rate_limiter.get_state()
+    return None
+
+
+def _create_usage_request(
+    usage: list,
+    token: str,
+    correlation_id: str = None
+):
+    return urllib.request.Request(
+        f'{_marketplace_url}batchUsageEvent'
+        f'?api-version={MARKETPLACE_API_VERSION}',
+        data=json.dumps({"request": usage}).encode("utf-8"),
+        headers={
+            'Content-type': 'application/json',
+            'x-ms-correlationid': correlation_id or str(uuid.uuid4()),
+            'authorization': token
+        },
+        method='POST'
+    )
+
+
+def _is_retriable_usage_result(resp: dict):
+    """Return True if a rejected usage event may be accepted later."""
+    if resp.get("status") in ("Accepted", "Duplicate"):
+        return False
+
+    error = resp.get("error") or {}
+    return error.get("code") in RETRIABLE_USAGE_ERROR_CODES
+
+
+def _create_failed_usage_status(
+    usage: list,
+    error: Exception,
+    key=_get_dimension
+):
+    """Return a status dict reporting every usage event as failed."""
+    return _create_failed_status(
+        {key(event): event['quantity'] for event in usage},
+        error
+    )
+
+
+def _create_failed_status(dimensions: dict, error: Exception):
+    """Return a status dict reporting every dimension as failed."""
+    msg = (
+        f"Failed to meter bill dimensions "
+        f"{dimensions}: {str(error)}"
+    )
+    log.error(msg)
+    return {
+        dimension_name: {
+            "status": "failed",
+            "error": msg
+        }
+        for dimension_name in dimensions
+    }
+
+
+@csp_billing_adapter.hookimpl(trylast=True)
+def get_csp_name(config: Config):
+    """Return CSP provider name"""
+    return 'microsoft'
+
+
+@csp_billing_adapter.hookimpl(trylast=True)
+def get_account_info(config: Config):
+    """
+    Return a dictionary with account information
+
+    The information contains the metadata for compute and network.
+    """
+    with _trace('get_account_info'):
+        account_info = _get_metadata()
+    account_info['cloud_provider'] = get_csp_name(config)
+
+    return account_info
+
+
+def _configure(config: Config):
+    """Apply the settings from the microsoft section of the config."""
+    pool_size = _get_setting(
+        config,
+        'connection_pool_size',
+        transport.DEFAULT_POOL_SIZE
+    )
+    idle_timeout = _get_setting(
+        config,
+        'connection_idle_timeout',
+        transport.DEFAULT_IDLE_TIMEOUT
+    )
+    transport.set_transport(
+        transport.PooledTransport(
+            pool_size=pool_size,
+            idle_timeout=idle_timeout
+        )
+    )
+    transport.set_async_transport(
+        transport.AsyncTransport(
+            pool_size=pool_size,
+            idle_timeout=idle_timeout
+        )
+    )
+
+    global _retry_policy, _timeouts, _billing_deadline
+    global _batch_size, _batch_workers, _outbox
+    global _instance_metadata_ttl, _attested_data_ttl, _disk_cache
+    global _token_store, _merge_policies, _rate_limiter
+    global _circuit_breakers, _metadata_url, _managed_identity_url
+    global _marketplace_url, _metrics
+    _metadata_url = _get_setting(config, 'metadata_url', METADATA_URL)
+    _managed_identity_url = _get_setting(
+        config,
+        'managed_identity_url',
+        MANAGED_IDENTITY_URL
+    )
+    _marketplace_url = _get_setting(config, 'marketplace_url', MARKETPLACE_URL)
+    _merge_policies = _get_merge_policies(config)
+    rate = _get_setting(config, 'marketplace_rate_limit')
+    _rate_limiter = rate_limit.RateLimiter(
+        rate,
+        _get_setting(
+            config,
+            'marketplace_burst',
+            DEFAULT_MARKETPLACE_BURST
+        )
+    ) if rate else None
+    cache_dir = _get_setting(config, 'cache_dir')
+    _disk_cache = disk_cache.DiskCache(cache_dir) if cache_dir else None
+    token_store_path = _get_setting(config, 'token_store_path')
+    _token_store = token_store.TokenStore(
+        token_store_path
+    ) if token_store_path else None
+    _instance_metadata_ttl = _get_setting(
+        config,
+        'instance_metadata_ttl',
+        DEFAULT_INSTANCE_METADATA_TTL
+    )
+    _attested_data_ttl = _get_setting(
+        config,
+        'attested_data_ttl',
+        DEFAULT_ATTESTED_DATA_TTL
+    )
+    _timeouts = _get_timeouts(config)
+    _circuit_breakers = _get_circuit_breakers(config)
+    set_trace_exporter(_get_trace_exporter(config))
+    set_profiler(_get_profiler(config))
+    _metrics = _create_metrics() if _get_setting(
+        config,
+        'metrics',
+        False
+    ) else None
+    _billing_deadline = _get_setting(
+        config,
+        'billing_deadline',
+        DEFAULT_BILLING_DEADLINE
+    )
+    _batch_size = min(
+        _get_setting(config, 'batch_size', MAX_BATCH_SIZE),
+        MAX_BATCH_SIZE
+    )
+    _batch_workers = _get_setting(
+        config,
+        'batch_workers',
+        DEFAULT_BATCH_WORKERS
+    )
+    outbox_path = _get_setting(config, 'outbox_path')
+    _outbox = outbox.Outbox(
+        outbox_path,
+        compact_threshold=_get_setting(
+            config,
+            'outbox_compact_threshold',
+            outbox.DEFAULT_COMPACT_THRESHOLD
+        )
+    ) if outbox_path else None
+    _retry_policy = retry.RetryPolicy(
+        attempts=_get_setting(
+            config,
+            'retry_attempts',
+            retry.DEFAULT_RETRY_ATTEMPTS
+        ),
+        backoff=_get_setting(
+            config,
+            'retry_backoff',
+            retry.DEFAULT_RETRY_BACKOFF
+        ),
+        backoff_factor=_get_setting(
+            config,
+            'retry_backoff_factor',
+            retry.DEFAULT_RETRY_BACKOFF_FACTOR
+        ),
+        max_backoff=_get_setting(
+            config,
+            'retry_max_backoff',
+            retry.DEFAULT_RETRY_MAX_BACKOFF
+        )
+    )
+
+
+def _get_merge_policies(config: Config):
+    """Return the merge policy by dimension from the config."""
+    policies = dict(_get_setting(config, 'merge_policies') or {})
+    for dimension, policy in policies.items():
+        if policy not in MERGE_POLICIES:
+            raise cba_exceptions.CSPBillingAdapterException(
+                f'Invalid merge policy {policy} for dimension {dimension}, '
+                f'expected one of: {", ".join(MERGE_POLICIES)}'
+            )
+    return policies
+
+
+def _get_circuit_breakers(config: Config):
+    """
+    Return a circuit breaker by endpoint when the circuit_breaker
+    setting is present, or an empty dict.
+    """
+    settings = _get_setting(config, 'circuit_breaker')
+    if settings is None:
+        return {}
+
+    return {
+        endpoint: circuit_breaker.CircuitBreaker(
+            endpoint,
+            failure_rate=settings.get(
+                'failure_rate',
+                circuit_breaker.DEFAULT_FAILURE_RATE
+            ),
+            minimum_calls=settings.get(
+                'minimum_calls',
+                circuit_breaker.DEFAULT_MINIMUM_CALLS
+            ),
+            window=settings.get('window', circuit_breaker.DEFAULT_WINDOW),
+            reset_timeout=settings.get(
+                'reset_timeout',
+                circuit_breaker.DEFAULT_RESET_TIMEOUT
+            )
+        )
+        for endpoint in _timeouts
+    }
+
+
+def _get_setting(config: Config, name: str, default=None):
+    """Return a setting from the optional microsoft section of the config."""
+    settings = (config or {}).get('microsoft') or {}
+    return settings.get(name, default)
+
+
+def _get_timeouts(config: Config):
+    """
+    Return the connect and read timeouts per endpoint from the config.
+
+    Endpoints missing from the timeouts setting keep their defaults.
+    """
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    for endpoint, value in (_get_setting(config, 'timeouts') or {}).items():
+        default = timeouts.get(endpoint, transport.Timeout(None, None))
+        timeouts[endpoint] = transport.Timeout(
+            value.get('connect', default.connect),
+            value.get('read', default.read)
+        )
+    return timeouts
+
+
+def _urlopen(request: urllib.request.Request, endpoint: str):
+    """
+    Send the request through the configured transport.
+
+    The endpoint timeouts are shortened to what is left of the
+    current deadline. The request is refused with CircuitOpenError
+    while the circuit of the endpoint is open.
+    """
+    timeout = _timeouts[endpoint]
+    remaining = retry.get_remaining()
+    if remaining is not None:
+        timeout = transport.Timeout(
+            min(timeout.connect, remaining),
+            min(timeout.read, remaining)
+        )
+
+    def _open():
+        with _guard_circuit(endpoint):
+            return transport.get_transport().open(request, timeout)
+
+    with _trace_request(endpoint, request):
+        if _metrics:
+            return _metrics.call(
+                endpoint,
+                _get_operation(endpoint, request.full_url),
+                request,
+                _open
+            )
+        return _open()
+
+
+def _trace_request(endpoint: str, request: urllib.request.Request):
+    """Return the span of a request, with its correlation id if any."""
+    if not _tracer:
+        return _NO_SPAN
+
+    attributes = {
+        'endpoint': endpoint,
+        'operation': _get_operation(endpoint, request.full_url),
+        'method': request.get_method()
+    }
+    correlation_id = request.get_header('X-ms-correlationid')
+    if correlation_id:
+        attributes['correlation_id'] = correlation_id
+    return _tracer.span('http_request', **attributes)
+
+
+def _get_operation(endpoint: str, url: str):
+    """Return the operation of a request for its metrics labels."""
+    if endpoint != 'imds':
+        return ENDPOINT_OPERATIONS.get(endpoint, endpoint)
+
+    path = urllib.parse.urlsplit(url).path
+    for marker, operation in METADATA_OPERATIONS:
+        if marker in path:
+            return operation
+    return 'other'
+
+
+@contextlib.contextmanager
+def _guard_circuit(endpoint: str):
+    """Record the outcome of a request in the endpoint circuit breaker."""
+    breaker = _circuit_breakers.get(endpoint)
+    if not breaker:
+        yield
+        return
+
+    breaker.before_call()
+    try:
+        yield
+    except urllib.error.URLError as error:
+        if circuit_breaker.is_failure(error):
+            breaker.on_failure()
+        else:
+            breaker.on_success()
+        raise
+    except BaseException:
+        breaker.on_abort()
+        raise
+    breaker.on_success()
+
+
+def _create_metrics():
+    """Return the plugin metrics, with gauges for the current state."""
+    plugin_metrics = metrics.Metrics()
+
+    def _collect():
+        for endpoint, state in get_circuit_state().items():
+            plugin_metrics.circuit_open.set(
+                endpoint,
+                value=int(state['state'] != circuit_breaker.CLOSED)
+            )
+        rate_limit_state = get_rate_limit_state()
+        if rate_limit_state:
+            plugin_metrics.rate_limit.set(value=rate_limit_state['rate'])
+
+    plugin_metrics.registry.add_collector(_collect)
+    return plugin_metrics
+
+
+def _trace(name: str, **attributes):
+    """Return a span for the block, a no-op one if tracing is disabled."""
+    if _tracer:
+        return _tracer.span(name, **attributes)
+    return _NO_SPAN
+
+
+def _get_trace_exporter(config: Config):
+    """Return the span exporter set up in the tracing setting or None."""
+    settings = _get_setting(config, 'tracing')
+    if not settings:
+        return None
+
+    exporter = settings.get('exporter', 'json_lines')
+    if exporter == 'json_lines':
+        path = settings.get('path')
+        if not path:
+            raise cba_exceptions.CSPBillingAdapterException(
+                'The json_lines trace exporter requires a path'
+            )
+        return tracing.JsonLinesExporter(path)
+    if exporter == 'memory':
+        return tracing.InMemoryExporter()
+    if exporter == 'noop':
+        return tracing.NoopExporter()
+
+    raise cba_exceptions.CSPBillingAdapterException(
+        f'Invalid trace exporter {exporter}, '
+        'expected one of: json_lines, memory, noop'
+    )
+
+
+def set_trace_exporter(exporter):
+    """
+    Trace the hooks and hand the finished spans to exporter.
+
+    Any object with export and close methods can be used, tracing is
+    disabled with None.
+    """
+    global _tracer
+    if _tracer:
+        _tracer.exporter.close()
+    _tracer = tracing.Tracer(exporter) if exporter else None
+
+
+def _get_profiler(config: Config):
+    """Return the profiler set up in the profiling setting or None."""
+    settings = _get_setting(config, 'profiling')
+    if not settings:
+        return None
+
+    directory = settings.get('directory')
+    if not directory:
+        raise cba_exceptions.CSPBillingAdapterException(
+            'Profiling requires a directory for the reports'
+        )
+    return profiling.Profiler(
+        directory,
+        interval=settings.get('interval', profiling.DEFAULT_INTERVAL),
+        sample_interval=settings.get(
+            'sample_interval',
+            profiling.DEFAULT_SAMPLE_INTERVAL
+        ),
+        memory_frames=settings.get(
+            'memory_frames',
+            profiling.DEFAULT_MEMORY_FRAMES
+        )
+    )
+
+
+def set_profiler(profiler):
+    """
+    Profile the hot paths of the plugin with profiler.
 
-    If a single dimension is provided the meter_usage API is
-    used for the metering. If there is an error the metering
-    is attempted 3 times before re-raising the exception to
-    calling scope.
+    The functions are only wrapped while a profiler is set, profiling is
+    disabled with None which restores them.
     """
+    global _profiler
+    # Imported here as the aio module imports this one
+    from csp_billing_adapter_microsoft import aio
 
-    status = {}
-    usage = _create_usage_list(dimensions, timestamp, config)
+    for (module, attribute), func in _unprofiled.items():
+        setattr(module, attribute, func)
+    _unprofiled.clear()
+    if _profiler:
+        _profiler.close()
 
-    if len(usage) > 0:
-        data_request = urllib.request.Request(
-            'https://marketplaceapi.microsoft.com/api/batchUsageEvent'
-            '?api-version=2018-08-31',
-            data=json.dumps({"request": usage}).encode("utf-8"),
-            headers={
-                'Content-type': 'application/json',
-                'x-ms-correlationid': str(uuid.uuid4()),
-                'authorization': _get_msi_token(config)
-            },
-            method='POST'
-        )
+    _profiler = profiler
+    if not profiler:
+        return
 
-        retries = 3
-        exc = None
-        response = None
+    for module in (sys.modules[__name__], aio):
+        for name, attribute in PROFILED_FUNCTIONS:
+            func = getattr(module, attribute, None)
+            if func:
+                _unprofiled[(module, attribute)] = func
+                setattr(module, attribute, profiler.wrap(name, func))
 
-        while retries > 0:
-            try:
-                with urllib.request.urlopen(data_request) as url_open_return:
-                    response = json.loads(
-                        url_open_return.read().decode("utf-8")
-                    )
-                    break
-            except urllib.error.URLError as error:
-                exc = error
-                retries -= 1
-                continue
 
-        if exc:
-            msg = (
-                f"Failed to meter bill dimensions "
-                f"{dimensions}: {str(exc)}"
-            )
-            for dimension_name in dimensions:
-                status[dimension_name] = {
-                    "status": "failed",
-                    "error": msg
-                }
-            log.error(msg)
-            return status
+def _record_cache(cache: str, hit: bool):
+    """Count a cache lookup when metrics are enabled."""
+    if _metrics:
+        _metrics.record_cache(cache, hit)
 
-        if response and (response.get("count", 0) > 0):
-            return _create_status_dict(response)
 
-    log.info(
-        'Nothing to meter bill: No dimensions have non zero quantity values'
-    )
-    return status
+def get_metrics():
+    """
+    Return the recorded metrics by name, with the cache hit ratios, or
+    None if metrics are not enabled.
+    """
+    if not _metrics:
+        return None
 
+    snapshot = _metrics.registry.snapshot()
+    snapshot['cache_hit_ratios'] = _metrics.get_cache_hit_ratios()
+    return snapshot
 
-@csp_billing_adapter.hookimpl(trylast=True)
-def get_csp_name(config: Config):
-    """Return CSP provider name"""
-    return 'microsoft'
 
+def render_metrics():
+    """
+    Return the recorded metrics in the Prometheus text format, empty if
+    metrics are not enabled.
+    """
+    if not _metrics:
+        return ''
+    return _metrics.registry.render()
 
-@csp_billing_adapter.hookimpl(trylast=True)
-def get_account_info(config: Config):
+
+def get_circuit_state():
     """
-    Return a dictionary with account information
+    Return the state of the circuit breaker by endpoint, empty if
+    circuit breakers are not configured.
+    """
+    return {
+        endpoint: breaker.get_state()
+        for endpoint, breaker in _circuit_breakers.items()
+    }
 
-    The information contains the metadata for compute and network.
+
+def _get_metadata():
     """
-    account_info = _get_metadata()
-    account_info['cloud_provider'] = get_csp_name(config)
+    Return a dict containing compute, network and signature information.
 
-    return account_info
+    The instance metadata and the attested document are fetched
+    concurrently. If either can not be loaded the missing keys are
+    set to empty dicts.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        instance = executor.submit(
+            contextvars.copy_context().run,
+            _get_instance_metadata
+        )
+        signature = executor.submit(
+            contextvars.copy_context().run,
+            _get_signature
+        )
 
+    return _build_metadata(instance, signature)
 
-def _get_metadata():
-    """Return a dict containing compute, network and signature information."""
+
+def _build_metadata(instance, signature):
+    """
+    Return the metadata dict from the instance metadata and attested
+    document futures.
+    """
     metadata = {}
+    failed = False
+    try:
+        metadata = instance.result()
+    except ValueError as error:
+        log.error('Could not load JSON from metadata %s:', error)
+        failed = True
+
     try:
-        metadata = _get_instance_metadata()
-        metadata['attestedData'] = _get_signature()
+        metadata['attestedData'] = signature.result()
     except ValueError as error:
         log.error('Could not load JSON from metadata %s:', error)
+        failed = True
+
+    if failed:
         for key in ['compute', 'network', 'attestedData']:
             if key not in metadata:
                 metadata[key] = {}
@@ -165,96 +1424,472 @@ def _get_metadata():
 
 
 def _get_instance_metadata():
-    """Return all compute and network information from metadata."""
-    instance_info_url = \
-        f'{METADATA_URL}instance?api-version={REQUIRED_METADATA_VERSION}'
-    return json.loads(
-        _fetch_metadata(instance_info_url)
+    """
+    Return all compute and network information from metadata.
+
+    The resolved metering context is dropped when the compute identity
+    changed, such as after the VM was redeployed.
+    """
+    metadata = _get_cached_metadata(
+        _get_instance_metadata_url(),
+        _instance_metadata_ttl
+    )
+    _check_compute(metadata)
+    return metadata
+
+
+def _get_instance_metadata_url():
+    return f'{_metadata_url}instance?api-version={REQUIRED_METADATA_VERSION}'
+
+
+def _get_signature_url():
+    return (
+        f'{_metadata_url}attested/document'
+        f'?api-version={REQUIRED_METADATA_VERSION}'
     )
 
 
+def _check_compute(metadata: dict):
+    """
+    Record the compute identity of the instance metadata and drop the
+    metering context if it changed.
+
+    The first identity seen by the process is not a change, so the
+    managed identity a previous process cached on disk is kept.
+    """
+    global _compute_fingerprint
+
+    if not metadata:
+        return
+
+    fingerprint = get_compute_fingerprint(metadata)
+    with _compute_lock:
+        previous, _compute_fingerprint = _compute_fingerprint, fingerprint
+    if previous is not None and previous != fingerprint:
+        _invalidate_metering_context()
+
+
 def _get_signature():
-    """Return attested data signature from metadata."""
-    return json.loads(
-        _fetch_metadata(SIGNATURE_URL)
+    """
+    Return attested data signature from metadata.
+
+    The document is reused until its TTL passes or it is about to
+    expire, whichever comes first.
+    """
+    return _get_cached_metadata(
+        _get_signature_url(),
+        _attested_data_ttl,
+        _get_attested_data_lifetime
+    )
+
+
+def _get_cached_metadata(url: str, ttl: float, get_lifetime=None):
+    """
+    Return the metadata document at url.
+
+    Documents are reused for ttl seconds, or for the lifetime returned
+    by get_lifetime if that is shorter, and shared through the disk
+    cache when configured. A copy is returned so callers can change it.
+    Empty documents, returned when the request failed, are not cached.
+    """
+    document = _get_cached_document(url)
+    if document is not None:
+        return document
+
+    document = json.loads(_fetch_metadata(url))
+    _cache_document(url, document, ttl, get_lifetime)
+    return document
+
+
+def _get_cached_document(url: str):
+    """Return a copy of the cached document at url or None."""
+    document = _lookup_document(url)
+    _record_cache(_get_operation('imds', url), document is not None)
+    return document
+
+
+def _lookup_document(url: str):
+    cached = _metadata_cache.get(url)
+    if cached and time.monotonic() < cached[0]:
+        return copy.deepcopy(cached[1])
+
+    entry = _disk_cache and _disk_cache.get(url)
+    if entry:
+        document, expires_at = entry
+        _metadata_cache[url] = (
+            time.monotonic() + expires_at - time.time(),
+            copy.deepcopy(document)
+        )
+        return document
+
+    return None
+
+
+def _cache_document(url: str, document: dict, ttl: float, get_lifetime):
+    """Cache a fetched document, see _get_cached_metadata."""
+    if not document:
+        return
+
+    lifetime = ttl
+    if get_lifetime:
+        document_lifetime = get_lifetime(document)
+        if document_lifetime is not None:
+            lifetime = min(lifetime, document_lifetime)
+
+    _metadata_cache[url] = (
+        time.monotonic() + lifetime,
+        copy.deepcopy(document)
+    )
+    if _disk_cache:
+        _disk_cache.set(url, document, lifetime)
+
+
+def _get_attested_data_lifetime(document: dict):
+    """
+    Return the seconds the attested document can still be used or None.
+
+    The signature is a base64 encoded PKCS7 structure that embeds the
+    signed JSON data, including its expiresOn time, as plain text.
+    """
+    try:
+        signed_data = base64.b64decode(document['signature'])
+        match = ATTESTED_EXPIRES_ON.search(signed_data)
+        expires_on = datetime.strptime(
+            match.group(1).decode('utf-8'),
+            ATTESTED_DATE_FORMAT
+        )
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+
+    remaining = expires_on - datetime.now(timezone.utc)
+    return max(remaining.total_seconds() - ATTESTED_EXPIRY_MARGIN, 0)
+
+
+def get_compute_fingerprint(metadata: dict):
+    """
+    Return a hash of the vmId, resourceId and plan identifying the
+    compute instance of the metadata.
+    """
+    compute = metadata.get('compute') or {}
+    if not isinstance(compute, dict):
+        compute = {}
+
+    identity = json.dumps(
+        [compute.get('vmId'), compute.get('resourceId'), compute.get('plan')],
+        sort_keys=True
     )
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+def has_compute_changed(metadata: dict, fingerprint: str = None):
+    """
+    Return True if the compute identity in the metadata differs from
+    the fingerprint.
+
+    By default the metadata is compared with the last one the plugin
+    fetched, it counts as changed while none was fetched yet. Nothing
+    is recorded, callers keeping the fingerprint of the metadata they
+    last processed can skip work when the instance did not change.
+    """
+    if fingerprint is None:
+        fingerprint = _compute_fingerprint
+    return get_compute_fingerprint(metadata) != fingerprint
 
 
 def _is_required_metadata_version_available():
     """
     Check if the metadata version we want is available
     """
-    versions = json.loads(_fetch_metadata(f"{METADATA_URL}versions"))
+    entry = _disk_cache and _disk_cache.get('versions')
+    if entry:
+        versions = entry[0]
+    else:
+        versions = json.loads(_fetch_metadata(f"{_metadata_url}versions"))
+        if _disk_cache and versions.get('apiVersions'):
+            _disk_cache.set('versions', versions, VERSIONS_TTL)
+
     return REQUIRED_METADATA_VERSION in versions.get('apiVersions', [])
 
 
 def _fetch_metadata(url):
-    """Return the response of the metadata request."""
-    data_request = urllib.request.Request(
+    """
+    Return the response of the metadata request.
+
+    Concurrent requests for the same url share a single request.
+    """
+    return _single_flight.do(('imds', url), lambda: _send_metadata(url))
+
+
+def _send_metadata(url):
+    data_request = _create_metadata_request(url)
+
+    def _fetch():
+        with _urlopen(data_request, 'imds') as value:
+            return value.read().decode("utf-8")
+
+    try:
+        return _retry_policy.call(_fetch)
+    except urllib.error.URLError as error:
+        log.error('Failed to retrieve metadata for: %s: %s', url, str(error))
+        return "{}"
+
+
+def _create_metadata_request(url: str):
+    return urllib.request.Request(
         url,
         headers=METADATA_HEADER,
         method='GET'
     )
+
+
+def _get_token_identity(config: Config):
+    """
+    Return the identity the MSI token is requested for.
+
+    On a VM the token belongs to the VM identity, on k8s it belongs
+    to the client id provided in the environment.
+    """
+    usage_api = config.get('api')
+    if usage_api and usage_api != 'no_data_query':
+        return 'vm'
+
+    return os.environ['CLIENT_ID']
+
+
+def _get_token_expiry(auth_token: dict):
+    """
+    Return the epoch time the token expires at or None if unknown.
+
+    IMDS provides expires_on as an epoch timestamp and expires_in
+    as the token lifetime in seconds, both as strings.
+    """
     try:
-        with urllib.request.urlopen(data_request) as value:
-            return value.read().decode("utf-8")
-    except urllib.error.URLError as error:
-        log.error('Failed to retrieve metadata for: %s: %s', url, str(error))
-        return "{}"
+        return float(auth_token['expires_on'])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    try:
+        return time.time() + float(auth_token['expires_in'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _invalidate_msi_token(config: Config):
+    """Drop the cached MSI token for the identity in use."""
+    identity = _get_token_identity(config)
+    cached = _token_cache.pop(identity, None)
+    if _disk_cache:
+        _disk_cache.delete(f'token:{identity}')
+    if _token_store and cached:
+        try:
+            _token_store.invalidate(identity, cached[0])
+        except OSError as error:
+            log.warning('Unable to update the token store: %s', error)
 
 
 def _get_msi_token(config: Config):
-    """Get the MSI token to authenticate when using the Billing API"""
+    """
+    Get the MSI token to authenticate when using the Billing API
+
+    Tokens are cached per identity, and shared through the disk cache
+    and the token store when configured, until they are within
+    TOKEN_EXPIRY_MARGIN seconds of expiring. Concurrent refreshes for
+    the same identity share a single request.
+    """
+    identity = _get_token_identity(config)
+    token = _get_cached_msi_token(identity)
+    _record_cache('token', bool(token))
+    if token:
+        return token
+
+    with _trace('msi_token', identity=identity):
+        return _single_flight.do(
+            ('token', identity),
+            lambda: _refresh_msi_token(identity)
+        )
+
+
+def _get_cached_msi_token(identity: str):
+    """Return the cached token if it is not about to expire."""
+    cached = _token_cache.get(identity)
+    if not cached and _disk_cache:
+        entry = _disk_cache.get(f'token:{identity}')
+        cached = tuple(entry[0]) if entry else None
+    if cached and cached[1] - TOKEN_EXPIRY_MARGIN > time.time():
+        _token_cache[identity] = cached
+        return cached[0]
+    return None
+
+
+def _refresh_msi_token(identity: str):
+    """Get a new token from the token store or IMDS and cache it."""
+    # A concurrent refresh may have finished since the cache was checked
+    token = _get_cached_msi_token(identity)
+    if token:
+        return token
+
+    expires_on = None
+    if _token_store:
+        try:
+            token, expires_on = _token_store.get(
+                identity,
+                lambda: _fetch_msi_token(identity),
+                TOKEN_EXPIRY_MARGIN
+            )
+        except OSError as error:
+            log.warning('Unable to use the token store: %s', error)
+
+    if not token:
+        token, expires_on = _fetch_msi_token(identity)
+
+    _cache_msi_token(identity, token, expires_on)
+    return token
+
+
+def _cache_msi_token(identity: str, token: str, expires_on: float):
+    if expires_on:
+        _token_cache[identity] = (token, expires_on)
+        if _disk_cache:
+            _disk_cache.set(
+                f'token:{identity}',
+                [token, expires_on],
+                expires_on - time.time()
+            )
+
+
+def _fetch_msi_token(identity: str):
+    """Request an MSI token from IMDS and return it with its expiry."""
+    try:
+        return _parse_msi_token(
+            _fetch_metadata(_get_msi_token_url(identity))
+        )
+    except ValueError as error:
+        log.error('Unable to acquire an MSI token %s:', str(error))
+        raise cba_exceptions.CSPBillingAdapterException from error
+
+
+def _get_msi_token_url(identity: str):
+    """Return the IMDS url of the MSI token for the identity."""
     # https://learn.microsoft.com/en-us/partner-center/marketplace/marketplace-metering-service-authentication
 
     # Set resource id to the required value needed to to retrieve an
     # MSI Authentication Token
-    usage_api = config.get('api')
-    if usage_api and usage_api != 'no_data_query':
+    if identity == 'vm':
         # running a vm
-        url = (
-            'http://169.254.169.254/metadata/identity/oauth2/token'
+        return (
+            f'{_metadata_url}identity/oauth2/token'
             f'?api-version={TOKEN_API_VERSION}'
             f'&resource={TOKEN_RESOURCE}'
         )
-    else:
-        # it is running on k8s
-        resource = '20e940b3-4c77-4b0b-9a53-9e16a1b010a7'
-        client_id = os.environ['CLIENT_ID']
-        url = (
-            f"{METADATA_URL}"
-            f"identity/oauth2/token?api-version=2018-02-01"
-            f"&client_id={client_id}"
-            f"&resource={resource}"
+
+    # it is running on k8s
+    resource = '20e940b3-4c77-4b0b-9a53-9e16a1b010a7'
+    return (
+        f"{_metadata_url}"
+        f"identity/oauth2/token?api-version=2018-02-01"
+        f"&client_id={identity}"
+        f"&resource={resource}"
+    )
+
+
+def _parse_msi_token(response: str):
+    """
+    Return the token and its expiry from the IMDS token response.
+
+    ValueError is raised if the response is not JSON.
+    """
+    auth_token = json.loads(response)
+
+    if (
+        auth_token.get("token_type") == "Bearer"
+        and auth_token.get("access_token")
+    ):
+        return (
+            f'Bearer {auth_token["access_token"]}',
+            _get_token_expiry(auth_token)
         )
 
-    try:
-        auth_token = json.loads(_fetch_metadata(url))
+    log.error('Invalid MSI token retrieved: %s', auth_token)
+    raise cba_exceptions.CSPBillingAdapterException
 
-        if auth_token["token_type"] == "Bearer" and auth_token["access_token"]:
-            return f'Bearer {auth_token["access_token"]}'
 
-        log.error('Invalid MSI token retrieved: %s', auth_token)
-        raise cba_exceptions.CSPBillingAdapterException
-    except ValueError as error:
-        log.error('Unable to acquire an MSI token %s:', str(error))
-        raise cba_exceptions.CSPBillingAdapterException from error
+def _get_metering_context(config: Config):
+    """
+    Return the resource uri and plan id that usage is metered against.
+
+    The values do not change for the life of a deployment so they are
+    resolved once and kept until invalidated.
+    """
+    source = _get_metering_source(config)
+    context = _get_cached_metering_context(source)
+    if context:
+        return context
+
+    resource_uri, plan_id = source[:2]
+    if resource_uri is None or plan_id is None:
+        # if not present, it is running on a VM
+        with _trace('resolve_resource') as span:
+            resource_uri = _get_resource_uri()
+            span.set_attribute('resource_uri', resource_uri)
+        plan_id = _get_plan_id(config)
+
+    return _cache_metering_context(source, resource_uri, plan_id)
+
+
+def _get_metering_source(config: Config):
+    """Return the settings the metering context is resolved from."""
+    return (
+        os.environ.get('EXTENSION_RESOURCE_ID'),
+        os.environ.get('PLAN_ID'),
+        config.get('product_code')
+    )
+
+
+def _get_cached_metering_context(source: tuple):
+    """Return the metering context resolved from the source or None."""
+    _record_cache('metering_context', source in _metering_context)
+    return _metering_context.get(source)
+
+
+def _cache_metering_context(source: tuple, resource_uri: str, plan_id: str):
+    """Keep the metering context once a resource uri was resolved."""
+    if resource_uri:
+        _metering_context[source] = (resource_uri, plan_id)
+
+    return resource_uri, plan_id
+
+
+def _get_plan_id(config: Config):
+    # product code has the format
+    # publisher:product_name:plan:version
+    return config['product_code'].split(':')[2]
+
+
+def _invalidate_metering_context():
+    """Drop the resolved metering context so it is resolved again."""
+    _metering_context.clear()
+    if _disk_cache:
+        _disk_cache.delete('managed_identity')
 
 
-def _create_usage_list(dimensions: dict, timestamp: datetime, config: Config):
-    """Create the usage list used with the batchEventUsage API"""
+def _create_usage_list(
+    dimensions: dict,
+    timestamp: datetime,
+    config: Config,
+    metering_context: tuple = None
+):
+    """
+    Create the usage list used with the batchEventUsage API
+
+    The metering context is resolved unless it is provided. The
+    effectiveStartTime is the UTC hour the timestamp falls in, as the
+    marketplace accepts one usage event per dimension and hour.
+    """
 
     usage = []
-    try:
-        resource_uri = os.environ['EXTENSION_RESOURCE_ID']
-        plan_id = os.environ['PLAN_ID']
-    except KeyError:
-        # if not present, it is running on a VM
-        resource_uri = _get_resource_uri()
-        product_code = config['product_code']
-        # product code has the format
-        # publisher:product_name:plan:version
-        plan_id = product_code.split(':')[2]
+    resource_uri, plan_id = (
+        metering_context or _get_metering_context(config)
+    )
 
     for dimension_name, quantity in dimensions.items():
         if quantity == 0:
@@ -270,7 +1905,9 @@ def _create_usage_list(dimensions: dict, timestamp: datetime, config: Config):
                 'resourceUri': resource_uri,
                 'quantity': quantity,
                 'dimension': dimension_name,
-                'effectiveStartTime': str(timestamp),
+                'effectiveStartTime': idempotency.get_hour_bucket(
+                    timestamp
+                ),
                 'planId': plan_id
             }
         )
@@ -278,11 +1915,69 @@ def _create_usage_list(dimensions: dict, timestamp: datetime, config: Config):
 
 
 def _get_managed_identity():
-    instance_metadata = _get_instance_metadata()
+    url, identity = _lookup_managed_identity(_get_instance_metadata())
+    if identity is not None:
+        return identity
+
+    data_request = _create_managed_identity_request(
+        url,
+        _get_msi_token({'api': '1'})
+    )
+
+    def _refresh_token():
+        _invalidate_msi_token({'api': '1'})
+        data_request.add_header('authorization', _get_msi_token({'api': '1'}))
+
+    def _fetch():
+        with _urlopen(data_request, 'arm') as value:
+            return json.loads(
+                value.read().decode("utf-8")
+            )
+
+    def _send():
+        return _retry_policy.call(_fetch, on_unauthorized=_refresh_token)
+
+    try:
+        identity = _single_flight.do(('arm', url), _send)
+    except urllib.error.URLError as error:
+        return _managed_identity_failed(url, error)
+
+    _cache_managed_identity(url, identity)
+    return identity
+
+
+def _lookup_managed_identity(instance_metadata: dict):
+    """
+    Return the url of the managed identity of the instance and the
+    identity cached on disk or None.
+    """
+    url = _get_managed_identity_url(instance_metadata)
+    identity = _get_cached_managed_identity(url)
+    _record_cache('managed_identity', identity is not None)
+    return url, identity
+
+
+def _create_managed_identity_request(url: str, token: str):
+    return urllib.request.Request(
+        url,
+        headers={'authorization': token},
+        method='GET'
+    )
+
+
+def _managed_identity_failed(url: str, error: urllib.error.URLError):
+    """Log the failed managed identity request, return an empty identity."""
+    log.error(
+        f'Failed to retrieve managed identity for: {url}: {str(error)}'
+    )
+    return {}
+
+
+def _get_managed_identity_url(instance_metadata: dict):
     try:
         compute = instance_metadata['compute']
-        url = (
-            f"{MANAGED_IDENTITY_URL}/"
+        return (
+            f"{_managed_identity_url}/"
             f"{compute['subscriptionId']}/"
             f"resourceGroups/{compute['resourceGroupName']}"
             f"?api-version={MANAGED_IDENTITY_VERSION}"
@@ -294,26 +1989,28 @@ def _get_managed_identity():
         )
         raise cba_exceptions.CSPMetadataRetrievalError(message)
 
-    token = _get_msi_token({'api': '1'})
-    data_request = urllib.request.Request(
-        url,
-        headers={'authorization': token},
-        method='GET'
-    )
-    try:
-        with urllib.request.urlopen(data_request) as value:
-            return json.loads(
-                value.read().decode("utf-8")
-            )
-    except urllib.error.URLError as error:
-        log.error(
-            f'Failed to retrieve managed identity for: {url}: {str(error)}'
+
+def _get_cached_managed_identity(url: str):
+    entry = _disk_cache and _disk_cache.get('managed_identity')
+    if entry and entry[0].get('url') == url:
+        return entry[0]['identity']
+    return None
+
+
+def _cache_managed_identity(url: str, identity: dict):
+    if _disk_cache and identity.get('managedBy'):
+        _disk_cache.set(
+            'managed_identity',
+            {'url': url, 'identity': identity},
+            MANAGED_IDENTITY_TTL
         )
-        return {}
 
 
 def _get_resource_uri():
-    managed_identity = _get_managed_identity()
+    return _get_managed_by(_get_managed_identity())
+
+
+def _get_managed_by(managed_identity: dict):
     try:
         return managed_identity['managedBy']
     except KeyError:
@@ -323,8 +2020,13 @@ def _get_resource_uri():
         )
 
 
-def _create_status_dict(response: dict):
-    """Create the status dict from the response from the batchUsageEvent API"""
+def _create_status_dict(response: dict, key=_get_dimension):
+    """
+    Create the status dict from the response from the batchUsageEvent API
+
+    Usage events the API reports as duplicates were accepted before and
+    are reported as submitted with the id of the accepted event.
+    """
     status = {}
     for resp in response["result"]:
         if resp.get("status") == "Accepted":
@@ -336,6 +2038,19 @@ def _create_status_dict(response: dict):
                 'New metered billing record added with ID %s:',
                 dim_status["record_id"]
             )
+        elif resp.get("status") == "Duplicate":
+            # The usage was accepted by an earlier submission
+            accepted = (resp.get("error") or {}).get(
+                "additionalInfo", {}
+            ).get("acceptedMessage", {})
+            dim_status = {
+                "record_id": accepted.get("usageEventId", None),
+                "status": "submitted"
+            }
+            log.info(
+                'Metered billing record already added with ID %s:',
+                dim_status["record_id"]
+            )
         else:
             log.error(
                 'Unable to log metered billing record: %s',
@@ -348,7 +2063,7 @@ def _create_status_dict(response: dict):
                     f'Status: {resp.get("status")} '
                     f'Message: {resp.get("error", {}).get("message")}'
             }
-        status[resp["dimension"]] = dim_status
+        status[key(resp)] = dim_status
     return status
 
 
@@ -0,0 +1,380 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Profiling of the hot paths of the plugin.
+
+A Profiler wraps functions to count their calls and time them. While a
+wrapped call runs, a sampler thread records the stack of the thread
+running it every sample interval, if the thread was using CPU since the
+previous sample, and tracemalloc traces the allocations. Where threads
+have no CPU clock of their own every sample is recorded, including
+those of a thread waiting for I/O.
+Every interval invocations a report is written to the directory: a JSON
+file with the call statistics, the most sampled functions and the
+largest and fastest growing allocations, and the sampled stacks in the
+collapsed format read by flame graph tools.
+
+Nothing is wrapped unless profiling is enabled in the config.
+"""
+
+import collections
+import contextlib
+import contextvars
+import datetime
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+log = logging.getLogger('CSPBillingAdapter')
+
+DEFAULT_INTERVAL = 100
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_MEMORY_FRAMES = 1
+# Share of the time since its previous sample a thread has to have used
+# CPU for to be sampled. A thread waiting for I/O or a lock for most of
+# that time is idle, the CPU it used before it blocked is not attributed
+# to the stack it blocked in.
+MIN_CPU_SHARE = 0.25
+# Entries listed in each section of a report
+TOP_ENTRIES = 25
+
+MEMORY_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>')
+)
+
+# Set while a wrapped call runs, nested calls are not invocations
+_profiled = contextvars.ContextVar('profiled', default=False)
+
+
+def _describe_frame(frame):
+    code = frame.f_code
+    return (
+        f'{code.co_name} '
+        f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+    )
+
+
+def _get_stack(frame):
+    """Return the stack of the frame from its outermost call."""
+    stack = []
+    while frame is not None:
+        stack.append(_describe_frame(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+def _get_cpu_time(ident: int):
+    """Return the CPU time used by the thread or None if unknown."""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        # No thread CPU clocks on this platform or the thread ended
+        return None
+
+
+class Sampler:
+    """Record the stacks of the started threads while they use CPU."""
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        # Started threads by ident, with the number of starts and the
+        # time and CPU time of the thread at the previous sample
+        self._threads = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='csp-billing-adapter-sampler',
+            daemon=True
+        )
+        self._thread.start()
+
+    def start(self):
+        """Sample the calling thread until each start is matched by a stop."""
+        ident = threading.get_ident()
+        with self._lock:
+            starts, previous = self._threads.get(ident, (0, None))
+            self._threads[ident] = (starts + 1, previous)
+            self._running.set()
+
+    def stop(self):
+        ident = threading.get_ident()
+        with self._lock:
+            starts, previous = self._threads.pop(ident)
+            if starts > 1:
+                self._threads[ident] = (starts - 1, previous)
+            if not self._threads and not self._closed:
+                self._running.clear()
+
+    def _run(self):
+        while True:
+            self._running.wait()
+            if self._closed:
+                return
+
+            self._sample()
+            time.sleep(self.interval)
+
+    def _sample(self):
+        frames = sys._current_frames()
+        now = time.perf_counter()
+        stacks = []
+        with self._lock:
+            for ident, (starts, previous) in list(self._threads.items()):
+                cpu_time = _get_cpu_time(ident)
+                self._threads[ident] = (starts, (now, cpu_time))
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                # The first sample of a thread only reads its CPU time
+                if cpu_time is None or (
+                    previous is not None
+                    and cpu_time - previous[1]
+                    >= (now - previous[0]) * MIN_CPU_SHARE
+                ):
+                    stacks.append(_get_stack(frame))
+
+            self.samples += 1
+            self.stacks.update(stacks)
+
+    def reset(self):
+        """Return the stacks and number of samples and start over."""
+        with self._lock:
+            stacks, self.stacks = self.stacks, collections.Counter()
+            samples, self.samples = self.samples, 0
+        return stacks, samples
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._running.set()
+        self._thread.join()
+
+
+class Profiler:
+    """Profile the wrapped functions and write reports to a directory."""
+
+    def __init__(
+        self,
+        directory: str,
+        interval: int = DEFAULT_INTERVAL,
+        sample_interval: float = DEFAULT_SAMPLE_INTERVAL,
+        memory_frames: int = DEFAULT_MEMORY_FRAMES
+    ):
+        self.directory = directory
+        self.interval = max(int(interval), 1)
+        self.invocations = 0
+        self.reports = 0
+        self._functions = {}
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+        self._sampler = Sampler(sample_interval)
+        # Memory profiling is disabled with 0 frames, tracing started
+        # by someone else is left running on close
+        self._tracing_memory = bool(
+            memory_frames and not tracemalloc.is_tracing()
+        )
+        if self._tracing_memory:
+            tracemalloc.start(memory_frames)
+
+    def wrap(self, name: str, func):
+        """Return func profiled under name, coroutines included."""
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def _profiled_coroutine(*args, **kwargs):
+                with self._profile(name):
+                    return await func(*args, **kwargs)
+            return _profiled_coroutine
+
+        @functools.wraps(func)
+        def _profiled_function(*args, **kwargs):
+            with self._profile(name):
+                return func(*args, **kwargs)
+        return _profiled_function
+
+    @contextlib.contextmanager
+    def _profile(self, name: str):
+        outermost = not _profiled.get()
+        token = _profiled.set(True)
+        self._sampler.start()
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            cpu_time = time.thread_time() - cpu_start
+            self._sampler.stop()
+            _profiled.reset(token)
+            if self._record(name, duration, cpu_time, outermost):
+                self.dump()
+
+    def _record(
+        self,
+        name: str,
+        duration: float,
+        cpu_time: float,
+        outermost: bool
+    ):
+        """Add the call to the statistics, return True if a report is due."""
+        with self._lock:
+            stats = self._functions.setdefault(name, {
+                'calls': 0,
+                'total_seconds': 0,
+                'max_seconds': 0,
+                'cpu_seconds': 0
+            })
+            stats['calls'] += 1
+            stats['total_seconds'] += duration
+            stats['max_seconds'] = max(stats['max_seconds'], duration)
+            stats['cpu_seconds'] += cpu_time
+            if not outermost:
+                return False
+
+            self.invocations += 1
+            return not self.invocations % self.interval
+
+    def dump(self):
+        """
+        Write a report of the calls since the previous one.
+
+        Return the path of the JSON report, or None if it could not be
+        written.
+        """
+        with self._dump_lock:
+            with self._lock:
+                functions, self._functions = self._functions, {}
+                invocations = self.invocations
+                self.reports += 1
+                number = self.reports
+            stacks, samples = self._sampler.reset()
+
+            # Called from the profiled hot path, a failure to profile
+            # must never reach the caller
+            try:
+                report = {
+                    'created': datetime.datetime.now(
+                        datetime.timezone.utc
+                    ).isoformat(),
+                    'pid': os.getpid(),
+                    'invocations': invocations,
+                    'functions': functions,
+                    'cpu': {
+                        'sample_interval': self._sampler.interval,
+                        'samples': samples,
+                        'top_functions': self._get_top_functions(stacks)
+                    },
+                    'memory': self._get_memory_report()
+                }
+            except Exception as error:
+                log.warning('Unable to create profile: %s', error)
+                return None
+
+            path = os.path.join(
+                self.directory,
+                f'profile-{os.getpid()}-{number:04d}'
+            )
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(f'{path}.json', 'w') as report_file:
+                    json.dump(report, report_file, indent=2)
+                with open(f'{path}.folded', 'w') as stacks_file:
+                    stacks_file.writelines(
+                        f'{stack} {count}\n'
+                        for stack, count in stacks.most_common()
+                    )
+            except OSError as error:
+                log.warning(
+                    'Unable to write profile to %s: %s',
+                    self.directory,
+                    error
+                )
+                return None
+
+        log.info('Profile of %d invocations written to %s', invocations, path)
+        return f'{path}.json'
+
+    def _get_top_functions(self, stacks: collections.Counter):
+        """Return the functions most often running when sampled."""
+        leaves = collections.Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values())
+        return [
+            {'function': function, 'samples': count, 'share': count / total}
+            for function, count in leaves.most_common(TOP_ENTRIES)
+        ]
+
+    def _get_memory_report(self):
+        """
+        Return the largest allocations and the growth since the
+        previous report, None if tracemalloc is not tracing.
+        """
+        if not tracemalloc.is_tracing():
+            return None
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(MEMORY_FILTERS)
+        current, peak = tracemalloc.get_traced_memory()
+        # Without reset_peak (Python < 3.9) the peak is since tracing began
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        report = {
+            'current': current,
+            'peak': peak,
+            'top': [
+                {
+                    'location': str(stat.traceback),
+                    'size': stat.size,
+                    'count': stat.count
+                }
+                for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]
+            ],
+            'growth': []
+        }
+        if self._snapshot:
+            report['growth'] = [
+                {
+                    'location': str(stat.traceback),
+                    'size_diff': stat.size_diff,
+                    'count_diff': stat.count_diff
+                }
+                for stat in snapshot.compare_to(
+                    self._snapshot,
+                    'lineno'
+                )[:TOP_ENTRIES]
+                if stat.size_diff > 0
+            ]
+        self._snapshot = snapshot
+        return report
+
+    def close(self):
+        """Stop sampling, and tracing memory if it was started here."""
+        self._sampler.close()
+        if self._tracing_memory:
+            tracemalloc.stop()
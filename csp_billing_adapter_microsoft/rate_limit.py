@@ -0,0 +1,148 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Client side rate limiting of the requests sent to the marketplace.
+
+A token bucket holds up to burst tokens and is refilled at the current
+rate, every request takes one token and waits for it when the bucket is
+empty. The rate is halved when the server throttles a request, no token
+is handed out before its Retry-After time, and the rate grows back
+towards the configured one as requests succeed.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from csp_billing_adapter_microsoft import retry
+
+log = logging.getLogger('CSPBillingAdapter')
+
+# The rate is multiplied by this factor when throttled
+DECREASE_FACTOR = 0.5
+# Share of the configured rate added back after each success
+INCREASE_STEP = 0.1
+# The rate is never lowered below this share of the configured rate
+MIN_RATE_FACTOR = 0.05
+
+
+class RateLimiter:
+    """A token bucket with a rate that adapts to throttling."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        if rate <= 0:
+            raise ValueError(f'Invalid rate: {rate}')
+
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate * MIN_RATE_FACTOR
+        self.burst = max(int(burst), 1)
+        self.rate = self.max_rate
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+        self._throttled = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._tokens = min(self._tokens + elapsed * self.rate, self.burst)
+        self._updated = now
+
+    def _reserve(self):
+        """
+        Take a token and return the seconds to wait before using it.
+
+        The bucket goes negative for tokens reserved ahead of time so
+        concurrent callers are spaced out at the current rate.
+        DeadlineExceeded is raised, without taking the token, if the
+        wait would end past the deadline.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(
+                -self._tokens / self.rate if self._tokens < 0 else 0,
+                self._blocked_until - now
+            )
+
+            remaining = retry.get_remaining() if wait > 0 else None
+            if remaining is not None and wait >= remaining:
+                self._tokens += 1
+                raise retry.DeadlineExceeded(
+                    'Deadline exceeded waiting for the rate limit'
+                )
+            return wait
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait until a request may be sent without blocking the loop."""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        """Raise the rate back towards the configured one."""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(
+                    self.rate + self.max_rate * INCREASE_STEP,
+                    self.max_rate
+                )
+
+    def on_throttled(self, retry_after: float = None):
+        """
+        Lower the rate after the server throttled a request.
+
+        No token is handed out before retry_after seconds have passed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.rate * DECREASE_FACTOR, self.min_rate)
+            self._throttled += 1
+            if retry_after:
+                self._blocked_until = max(
+                    self._blocked_until,
+                    now + retry_after
+                )
+
+        log.warning(
+            'Marketplace requests throttled, rate lowered to %.2f/s',
+            self.rate
+        )
+
+    def get_state(self):
+        """Return the current state of the limiter."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'rate': self.rate,
+                'max_rate': self.max_rate,
+                'burst': self.burst,
+                'tokens': self._tokens,
+                'blocked_for': max(self._blocked_until - now, 0),
+                'throttled': self._throttled
+            }
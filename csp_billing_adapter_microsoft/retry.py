@@ -0,0 +1,283 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Retry policy for the requests sent by the plugin.
+
+Throttling (429), timeouts (408), server errors (5xx) and connection
+errors are retried with a jittered exponential backoff, honoring any
+Retry-After header sent with the response. Other client errors, and
+requests refused by an open circuit, are raised right away as they will
+not succeed when sent again.
+
+A deadline can be set for a block of requests, no request is started
+and no retry is scheduled past the deadline. Coroutines are retried the
+same way with call_async.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import logging
+import random
+import time
+import urllib.error
+
+from datetime import datetime, timezone
+
+import csp_billing_adapter.exceptions as cba_exceptions
+
+from csp_billing_adapter_microsoft import circuit_breaker
+
+log = logging.getLogger('CSPBillingAdapter')
+
+DEFAULT_RETRY_ATTEMPTS = 3
+DEFAULT_RETRY_BACKOFF = 1
+DEFAULT_RETRY_BACKOFF_FACTOR = 2
+DEFAULT_RETRY_MAX_BACKOFF = 30
+
+RETRIABLE_STATUS_CODES = (408, 429)
+
+# Monotonic time the current block of requests has to finish by
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(cba_exceptions.CSPBillingAdapterException):
+    """The time budget for a block of requests ran out."""
+
+
+@contextlib.contextmanager
+def deadline(seconds: float = None):
+    """
+    Limit the requests sent in the block to the given number of seconds.
+
+    A nested deadline can only shorten the enclosing one. No deadline is
+    set if seconds is None.
+    """
+    current = _deadline.get()
+    if seconds is not None:
+        new = time.monotonic() + seconds
+        if current is None or new < current:
+            current = new
+
+    token = _deadline.set(current)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def get_remaining():
+    """
+    Return the seconds left before the deadline or None without one.
+
+    DeadlineExceeded is raised once the deadline has passed.
+    """
+    current = _deadline.get()
+    if current is None:
+        return None
+
+    remaining = current - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded('Deadline exceeded')
+    return remaining
+
+
+def get_retry_after(error: urllib.error.URLError):
+    """
+    Return the seconds to wait from the Retry-After header or None.
+
+    The header is either a number of seconds or an HTTP date.
+    """
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    delta = retry_at - datetime.now(timezone.utc)
+    return max(delta.total_seconds(), 0)
+
+
+def is_retriable(error: urllib.error.URLError):
+    """Return True if the request may succeed when sent again."""
+    if isinstance(error, circuit_breaker.CircuitOpenError):
+        return False
+
+    code = getattr(error, 'code', None)
+    if code is None:
+        # No response was received, the connection failed
+        return True
+
+    return code in RETRIABLE_STATUS_CODES or code >= 500
+
+
+class RetryPolicy:
+    """
+    Send a request up to attempts times.
+
+    The delay before retry n is backoff * backoff_factor ** (n - 1),
+    capped at max_backoff, with up to half of it replaced by jitter.
+    """
+
+    def __init__(
+        self,
+        attempts: int = DEFAULT_RETRY_ATTEMPTS,
+        backoff: float = DEFAULT_RETRY_BACKOFF,
+        backoff_factor: float = DEFAULT_RETRY_BACKOFF_FACTOR,
+        max_backoff: float = DEFAULT_RETRY_MAX_BACKOFF
+    ):
+        self.attempts = max(int(attempts), 1)
+        self.backoff = max(backoff, 0)
+        self.backoff_factor = max(backoff_factor, 1)
+        self.max_backoff = max(max_backoff, 0)
+
+    def get_delay(self, attempt: int, error: urllib.error.URLError = None):
+        """
+        Return the seconds to wait after the given failed attempt.
+
+        None is returned when the server asks for a longer wait
+        than max_backoff allows.
+        """
+        retry_after = get_retry_after(error) if error else None
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            return retry_after
+
+        delay = min(
+            self.backoff * self.backoff_factor ** (attempt - 1),
+            self.max_backoff
+        )
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def get_wait(self, attempt: int, error=None):
+        """
+        Return the seconds to wait before retrying after the given
+        failed attempt, see wait, or None when not retrying.
+        """
+        if attempt >= self.attempts:
+            return None
+
+        delay = self.get_delay(attempt, error)
+        if delay is None:
+            return None
+
+        remaining = get_remaining()
+        if remaining is not None and delay >= remaining:
+            raise DeadlineExceeded(f'Deadline exceeded after: {error}')
+
+        log.warning(
+            'Request failed: %s, retry after %.2f seconds, '
+            '%d attempts remaining',
+            error,
+            delay,
+            self.attempts - attempt
+        )
+        return delay
+
+    def wait(self, attempt: int, error=None):
+        """
+        Sleep before retrying after the given failed attempt.
+
+        The error, an exception or a message, describes the failure.
+        Return False instead when no attempts are left or the server
+        asks for a longer wait than allowed. DeadlineExceeded is raised
+        if the retry would start after the deadline.
+        """
+        delay = self.get_wait(attempt, error)
+        if delay is None:
+            return False
+
+        time.sleep(delay)
+        return True
+
+    async def wait_async(self, attempt: int, error=None):
+        """Sleep without blocking the event loop, see wait."""
+        delay = self.get_wait(attempt, error)
+        if delay is None:
+            return False
+
+        await asyncio.sleep(delay)
+        return True
+
+    def call(self, func, on_unauthorized=None):
+        """
+        Return the result of func, retrying it on retriable errors.
+
+        If on_unauthorized is provided it is called once on a 401 to
+        refresh the credentials before the request is sent again.
+        """
+        attempt = 1
+        while True:
+            try:
+                return func()
+            except urllib.error.URLError as error:
+                if getattr(error, 'code', None) == 401 and on_unauthorized:
+                    on_unauthorized()
+                    on_unauthorized = None
+                    continue
+
+                if not is_retriable(error):
+                    raise
+
+                try:
+                    if not self.wait(attempt, error):
+                        raise
+                except DeadlineExceeded as deadline_error:
+                    raise deadline_error from error
+
+                attempt += 1
+
+    async def call_async(self, func, on_unauthorized=None):
+        """
+        Return the result of the coroutine function func, see call.
+
+        on_unauthorized is a coroutine function as well.
+        """
+        attempt = 1
+        while True:
+            try:
+                return await func()
+            except urllib.error.URLError as error:
+                if getattr(error, 'code', None) == 401 and on_unauthorized:
+                    await on_unauthorized()
+                    on_unauthorized = None
+                    continue
+
+                if not is_retriable(error):
+                    raise
+
+                try:
+                    if not await self.wait_async(attempt, error):
+                        raise
+                except DeadlineExceeded as deadline_error:
+                    raise deadline_error from error
+
+                attempt += 1
@@ -0,0 +1,128 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Coalescing of identical concurrent requests.
+
+The first thread to request a key runs the call, the threads that
+request the same key while it is in flight wait for it and share its
+result or exception. Nothing is cached once the call has finished.
+AsyncSingleFlight does the same for the tasks of an event loop.
+"""
+
+import asyncio
+import threading
+
+from csp_billing_adapter_microsoft import retry
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one call per key at a time."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        Return the result of func, sharing it with concurrent callers.
+
+        Callers waiting on another thread stop at the deadline with
+        DeadlineExceeded.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as error:
+                call.error = error
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+
+        if not call.done.wait(retry.get_remaining()):
+            raise retry.DeadlineExceeded(
+                f'Deadline exceeded waiting for: {key}'
+            )
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """Run at most one coroutine per key and event loop at a time."""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        """
+        Return the result of the coroutine function func, see SingleFlight.
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (loop, key)
+        future = self._calls.get(loop_key)
+
+        if future is None:
+            future = self._calls[loop_key] = loop.create_future()
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except BaseException as error:
+                future.set_exception(error)
+                # Nobody may be waiting for it
+                future.exception()
+                raise
+            else:
+                future.set_result(result)
+                return result
+            finally:
+                del self._calls[loop_key]
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future),
+                retry.get_remaining()
+            )
+        except asyncio.TimeoutError as error:
+            raise retry.DeadlineExceeded(
+                f'Deadline exceeded waiting for: {key}'
+            ) from error
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,157 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+MSI token store shared by the adapter processes on a node.
+
+The tokens are kept in a JSON file readable only by its owner. The file
+is replaced atomically so it can be read without locking. Refreshing a
+token takes an exclusive lock on a separate lock file, the processes
+waiting for it reuse the token once the lock is released instead of
+requesting one of their own.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+from csp_billing_adapter_microsoft import retry
+
+log = logging.getLogger('CSPBillingAdapter')
+
+# Seconds between attempts to take the lock held by another process
+LOCK_POLL_INTERVAL = 0.05
+
+
+class TokenStore:
+    """Share MSI tokens by identity through a file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+
+    def _read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as store_file:
+                tokens = json.load(store_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            log.warning(
+                'Ignoring invalid token store %s: %s',
+                self.path,
+                error
+            )
+            return {}
+
+        return tokens if isinstance(tokens, dict) else {}
+
+    def _write(self, tokens: dict):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(
+            dir=directory,
+            prefix='.',
+            suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as store_file:
+                json.dump(tokens, store_file)
+                store_file.flush()
+                os.fsync(store_file.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """
+        Hold the exclusive lock on the store.
+
+        DeadlineExceeded is raised if the deadline passes while waiting.
+        """
+        os.makedirs(
+            os.path.dirname(os.path.abspath(self.path)),
+            mode=0o700,
+            exist_ok=True
+        )
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    retry.get_remaining()
+                    time.sleep(LOCK_POLL_INTERVAL)
+            yield
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    @staticmethod
+    def _get_valid(tokens: dict, identity: str, margin: float):
+        entry = tokens.get(identity)
+        try:
+            token, expires_on = entry['token'], float(entry['expires_on'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        if expires_on - margin > time.time():
+            return token, expires_on
+        return None
+
+    def get(self, identity: str, fetch, margin: float = 0):
+        """
+        Return the token and expiry for the identity.
+
+        A stored token is used until it is within margin seconds of
+        expiring. Otherwise the process holding the lock calls fetch,
+        which returns a token and its epoch expiry, and stores the
+        result for the other processes.
+        """
+        valid = self._get_valid(self._read(), identity, margin)
+        if valid:
+            return valid
+
+        with self._lock():
+            # Another process may have refreshed it while we waited
+            tokens = self._read()
+            valid = self._get_valid(tokens, identity, margin)
+            if valid:
+                return valid
+
+            token, expires_on = fetch()
+            if expires_on:
+                tokens[identity] = {'token': token, 'expires_on': expires_on}
+                try:
+                    self._write(tokens)
+                except OSError as error:
+                    log.warning('Unable to store the MSI token: %s', error)
+            return token, expires_on
+
+    def invalidate(self, identity: str, token: str):
+        """Remove the token for the identity unless it was replaced."""
+        with self._lock():
+            tokens = self._read()
+            entry = tokens.get(identity)
+            if isinstance(entry, dict) and entry.get('token') == token:
+                del tokens[identity]
+                self._write(tokens)
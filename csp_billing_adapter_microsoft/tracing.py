@@ -0,0 +1,187 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tracing of the phases of the plugin hooks.
+
+A Tracer times each phase as a span. Spans opened while another one is
+current become its children and share its trace id, through threads
+started with a copied context and asyncio tasks as well. Finished spans
+are handed to an exporter: NoopExporter drops them, JsonLinesExporter
+appends them to a file and InMemoryExporter keeps them in a list.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger('CSPBillingAdapter')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _new_id(size: int):
+    return os.urandom(size).hex()
+
+
+class Span:
+    """A timed phase with attributes."""
+
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else _new_id(16)
+        self.span_id = _new_id(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self.duration = None
+        self.error = None
+        self._start = time.perf_counter()
+
+    def set_attribute(self, name: str, value):
+        self.attributes[name] = value
+
+    def finish(self, error: BaseException = None):
+        self.duration = time.perf_counter() - self._start
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration': self.duration,
+            'status': 'error' if self.error else 'ok',
+            'error': self.error,
+            'attributes': self.attributes
+        }
+
+
+class _NoopSpan:
+    """Stands in for a span when tracing is disabled."""
+
+    trace_id = None
+
+    def set_attribute(self, name: str, value):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class NoopExporter:
+    """Drop the spans."""
+
+    def export(self, span: Span):
+        pass
+
+    def close(self):
+        pass
+
+
+class InMemoryExporter:
+    """Keep the finished spans in a list."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def get_spans(self, name: str = None):
+        with self._lock:
+            return [
+                span for span in self.spans
+                if name is None or span.name == name
+            ]
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+    def close(self):
+        pass
+
+
+class JsonLinesExporter:
+    """Append each finished span to a file as a line of JSON."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, 'a', encoding='utf-8')
+                self._file.write(line)
+                self._file.flush()
+            except OSError as error:
+                log.warning(
+                    'Unable to write span to %s: %s',
+                    self.path,
+                    error
+                )
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class Tracer:
+    """Create spans and export them once finished."""
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter or NoopExporter()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Time the block as a span, the child of the current span.
+
+        Exceptions raised in the block are recorded in the span.
+        """
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.finish(error)
+            raise
+        else:
+            span.finish()
+        finally:
+            _current_span.reset(token)
+            self.exporter.export(span)
+
+
+def get_current_span():
+    """Return the current span or None."""
+    return _current_span.get()
@@ -0,0 +1,558 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+HTTP transports used by the plugin for IMDS, ARM and Marketplace requests.
+
+A transport takes a urllib.request.Request and returns a response that
+can be used as a context manager and read like the object returned by
+urllib.request.urlopen. Failures are raised as urllib.error.HTTPError and
+urllib.error.URLError so callers handle both transports the same way.
+
+AsyncTransport does the same for coroutines, without blocking the event
+loop while waiting for the network.
+"""
+
+import asyncio
+import http.client
+import io
+import logging
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from collections import namedtuple
+
+log = logging.getLogger('CSPBillingAdapter')
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 60
+
+# Seconds to wait for a connection and for each read on it
+Timeout = namedtuple('Timeout', ['connect', 'read'])
+
+# Errors raised when a kept alive connection was closed by the server
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError
+)
+
+# Errors raised by asyncio streams when the server closed the connection
+ASYNC_STALE_CONNECTION_ERRORS = (
+    asyncio.IncompleteReadError,
+    BrokenPipeError,
+    ConnectionResetError
+)
+
+_transport = None
+_async_transport = None
+_transport_lock = threading.Lock()
+
+
+class Response:
+    """A fully read HTTP response."""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._body = io.BytesIO(body)
+
+    def read(self, *args):
+        return self._body.read(*args)
+
+    def getcode(self):
+        return self.status
+
+    def close(self):
+        self._body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class UrllibTransport:
+    """
+    Open a new connection for every request with urllib.
+
+    urllib has a single timeout, the larger of the two is used.
+    """
+
+    def open(self, request: urllib.request.Request, timeout: Timeout = None):
+        if timeout is None:
+            return urllib.request.urlopen(request)
+        return urllib.request.urlopen(request, timeout=max(timeout))
+
+    def close(self):
+        pass
+
+
+class ConnectionPool:
+    """
+    Keep alive connections to a single host.
+
+    At most pool_size idle connections are kept and connections that
+    were idle for longer than idle_timeout seconds are discarded.
+    """
+
+    def __init__(
+        self,
+        scheme: str,
+        host: str,
+        port: int = None,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT
+    ):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port)
+        return http.client.HTTPConnection(self.host, self.port)
+
+    def get(self):
+        """Return an idle connection or a new one, and if it is reused."""
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return connection, True
+                connection.close()
+
+        return self._new_connection(), False
+
+    def put(self, connection):
+        """Return a connection to the pool once its response is read."""
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append((connection, time.monotonic()))
+                return
+
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            connection.close()
+
+
+class PooledTransport:
+    """
+    Reuse connections with a keep alive pool per host.
+
+    Requests that have to go through a proxy configured in the
+    environment are handed to urllib.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT
+    ):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._fallback = UrllibTransport()
+
+    def _get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(
+                    scheme,
+                    host,
+                    port,
+                    self.pool_size,
+                    self.idle_timeout
+                )
+            return self._pools[key]
+
+    @staticmethod
+    def _uses_proxy(scheme, host):
+        proxies = urllib.request.getproxies()
+        return scheme in proxies and not urllib.request.proxy_bypass(host)
+
+    def open(self, request: urllib.request.Request, timeout: Timeout = None):
+        url = request.full_url
+        parts = urllib.parse.urlsplit(url)
+
+        if parts.scheme not in ('http', 'https'):
+            raise urllib.error.URLError(
+                f'Unsupported URL scheme: {parts.scheme}'
+            )
+
+        if self._uses_proxy(parts.scheme, parts.hostname):
+            return self._fallback.open(request, timeout)
+
+        pool = self._get_pool(parts.scheme, parts.hostname, parts.port)
+        headers = dict(request.header_items())
+        headers.setdefault('Host', parts.netloc)
+        if request.data is not None:
+            headers.setdefault('Content-Length', str(len(request.data)))
+
+        while True:
+            connection, reused = pool.get()
+            try:
+                if timeout is not None:
+                    connection.timeout = timeout.connect
+                    if connection.sock is None:
+                        connection.connect()
+                    connection.sock.settimeout(timeout.read)
+
+                connection.request(
+                    request.get_method(),
+                    request.selector,
+                    body=request.data,
+                    headers=headers
+                )
+                response = connection.getresponse()
+                body = response.read()
+            except STALE_CONNECTION_ERRORS as error:
+                connection.close()
+                if reused:
+                    # The server closed the idle connection, try again
+                    # with a new one.
+                    continue
+                raise urllib.error.URLError(error) from error
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                raise urllib.error.URLError(error) from error
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            pool.put(connection)
+
+        if response.status >= 400:
+            raise urllib.error.HTTPError(
+                url,
+                response.status,
+                response.reason,
+                response.headers,
+                io.BytesIO(body)
+            )
+
+        return Response(
+            url,
+            response.status,
+            response.reason,
+            response.headers,
+            body
+        )
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+
+        for pool in pools.values():
+            pool.close()
+
+
+class _StaleConnection(Exception):
+    """The server closed a kept alive connection before responding."""
+
+
+class AsyncTransport:
+    """
+    Send requests with asyncio streams, keeping connections alive.
+
+    Idle connections are kept per host and event loop, at most
+    pool_size of them for idle_timeout seconds. The connections of a
+    closed event loop, such as one run by asyncio.run, are dropped on
+    the next request. Requests that have to go through a proxy
+    configured in the environment are handed to urllib in the default
+    executor.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT
+    ):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._fallback = UrllibTransport()
+
+    def _get_connection(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._drop_closed_loops()
+            idle = self._idle.get(key, [])
+            while idle:
+                reader, writer, last_used = idle.pop()
+                if (
+                    now - last_used <= self.idle_timeout
+                    and not writer.is_closing()
+                    and not reader.at_eof()
+                ):
+                    return reader, writer
+                writer.close()
+        return None
+
+    def _put_connection(self, key, reader, writer):
+        with self._lock:
+            self._drop_closed_loops()
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append((reader, writer, time.monotonic()))
+                return
+        writer.close()
+
+    def _drop_closed_loops(self):
+        """Drop the idle connections of event loops that were closed."""
+        for key in [key for key in self._idle if key[0].is_closed()]:
+            for _, writer, _ in self._idle.pop(key):
+                _close_writer(writer)
+
+    async def _connect(self, parts, timeout):
+        ssl_context = None
+        if parts.scheme == 'https':
+            ssl_context = ssl.create_default_context()
+
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                parts.hostname,
+                parts.port or (443 if ssl_context else 80),
+                ssl=ssl_context
+            ),
+            timeout.connect if timeout else None
+        )
+
+    async def open(
+        self,
+        request: urllib.request.Request,
+        timeout: Timeout = None
+    ):
+        url = request.full_url
+        parts = urllib.parse.urlsplit(url)
+
+        if parts.scheme not in ('http', 'https'):
+            raise urllib.error.URLError(
+                f'Unsupported URL scheme: {parts.scheme}'
+            )
+
+        if PooledTransport._uses_proxy(parts.scheme, parts.hostname):
+            return await asyncio.get_running_loop().run_in_executor(
+                None,
+                self._fallback.open,
+                request,
+                timeout
+            )
+
+        key = (asyncio.get_running_loop(), parts.scheme, parts.netloc)
+        data = self._encode_request(request, parts)
+
+        while True:
+            connection = self._get_connection(key)
+            reused = connection is not None
+            try:
+                if not reused:
+                    connection = await self._connect(parts, timeout)
+                reader, writer = connection
+                writer.write(data)
+                await writer.drain()
+                status, reason, headers, body, will_close = (
+                    await self._read_response(
+                        reader,
+                        request.get_method(),
+                        timeout.read if timeout else None
+                    )
+                )
+            except (_StaleConnection, *ASYNC_STALE_CONNECTION_ERRORS) as error:
+                if connection:
+                    connection[1].close()
+                if reused:
+                    # The server closed the idle connection, try again
+                    # with a new one.
+                    continue
+                raise urllib.error.URLError(error) from error
+            except (
+                OSError,
+                ValueError,
+                asyncio.TimeoutError,
+                http.client.HTTPException
+            ) as error:
+                if connection:
+                    connection[1].close()
+                raise urllib.error.URLError(error) from error
+            break
+
+        if will_close:
+            writer.close()
+        else:
+            self._put_connection(key, reader, writer)
+
+        if status >= 400:
+            raise urllib.error.HTTPError(
+                url,
+                status,
+                reason,
+                headers,
+                io.BytesIO(body)
+            )
+
+        return Response(url, status, reason, headers, body)
+
+    @staticmethod
+    def _encode_request(request, parts):
+        headers = dict(request.header_items())
+        headers.setdefault('Host', parts.netloc)
+        if request.data is not None:
+            headers.setdefault('Content-Length', str(len(request.data)))
+
+        lines = [f'{request.get_method()} {request.selector} HTTP/1.1']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        return head + (request.data or b'')
+
+    @staticmethod
+    async def _read_response(reader, method, read_timeout):
+        async def _read(coroutine):
+            return await asyncio.wait_for(coroutine, read_timeout)
+
+        status_line = await _read(reader.readline())
+        if not status_line:
+            raise _StaleConnection('Connection closed before response')
+
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+            + ['']
+        )[:3]
+        status = int(status)
+
+        head = b''
+        while True:
+            line = await _read(reader.readline())
+            head += line
+            if line in (b'\r\n', b'\n', b''):
+                break
+        headers = http.client.parse_headers(io.BytesIO(head))
+
+        connection = (headers.get('Connection') or '').lower()
+        will_close = connection == 'close' or (
+            version == 'HTTP/1.0' and connection != 'keep-alive'
+        )
+
+        if method == 'HEAD' or status in (204, 304) or status < 200:
+            body = b''
+        elif 'chunked' in (headers.get('Transfer-Encoding') or '').lower():
+            body = b''
+            while True:
+                size_line = await _read(reader.readline())
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    # Skip the trailer
+                    while await _read(reader.readline()) not in (
+                        b'\r\n', b'\n', b''
+                    ):
+                        pass
+                    break
+                body += await _read(reader.readexactly(size))
+                await _read(reader.readline())
+        elif headers.get('Content-Length') is not None:
+            body = await _read(
+                reader.readexactly(int(headers['Content-Length']))
+            )
+        else:
+            body = await _read(reader.read())
+            will_close = True
+
+        return status, reason, headers, body, will_close
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for _, writer, _ in connections:
+                _close_writer(writer)
+
+
+def _close_writer(writer):
+    """
+    Close the connection of a stream writer.
+
+    The transport can not be closed once its event loop is closed, its
+    socket is then closed when the transport is garbage collected.
+    """
+    try:
+        writer.close()
+    except RuntimeError:
+        pass
+
+
+def get_transport():
+    """Return the transport in use, creating a pooled one if needed."""
+    global _transport
+
+    with _transport_lock:
+        if _transport is None:
+            _transport = PooledTransport()
+        return _transport
+
+
+def set_transport(transport):
+    """Replace the transport in use and close the previous one."""
+    global _transport
+
+    with _transport_lock:
+        previous, _transport = _transport, transport
+
+    if previous is not None and previous is not transport:
+        previous.close()
+
+
+def get_async_transport():
+    """Return the async transport in use, creating one if needed."""
+    global _async_transport
+
+    with _transport_lock:
+        if _async_transport is None:
+            _async_transport = AsyncTransport()
+        return _async_transport
+
+
+def set_async_transport(transport):
+    """Replace the async transport in use and close the previous one."""
+    global _async_transport
+
+    with _transport_lock:
+        previous, _async_transport = _async_transport, transport
+
+    if previous is not None and previous is not transport:
+        previous.close()
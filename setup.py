@@ -53,7 +53,7 @@ setup(
     },
     packages=['csp_billing_adapter_microsoft'],
     include_package_data=True,
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     install_requires=requirements,
     extras_require={
         'dev': dev_requirements,
@@ -70,7 +70,6 @@ setup(
         'License :: OSI Approved :: Apache License 2.0',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: 3.9',
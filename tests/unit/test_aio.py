@@ -0,0 +1,397 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import datetime
+import io
+import json
+import os
+import pytest
+import threading
+import time
+import urllib.error
+
+from unittest.mock import patch
+
+from csp_billing_adapter_microsoft import (
+    aio,
+    disk_cache,
+    idempotency,
+    outbox,
+    plugin,
+    retry,
+    transport
+)
+from csp_billing_adapter.config import Config
+from csp_billing_adapter.adapter import get_plugin_manager
+
+
+pm = get_plugin_manager()
+config = Config.load_from_file(
+    'tests/data/good_config.yaml',
+    pm.hook
+)
+
+
+class FakeTransport:
+    """Answer requests with the responses returned by handler."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+
+    async def open(self, request, timeout=None):
+        self.requests.append(request)
+        await asyncio.sleep(0)
+        status, body = self.handler(request)
+        data = json.dumps(body).encode('utf-8')
+        if status >= 400:
+            raise urllib.error.HTTPError(
+                request.full_url, status, 'Error', {}, io.BytesIO(data)
+            )
+        return transport.Response(request.full_url, status, 'OK', {}, data)
+
+    def close(self):
+        pass
+
+
+def _imds(request):
+    url = request.full_url
+    if 'oauth2/token' in url:
+        return 200, {
+            'access_token': '123456789',
+            'token_type': 'Bearer',
+            'expires_on': str(int(time.time()) + 3600)
+        }
+    if 'attested' in url:
+        return 200, {'signature': 'signature'}
+    if 'instance' in url:
+        return 200, {
+            'compute': {
+                'vmId': '1',
+                'subscriptionId': 'sub',
+                'resourceGroupName': 'group'
+            },
+            'network': {}
+        }
+    if 'resourceGroups' in url:
+        return 200, {'managedBy': '/subscriptions/sub/resource'}
+    return 200, _accept(request)
+
+
+def _accept(request):
+    usage = json.loads(request.data)['request']
+    return {
+        'count': len(usage),
+        'result': [
+            dict(
+                event,
+                usageEventId=f"id-{event['dimension']}",
+                status='Accepted'
+            )
+            for event in usage
+        ]
+    }
+
+
+@pytest.fixture(autouse=True)
+def plugin_state():
+    plugin._configure({})
+    plugin._retry_policy = retry.RetryPolicy(backoff=0)
+    plugin._token_cache.clear()
+    plugin._metering_context.clear()
+    plugin._metadata_cache.clear()
+    plugin._accepted_index.clear()
+    plugin._compute_fingerprint = None
+    fake = FakeTransport(_imds)
+    transport.set_async_transport(fake)
+    yield fake
+    transport.set_async_transport(None)
+    plugin._token_cache.clear()
+    plugin._metering_context.clear()
+    plugin._metadata_cache.clear()
+    plugin._accepted_index.clear()
+
+
+def test_get_account_info(plugin_state):
+    info = asyncio.run(aio.get_account_info(config))
+
+    assert info == {
+        'compute': {
+            'vmId': '1',
+            'subscriptionId': 'sub',
+            'resourceGroupName': 'group'
+        },
+        'network': {},
+        'attestedData': {'signature': 'signature'},
+        'cloud_provider': 'microsoft'
+    }
+
+    # The documents are shared with the sync hooks
+    assert plugin.get_account_info(config) == info
+    assert len(plugin_state.requests) == 2
+
+
+def test_get_account_info_failure(plugin_state):
+    """Test failed metadata requests leave empty dicts"""
+    plugin_state.handler = lambda request: (500, {})
+    plugin._retry_policy = retry.RetryPolicy(attempts=1)
+
+    info = asyncio.run(aio.get_account_info(config))
+    assert info == {'attestedData': {}, 'cloud_provider': 'microsoft'}
+
+
+@patch.dict(os.environ, {'CLIENT_ID': 'client'})
+def test_meter_billing(plugin_state):
+    """Test usage is submitted for the resolved resource"""
+    dimensions = {f'dim_{index}': index + 1 for index in range(30)}
+
+    status = asyncio.run(aio.meter_billing(
+        config,
+        dimensions,
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    ))
+
+    assert status == {
+        name: {'record_id': f'id-{name}', 'status': 'submitted'}
+        for name in dimensions
+    }
+    posts = [
+        request for request in plugin_state.requests
+        if request.get_method() == 'POST'
+    ]
+    assert len(posts) == 2
+    usage = json.loads(posts[0].data)['request']
+    assert usage[0]['resourceUri'] == '/subscriptions/sub/resource'
+    assert usage[0]['planId'] == 'foobar'
+    assert posts[0].get_header('Authorization') == 'Bearer 123456789'
+
+
+@patch.dict(
+    os.environ,
+    {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'bar', 'CLIENT_ID': 'client'}
+)
+def test_meter_billing_refreshes_token(plugin_state):
+    """Test a rejected token is refreshed once"""
+    rejected = []
+
+    def handler(request):
+        if request.get_method() == 'POST' and not rejected:
+            rejected.append(request)
+            return 401, {}
+        return _imds(request)
+
+    plugin_state.handler = handler
+    status = asyncio.run(aio.meter_billing(
+        config,
+        {'tier_1': 1},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    ))
+
+    assert status == {
+        'tier_1': {'record_id': 'id-tier_1', 'status': 'submitted'}
+    }
+    tokens = [
+        request for request in plugin_state.requests
+        if 'oauth2/token' in request.full_url
+    ]
+    assert len(tokens) == 2
+
+
+@patch.dict(
+    os.environ,
+    {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'bar', 'CLIENT_ID': 'client'}
+)
+def test_meter_billing_failure(plugin_state):
+    """Test a failed batch reports its dimensions as failed"""
+    plugin._retry_policy = retry.RetryPolicy(attempts=1)
+    plugin_state.handler = lambda request: (
+        (400, {}) if request.get_method() == 'POST' else _imds(request)
+    )
+
+    status = asyncio.run(aio.meter_billing(
+        config,
+        {'tier_1': 1},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    ))
+    assert status['tier_1']['status'] == 'failed'
+
+
+@patch.dict(
+    os.environ,
+    {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'bar', 'CLIENT_ID': 'client'}
+)
+def test_meter_billing_deadline_exceeded(plugin_state):
+    plugin._billing_deadline = 0
+
+    status = asyncio.run(aio.meter_billing(
+        config,
+        {'tier_1': 1},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    ))
+    assert status['tier_1']['status'] == 'failed'
+    assert 'Deadline exceeded' in status['tier_1']['error']
+
+
+@patch.dict(
+    os.environ,
+    {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'bar', 'CLIENT_ID': 'client'}
+)
+def test_meter_billing_deadline_keeps_accepted(plugin_state):
+    """Test accepted usage is reported when the deadline stops retries"""
+    def _throttle_tier_2(request):
+        code, response = _imds(request)
+        for result in response.get('result', []):
+            if result['dimension'] == 'tier_2':
+                result['status'] = 'Error'
+                result['error'] = {'code': 'TooManyRequests'}
+        return code, response
+
+    plugin_state.handler = _throttle_tier_2
+    plugin._billing_deadline = 1
+    plugin._retry_policy = retry.RetryPolicy(backoff=5)
+
+    status = asyncio.run(aio.meter_billing(
+        config,
+        {'tier_1': 1, 'tier_2': 2},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    ))
+    assert status['tier_1'] == {
+        'record_id': 'id-tier_1',
+        'status': 'submitted'
+    }
+    assert status['tier_2']['status'] == 'failed'
+    assert 'Deadline exceeded' in status['tier_2']['error']
+
+
+@patch.dict(
+    os.environ,
+    {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'bar', 'CLIENT_ID': 'client'}
+)
+def test_file_io_off_event_loop(plugin_state, tmp_path):
+    """Test the outbox and the disk cache are not used from the loop"""
+    threads = set()
+
+    def _record(func):
+        def _call(*args, **kwargs):
+            threads.add(threading.get_ident())
+            return func(*args, **kwargs)
+        return _call
+
+    plugin._outbox = outbox.Outbox(str(tmp_path / 'outbox'))
+    plugin._outbox.add([{
+        'resourceUri': 'foo',
+        'quantity': 1,
+        'dimension': 'tier_2',
+        'effectiveStartTime': idempotency.get_hour_bucket(
+            datetime.datetime.now(datetime.timezone.utc)
+        ),
+        'planId': 'bar'
+    }])
+    plugin._disk_cache = disk_cache.DiskCache(str(tmp_path / 'cache'))
+    for name in ('add', 'ack', '_scan', '_read_events'):
+        setattr(
+            plugin._outbox,
+            name,
+            _record(getattr(plugin._outbox, name))
+        )
+    for name in ('get', 'set', 'delete'):
+        setattr(
+            plugin._disk_cache,
+            name,
+            _record(getattr(plugin._disk_cache, name))
+        )
+
+    async def _run():
+        status = await aio.meter_billing(
+            config,
+            {'tier_1': 1},
+            datetime.datetime.now(datetime.timezone.utc),
+            dry_run=False
+        )
+        await aio.get_account_info(config)
+        return status
+
+    try:
+        status = asyncio.run(_run())
+    finally:
+        plugin._outbox = None
+        plugin._disk_cache = None
+
+    assert status['tier_1']['status'] == 'submitted'
+    assert len(plugin_state.requests) == 5
+    assert threads
+    assert threading.get_ident() not in threads
+
+
+def test_get_msi_token_concurrent(plugin_state):
+    """Test concurrent tasks share one token request"""
+    async def run():
+        return await asyncio.gather(
+            *(aio._get_msi_token({'api': 'foo'}) for _ in range(4))
+        )
+
+    assert asyncio.run(run()) == ['Bearer 123456789'] * 4
+    assert len(plugin_state.requests) == 1
+    assert plugin._get_msi_token({'api': 'foo'}) == 'Bearer 123456789'
+
+
+def test_get_managed_identity(plugin_state):
+    assert asyncio.run(aio._get_managed_identity()) == {
+        'managedBy': '/subscriptions/sub/resource'
+    }
+
+    plugin._metadata_cache.clear()
+    plugin_state.handler = lambda request: (200, {'compute': {}})
+    with pytest.raises(plugin.cba_exceptions.CSPMetadataRetrievalError):
+        asyncio.run(aio._get_managed_identity())
+
+
+@patch.dict(os.environ, {'CLIENT_ID': 'client'})
+def test_meter_billing_bulk(plugin_state):
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = asyncio.run(aio.meter_billing_bulk(config, [
+        ('/a', 'plan', {'tier_1': 1, 'tier_2': 2}, timestamp),
+        ('/b', 'plan', {'tier_1': 1}, timestamp)
+    ]))
+
+    hour = idempotency.get_hour_bucket(timestamp)
+    assert status == {
+        '/a': {
+            'tier_1': {
+                hour: {'record_id': 'id-tier_1', 'status': 'submitted'}
+            },
+            'tier_2': {
+                hour: {'record_id': 'id-tier_2', 'status': 'submitted'}
+            }
+        },
+        '/b': {
+            'tier_1': {
+                hour: {'record_id': 'id-tier_1', 'status': 'submitted'}
+            }
+        }
+    }
+    posts = [
+        request for request in plugin_state.requests
+        if request.get_method() == 'POST'
+    ]
+    assert len(posts) == 1
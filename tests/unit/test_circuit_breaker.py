@@ -0,0 +1,126 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import pytest
+import urllib.error
+
+from unittest.mock import patch
+
+from csp_billing_adapter_microsoft import circuit_breaker, retry
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with patch.object(circuit_breaker, 'time', clock):
+        yield clock
+
+
+def test_opens_on_failure_rate(clock):
+    breaker = circuit_breaker.CircuitBreaker(
+        'imds',
+        failure_rate=0.5,
+        minimum_calls=4
+    )
+
+    breaker.on_success()
+    breaker.on_failure()
+    breaker.on_success()
+    assert breaker.state == circuit_breaker.CLOSED
+
+    breaker.on_failure()
+    assert breaker.state == circuit_breaker.OPEN
+
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_window_forgets_old_calls(clock):
+    breaker = circuit_breaker.CircuitBreaker(
+        'imds',
+        minimum_calls=2,
+        window=10
+    )
+
+    breaker.on_failure()
+    clock.now += 11
+    breaker.on_failure()
+    assert breaker.state == circuit_breaker.CLOSED
+    assert breaker.get_state()['calls'] == 1
+
+
+def test_half_open_trial(clock):
+    """Test a single trial is let through once the timeout passed"""
+    breaker = circuit_breaker.CircuitBreaker(
+        'marketplace',
+        minimum_calls=1,
+        reset_timeout=30
+    )
+    breaker.on_failure()
+    assert breaker.get_state()['retry_in'] == 30
+
+    clock.now += 30
+    breaker.before_call()
+    assert breaker.state == circuit_breaker.HALF_OPEN
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        breaker.before_call()
+
+    # A failed trial opens the circuit again
+    breaker.on_failure()
+    assert breaker.state == circuit_breaker.OPEN
+
+    clock.now += 30
+    breaker.before_call()
+    breaker.on_success()
+    assert breaker.get_state() == {
+        'state': circuit_breaker.CLOSED,
+        'calls': 0,
+        'failures': 0,
+        'retry_in': 0
+    }
+
+
+def test_aborted_trial(clock):
+    breaker = circuit_breaker.CircuitBreaker('arm', minimum_calls=1)
+    breaker.on_failure()
+    clock.now += breaker.reset_timeout
+
+    breaker.before_call()
+    breaker.on_abort()
+    breaker.before_call()
+    assert breaker.state == circuit_breaker.HALF_OPEN
+
+
+def test_is_failure():
+    assert circuit_breaker.is_failure(urllib.error.URLError('reset'))
+    assert circuit_breaker.is_failure(
+        urllib.error.HTTPError('url', 503, 'Unavailable', {}, None)
+    )
+    assert not circuit_breaker.is_failure(
+        urllib.error.HTTPError('url', 429, 'Too Many Requests', {}, None)
+    )
+
+
+def test_open_circuit_is_not_retried():
+    assert not retry.is_retriable(circuit_breaker.CircuitOpenError('open'))
@@ -0,0 +1,77 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import time
+
+from unittest.mock import patch
+
+from csp_billing_adapter_microsoft.disk_cache import DiskCache
+
+
+def test_set_get(tmp_path):
+    """Test a value is read back with its expiry time"""
+    cache = DiskCache(str(tmp_path / 'cache'))
+    cache.set('entry', {'a': 1}, 60)
+
+    value, expires_at = cache.get('entry')
+    assert value == {'a': 1}
+    assert time.time() < expires_at <= time.time() + 60
+    assert cache.get('missing') is None
+
+    # Only the entry is left, no temporary files
+    assert len(os.listdir(tmp_path / 'cache')) == 1
+
+
+def test_expired(tmp_path):
+    """Test expired entries and entries without a TTL are missing"""
+    cache = DiskCache(str(tmp_path))
+    cache.set('entry', 'value', 60)
+    cache.set('no ttl', 'value', 0)
+
+    with patch('time.time', return_value=time.time() + 61):
+        assert cache.get('entry') is None
+    assert cache.get('no ttl') is None
+
+
+def test_corrupt(tmp_path, caplog):
+    """Test corrupt entries are ignored"""
+    cache = DiskCache(str(tmp_path))
+    cache.set('entry', 'value', 60)
+    with open(cache._get_path('entry'), 'w') as entry_file:
+        entry_file.write('{"expires_at": ')
+
+    assert cache.get('entry') is None
+    assert 'Ignoring corrupt cache entry' in caplog.text
+
+
+def test_delete(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.set('entry', 'value', 60)
+    cache.delete('entry')
+    cache.delete('entry')
+
+    assert cache.get('entry') is None
+
+
+def test_set_error(tmp_path, caplog):
+    """Test write errors are logged"""
+    path = tmp_path / 'file'
+    path.write_text('')
+    cache = DiskCache(str(path))
+    cache.set('entry', 'value', 60)
+
+    assert 'Unable to write cache entry' in caplog.text
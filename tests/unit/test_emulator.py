@@ -0,0 +1,273 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import pytest
+import random
+import time
+
+from unittest.mock import patch
+
+from csp_billing_adapter_microsoft import aio, emulator, plugin, transport
+from csp_billing_adapter.config import Config
+from csp_billing_adapter.adapter import get_plugin_manager
+
+
+pm = get_plugin_manager()
+config = Config.load_from_file(
+    'tests/data/good_config.yaml',
+    pm.hook
+)
+
+
+@pytest.fixture
+def azure():
+    with emulator.Emulator(seed=1) as server:
+        yield server
+
+
+def _setup(server, **settings):
+    """Configure the plugin to use the emulator."""
+    emulated = dict(config)
+    emulated['microsoft'] = dict(
+        server.get_settings(),
+        retry_backoff=0,
+        **settings
+    )
+    plugin._configure(emulated)
+    plugin._token_cache.clear()
+    plugin._metering_context.clear()
+    plugin._metadata_cache.clear()
+    plugin._accepted_index.clear()
+    plugin._compute_fingerprint = None
+    return emulated
+
+
+@pytest.fixture(autouse=True)
+def reset_plugin():
+    yield
+    plugin._configure({})
+    transport.set_transport(transport.UrllibTransport())
+    plugin._token_cache.clear()
+    plugin._metering_context.clear()
+    plugin._metadata_cache.clear()
+    plugin._accepted_index.clear()
+
+
+def test_setup_and_account_info(azure):
+    emulated = _setup(azure)
+    plugin.setup_adapter(emulated)
+
+    info = plugin.get_account_info(emulated)
+    assert info['compute']['subscriptionId'] == 'sub'
+    assert info['attestedData']['encoding'] == 'pkcs7'
+    assert azure.requests['versions'] == 1
+
+
+@patch.dict(os.environ, {'CLIENT_ID': 'client'})
+def test_meter_billing(azure):
+    """Test the VM flow resolves the resource before submitting usage"""
+    emulated = _setup(azure)
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(
+        emulated,
+        {'tier_1': 10, 'tier_2': 5},
+        timestamp,
+        dry_run=False
+    )
+
+    assert {value['status'] for value in status.values()} == {'submitted'}
+    assert azure.requests['arm'] == 1
+    assert azure.requests['marketplace'] == 1
+    assert set(key[0] for key in azure.accepted) == {azure.managed_by}
+
+    # The marketplace rejects the same usage for the same hour
+    plugin._accepted_index.clear()
+    again = plugin.meter_billing(emulated, {'tier_1': 10}, timestamp, False)
+    assert again['tier_1']['record_id'] == status['tier_1']['record_id']
+
+
+@patch.dict(os.environ, {'CLIENT_ID': 'client'})
+def test_meter_billing_throttled(azure):
+    azure.behaviors['marketplace'] = emulator.Behavior(
+        throttle_rate=1,
+        retry_after=0
+    )
+    emulated = _setup(azure, retry_attempts=2)
+
+    status = plugin.meter_billing(
+        emulated,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status['tier_1']['status'] == 'failed'
+    assert 'Too Many Requests' in status['tier_1']['error']
+    assert azure.requests['marketplace'] == 2
+
+
+@patch.dict(os.environ, {
+    'EXTENSION_RESOURCE_ID': 'foo',
+    'PLAN_ID': 'bar',
+    'CLIENT_ID': 'client'
+})
+def test_meter_billing_duplicates(azure):
+    azure.behaviors['marketplace'] = emulator.Behavior(duplicate_rate=1)
+    emulated = _setup(azure)
+
+    status = plugin.meter_billing(
+        emulated,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status['tier_1'] == {
+        'record_id': azure.accepted[next(iter(azure.accepted))],
+        'status': 'submitted'
+    }
+
+
+def test_connection_reset(azure):
+    """Test reset connections are retried and then reported"""
+    azure.behaviors['instance'] = emulator.Behavior(reset_rate=1)
+    azure.behaviors['attested'] = emulator.Behavior(
+        error_rate=1,
+        error_status=500
+    )
+    emulated = _setup(azure, retry_attempts=2)
+
+    info = plugin.get_account_info(emulated)
+
+    assert info == {'attestedData': {}, 'cloud_provider': 'microsoft'}
+    # A reset on a reused connection is resent once by the transport
+    assert azure.requests['instance'] >= 2
+    assert azure.requests['attested'] == 2
+
+
+def test_latency(azure):
+    azure.behaviors['versions'] = emulator.Behavior(
+        latency=emulator.fixed(0.05)
+    )
+    _setup(azure)
+
+    start = time.monotonic()
+    assert plugin._is_required_metadata_version_available()
+    assert time.monotonic() - start >= 0.05
+
+
+def test_metadata_header_required(azure):
+    request = transport.urllib.request.Request(
+        f'{azure.url}/metadata/instance'
+    )
+    with pytest.raises(transport.urllib.error.HTTPError) as error:
+        transport.UrllibTransport().open(request)
+    assert error.value.code == 400
+
+
+def test_latency_distributions():
+    rng = random.Random(1)
+    assert emulator.fixed(0.1)(rng) == 0.1
+    assert 0.1 <= emulator.uniform(0.1, 0.2)(rng) <= 0.2
+    assert emulator.exponential(0.1)(rng) >= 0
+    assert emulator.lognormal(0.1, 0.5)(rng) > 0
+
+    assert emulator._parse_latency('fixed:0.5')(rng) == 0.5
+    with pytest.raises(argparse.ArgumentTypeError):
+        emulator._parse_latency('normal:1')
+
+
+@patch.dict(os.environ, {'CLIENT_ID': 'client'})
+def test_metrics(azure):
+    azure.behaviors['marketplace'] = emulator.Behavior(error_rate=0.5)
+    emulated = _setup(azure, metrics=True, retry_attempts=10)
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    for hour in range(3):
+        plugin.meter_billing(
+            emulated,
+            {'tier_1': 10},
+            timestamp - datetime.timedelta(hours=hour),
+            dry_run=False
+        )
+
+    metrics = plugin.get_metrics()
+    # The resource group lookup uses a token of the VM identity
+    assert metrics['cache_hit_ratios']['token'] == 0.5
+    assert metrics['cache_hit_ratios']['metering_context'] == (
+        pytest.approx(2 / 3)
+    )
+
+    text = plugin.render_metrics()
+    sent = azure.requests['marketplace']
+    prefix = 'csp_billing_adapter_microsoft_'
+    assert (
+        f'{prefix}retries_total{{endpoint="marketplace",'
+        f'operation="batch_usage"}} {sent - 3}'
+    ) in text
+    assert (
+        f'{prefix}request_duration_seconds_count{{endpoint="imds",'
+        f'operation="token"}} 2'
+    ) in text
+    assert f'{prefix}usage_events_total{{status="Accepted"}} 3' in text
+
+
+def test_metrics_disabled(azure):
+    _setup(azure)
+    assert plugin.get_metrics() is None
+    assert plugin.render_metrics() == ''
+
+
+@patch.dict(os.environ, {'CLIENT_ID': 'client'})
+def test_profiling(azure, tmp_path):
+    emulated = _setup(
+        azure,
+        profiling={
+            'directory': str(tmp_path),
+            'interval': 3,
+            'memory_frames': 0
+        }
+    )
+
+    plugin.get_account_info(emulated)
+    asyncio.run(aio.get_account_info(emulated))
+    plugin.meter_billing(
+        emulated,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    with open(tmp_path / f'profile-{os.getpid()}-0001.json') as report:
+        functions = json.load(report)['functions']
+    assert functions['get_account_info']['calls'] == 2
+    assert set(functions) == {
+        'get_account_info',
+        'meter_billing',
+        '_create_usage_list',
+        '_create_status_dict'
+    }
+
+    # Disabling profiling restores the functions
+    plugin._configure({})
+    assert not hasattr(plugin._meter_billing, '__wrapped__')
+    assert not hasattr(aio._get_metadata, '__wrapped__')
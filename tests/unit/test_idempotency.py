@@ -0,0 +1,68 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from datetime import datetime, timedelta, timezone
+
+from csp_billing_adapter_microsoft import idempotency
+
+
+def _event(dimension, start):
+    return {
+        'resourceUri': 'foo',
+        'planId': 'bar',
+        'dimension': dimension,
+        'quantity': 1,
+        'effectiveStartTime': str(start)
+    }
+
+
+def test_get_hour_bucket():
+    assert idempotency.get_hour_bucket(
+        datetime(2024, 1, 1, 10, 42, 7, 12, tzinfo=timezone.utc)
+    ) == '2024-01-01T10:00:00Z'
+    assert idempotency.get_hour_bucket(
+        '2024-01-01 12:42:07+02:00'
+    ) == '2024-01-01T10:00:00Z'
+    assert idempotency.get_hour_bucket(
+        '2024-01-01T10:59:59'
+    ) == '2024-01-01T10:00:00Z'
+    assert idempotency.get_hour_bucket(
+        '2024-01-01T10:59:59Z'
+    ) == '2024-01-01T10:00:00Z'
+    assert idempotency.get_hour_bucket('yesterday') == 'yesterday'
+
+
+def test_accepted_index_same_hour():
+    index = idempotency.AcceptedIndex()
+    now = datetime.now(timezone.utc).replace(minute=5)
+    index.add(_event('tier_1', now), '1000')
+
+    assert index.get(_event('tier_1', now.replace(minute=55))) == '1000'
+    assert index.get(_event('tier_2', now)) is None
+    assert index.get(_event('tier_1', now + timedelta(hours=1))) is None
+
+
+def test_accepted_index_eviction():
+    index = idempotency.AcceptedIndex()
+    now = datetime.now(timezone.utc)
+    index.add(_event('tier_1', now - timedelta(hours=30)), '1000')
+    index.add(_event('tier_2', now), '1001')
+
+    assert len(index) == 1
+    assert index.get(_event('tier_2', now)) == '1001'
+
+    index.clear()
+    assert len(index) == 0
@@ -0,0 +1,141 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import pytest
+import urllib.error
+import urllib.request
+
+from csp_billing_adapter_microsoft import circuit_breaker, metrics, transport
+
+
+def _response():
+    return transport.Response('url', 200, 'OK', {}, b'{}')
+
+
+def test_render():
+    registry = metrics.Registry()
+    counter = registry.counter('requests_total', 'Requests', ('status',))
+    gauge = registry.gauge('rate', 'Rate')
+    histogram = registry.histogram(
+        'duration_seconds',
+        'Duration',
+        ('endpoint',),
+        buckets=(0.1, 1)
+    )
+    registry.add_collector(lambda: gauge.set(value=2.5))
+
+    counter.inc('200')
+    counter.inc('200')
+    counter.inc('say "hi"\n')
+    histogram.observe('imds', value=0.05)
+    histogram.observe('imds', value=0.5)
+
+    assert registry.render() == (
+        '# HELP requests_total Requests\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{status="200"} 2\n'
+        'requests_total{status="say \\"hi\\"\\n"} 1\n'
+        '# HELP rate Rate\n'
+        '# TYPE rate gauge\n'
+        'rate 2.5\n'
+        '# HELP duration_seconds Duration\n'
+        '# TYPE duration_seconds histogram\n'
+        'duration_seconds_bucket{endpoint="imds",le="0.1"} 1\n'
+        'duration_seconds_bucket{endpoint="imds",le="1"} 2\n'
+        'duration_seconds_bucket{endpoint="imds",le="+Inf"} 2\n'
+        'duration_seconds_sum{endpoint="imds"} 0.55\n'
+        'duration_seconds_count{endpoint="imds"} 2\n'
+    )
+
+
+def test_snapshot():
+    registry = metrics.Registry()
+    histogram = registry.histogram('duration', 'Duration', buckets=(1,))
+    histogram.observe(value=2)
+
+    assert registry.snapshot() == {
+        'duration': {
+            'type': 'histogram',
+            'help': 'Duration',
+            'samples': [{
+                'labels': {},
+                'value': {
+                    'count': 1,
+                    'sum': 2,
+                    'buckets': {'1': 0, '+Inf': 1}
+                }
+            }]
+        }
+    }
+
+
+def test_duplicate_metric():
+    registry = metrics.Registry()
+    registry.counter('requests_total', 'Requests')
+    with pytest.raises(ValueError):
+        registry.gauge('requests_total', 'Requests')
+
+
+def test_call_records_status_and_retries():
+    plugin_metrics = metrics.Metrics()
+    request = urllib.request.Request('http://localhost/metadata/instance')
+
+    def _fail():
+        raise urllib.error.HTTPError('url', 503, 'Unavailable', {}, None)
+
+    with pytest.raises(urllib.error.HTTPError):
+        plugin_metrics.call('imds', 'instance', request, _fail)
+    plugin_metrics.call('imds', 'instance', request, _response)
+
+    requests = plugin_metrics.requests
+    assert requests.get('imds', 'instance', '503') == 1
+    assert requests.get('imds', 'instance', '200') == 1
+    assert plugin_metrics.retries.get('imds', 'instance') == 1
+    assert plugin_metrics.request_duration.snapshot()['samples'][0][
+        'value'
+    ]['count'] == 2
+
+
+def test_call_async_circuit_open():
+    plugin_metrics = metrics.Metrics()
+    request = urllib.request.Request('http://localhost/api')
+
+    async def _refused():
+        raise circuit_breaker.CircuitOpenError('open')
+
+    async def _open():
+        return _response()
+
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        asyncio.run(plugin_metrics.call_async('arm', 'x', request, _refused))
+    asyncio.run(plugin_metrics.call_async('arm', 'x', request, _open))
+
+    assert plugin_metrics.requests.get('arm', 'x', 'circuit_open') == 1
+    assert plugin_metrics.requests.get('arm', 'x', '200') == 1
+
+
+def test_cache_hit_ratios():
+    plugin_metrics = metrics.Metrics()
+    plugin_metrics.record_cache('token', True)
+    plugin_metrics.record_cache('token', True)
+    plugin_metrics.record_cache('token', False)
+    plugin_metrics.record_cache('instance', False)
+
+    assert plugin_metrics.get_cache_hit_ratios() == {
+        'instance': 0,
+        'token': pytest.approx(2 / 3)
+    }
@@ -0,0 +1,118 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import stat
+
+from csp_billing_adapter_microsoft import outbox
+
+
+def _event(dimension, hour='2024-01-01 10:00:00+00:00'):
+    return {
+        'resourceUri': 'foo',
+        'quantity': 1,
+        'dimension': dimension,
+        'effectiveStartTime': hour,
+        'planId': 'bar'
+    }
+
+
+def _pending(box, batch_size=100):
+    return [
+        event
+        for batch in box.iter_pending(batch_size)
+        for event in batch
+    ]
+
+
+def test_outbox_add_and_ack(tmp_path):
+    box = outbox.Outbox(str(tmp_path / 'outbox'))
+    assert _pending(box) == []
+
+    box.add([_event('tier_1'), _event('tier_2'), _event('tier_3')])
+    box.ack([_event('tier_2')])
+
+    assert _pending(box) == [_event('tier_1'), _event('tier_3')]
+    assert stat.S_IMODE(os.stat(tmp_path / 'outbox').st_mode) == 0o600
+
+
+def test_outbox_survives_restart(tmp_path):
+    path = str(tmp_path / 'outbox')
+    outbox.Outbox(path).add([_event('tier_1'), _event('tier_2')])
+    outbox.Outbox(path).ack([_event('tier_1')])
+
+    assert _pending(outbox.Outbox(path)) == [_event('tier_2')]
+
+
+def test_outbox_re_add_is_pending_once(tmp_path):
+    box = outbox.Outbox(str(tmp_path / 'outbox'))
+    box.add([_event('tier_1')])
+    box.add([dict(_event('tier_1', '2024-01-01T10:30:00Z'), quantity=2)])
+
+    # Events of the same hour have the same key, the last one is pending
+    assert _pending(box) == [
+        dict(_event('tier_1', '2024-01-01T10:30:00Z'), quantity=2)
+    ]
+
+
+def test_outbox_batches(tmp_path):
+    box = outbox.Outbox(str(tmp_path / 'outbox'))
+    box.add([_event(f'dim_{index}') for index in range(2500)])
+
+    batches = list(box.iter_pending(1000))
+    assert [len(batch) for batch in batches] == [1000, 1000, 500]
+    assert batches[0][0] == _event('dim_0')
+
+
+def test_outbox_skips_torn_record(tmp_path):
+    path = tmp_path / 'outbox'
+    box = outbox.Outbox(str(path))
+    box.add([_event('tier_1')])
+    with open(path, 'a') as log_file:
+        log_file.write('{"op": "add", "key": "foo|b')
+
+    assert _pending(box) == [_event('tier_1')]
+
+
+def test_outbox_compaction(tmp_path):
+    path = tmp_path / 'outbox'
+    box = outbox.Outbox(str(path), compact_threshold=3)
+    events = [_event(f'dim_{index}') for index in range(5)]
+    box.add(events)
+    box.ack(events[:2])
+    assert len(path.read_text().splitlines()) == 7
+
+    # The third acknowledgement triggers the compaction
+    box.ack(events[2:3])
+    assert len(path.read_text().splitlines()) == 2
+    assert _pending(box) == events[3:]
+    assert not os.path.exists(f'{path}.tmp')
+
+
+def test_outbox_no_compaction_while_reading(tmp_path):
+    path = tmp_path / 'outbox'
+    box = outbox.Outbox(str(path), compact_threshold=1)
+    events = [_event(f'dim_{index}') for index in range(4)]
+    box.add(events)
+
+    pending = box.iter_pending(1)
+    assert next(pending) == [events[0]]
+    box.ack(events[:1])
+    assert next(pending) == [events[1]]
+    pending.close()
+
+    box.compact()
+    assert len(path.read_text().splitlines()) == 3
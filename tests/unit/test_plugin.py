@@ -14,16 +14,31 @@
 # limitations under the License.
 #
 
+import base64
 import datetime
 import json
 import logging
 import os
 import pytest
+import threading
+import time
 import urllib.error
+import urllib.request
 
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import Mock, MagicMock, patch
 
-from csp_billing_adapter_microsoft import plugin
+from csp_billing_adapter_microsoft import (
+    disk_cache,
+    idempotency,
+    outbox,
+    plugin,
+    rate_limit,
+    retry,
+    tracing,
+    token_store,
+    transport
+)
 from csp_billing_adapter.config import Config
 from csp_billing_adapter.adapter import get_plugin_manager
 import csp_billing_adapter.exceptions as cba_exceptions
@@ -36,13 +51,92 @@ config = Config.load_from_file(
 )
 
 
+@pytest.fixture(autouse=True)
+def clear_plugin_caches():
+    plugin._token_cache.clear()
+    plugin._metering_context.clear()
+    plugin._metadata_cache.clear()
+    plugin._compute_fingerprint = None
+    plugin._instance_metadata_ttl = plugin.DEFAULT_INSTANCE_METADATA_TTL
+    plugin._attested_data_ttl = plugin.DEFAULT_ATTESTED_DATA_TTL
+    transport.set_transport(transport.UrllibTransport())
+    plugin._retry_policy = retry.RetryPolicy(backoff=0)
+    plugin._timeouts = dict(plugin.DEFAULT_TIMEOUTS)
+    plugin._billing_deadline = plugin.DEFAULT_BILLING_DEADLINE
+    plugin._batch_size = plugin.MAX_BATCH_SIZE
+    plugin._batch_workers = plugin.DEFAULT_BATCH_WORKERS
+    plugin._outbox = None
+    plugin._accepted_index.clear()
+    plugin._disk_cache = None
+    plugin._token_store = None
+    plugin._merge_policies = {}
+    plugin._rate_limiter = None
+    plugin._circuit_breakers = {}
+    plugin._metrics = None
+    plugin.set_trace_exporter(None)
+    plugin.set_profiler(None)
+    yield
+    plugin._disk_cache = None
+    plugin._token_store = None
+    plugin._outbox = None
+    plugin._accepted_index.clear()
+    plugin._token_cache.clear()
+    plugin._metering_context.clear()
+
+
 @patch(
     'csp_billing_adapter_microsoft.plugin.'
     '_is_required_metadata_version_available'
 )
 def test_setup(mock_check_metadata_version):
     mock_check_metadata_version.return_value = True
-    plugin.setup_adapter(config)  # Currently no-op
+    config_pool = dict(config)
+    config_pool['microsoft'] = {
+        'connection_pool_size': 2,
+        'connection_idle_timeout': 30,
+        'retry_attempts': 5,
+        'retry_backoff': 0.5,
+        'timeouts': {'marketplace': {'read': 60}},
+        'billing_deadline': 300,
+        'batch_size': 100,
+        'batch_workers': 8,
+        'outbox_path': '/var/lib/csp-billing-adapter/outbox',
+        'instance_metadata_ttl': 600,
+        'attested_data_ttl': 120,
+        'cache_dir': '/var/cache/csp-billing-adapter',
+        'token_store_path': '/run/csp-billing-adapter/tokens',
+        'merge_policies': {'tier_1': 'max'},
+        'marketplace_rate_limit': 5,
+        'marketplace_burst': 10,
+        'circuit_breaker': {'minimum_calls': 10},
+        'metrics': True
+    }
+    plugin.setup_adapter(config_pool)
+
+    assert plugin._timeouts['marketplace'] == transport.Timeout(5, 60)
+    assert plugin._timeouts['imds'] == plugin.DEFAULT_TIMEOUTS['imds']
+    assert plugin._billing_deadline == 300
+    assert plugin._batch_size == plugin.MAX_BATCH_SIZE
+    assert plugin._batch_workers == 8
+    assert plugin._outbox.path == '/var/lib/csp-billing-adapter/outbox'
+    assert plugin._instance_metadata_ttl == 600
+    assert plugin._attested_data_ttl == 120
+    assert plugin._disk_cache.directory == '/var/cache/csp-billing-adapter'
+    assert plugin._token_store.path == '/run/csp-billing-adapter/tokens'
+    assert plugin._merge_policies == {'tier_1': 'max'}
+    assert plugin.get_rate_limit_state()['max_rate'] == 5
+    assert plugin.get_rate_limit_state()['burst'] == 10
+    assert set(plugin.get_circuit_state()) == {'imds', 'arm', 'marketplace'}
+    assert plugin._circuit_breakers['arm'].minimum_calls == 10
+    assert 'circuit_open{endpoint="arm"} 0' in plugin.render_metrics()
+
+    assert plugin._retry_policy.attempts == 5
+    assert plugin._retry_policy.backoff == 0.5
+
+    pooled = transport.get_transport()
+    assert isinstance(pooled, transport.PooledTransport)
+    assert pooled.pool_size == 2
+    assert pooled.idle_timeout == 30
 
 
 @patch(
@@ -180,7 +274,7 @@ def test_meter_billing_non_accepted_status_from_batchUsageEvent(
     mock_get_msi_token,
     caplog
 ):
-    """Test for a non accepted status"""
+    """Test a duplicate is reported as submitted"""
     urlopen = MagicMock()
     urlopen.read.side_effect = [
         json.dumps({
@@ -217,6 +311,7 @@ def test_meter_billing_non_accepted_status_from_batchUsageEvent(
     urlopen.__enter__.return_value = urlopen
     mock_urlopen.return_value = urlopen
 
+    caplog.set_level(logging.INFO)
     dimensions = {'tier_1': 10, 'tier_2': 5}
     timestamp = datetime.datetime.now(datetime.timezone.utc)
 
@@ -227,13 +322,11 @@ def test_meter_billing_non_accepted_status_from_batchUsageEvent(
         timestamp,
         dry_run=False
     )
-    assert test_record["tier_1"].get("record_id") is None
-    assert test_record["tier_1"].get("status") == 'failed'
-    assert test_record["tier_1"].get("error") == (
-        'Failed to meter bill dimensions: Status: '
-        'Duplicate Message: This usage event already exist.'
-    )
-    assert "Unable to log metered billing record" in caplog.records[0].msg
+    assert test_record["tier_1"] == {
+        "record_id": "1000",
+        "status": "submitted"
+    }
+    assert "Metered billing record already added" in caplog.records[0].msg
 
 
 # @patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
@@ -246,7 +339,7 @@ def test_meter_billing_non_accepted_status_from_batchUsageEvent_vm(
     mock_get_resource_uri,
     caplog
 ):
-    """Test for a non accepted status on VM"""
+    """Test a duplicate is reported as submitted on VM"""
     mock_get_resource_uri.return_value = "super_resource_id"
     urlopen = MagicMock()
     urlopen.read.side_effect = [
@@ -284,6 +377,7 @@ def test_meter_billing_non_accepted_status_from_batchUsageEvent_vm(
     urlopen.__enter__.return_value = urlopen
     mock_urlopen.return_value = urlopen
 
+    caplog.set_level(logging.INFO)
     dimensions = {'tier_1': 10, 'tier_2': 5}
     timestamp = datetime.datetime.now(datetime.timezone.utc)
 
@@ -294,13 +388,11 @@ def test_meter_billing_non_accepted_status_from_batchUsageEvent_vm(
         timestamp,
         dry_run=False
     )
-    assert test_record["tier_1"].get("record_id") is None
-    assert test_record["tier_1"].get("status") == 'failed'
-    assert test_record["tier_1"].get("error") == (
-        'Failed to meter bill dimensions: Status: '
-        'Duplicate Message: This usage event already exist.'
-    )
-    assert "Unable to log metered billing record" in caplog.records[0].msg
+    assert test_record["tier_1"] == {
+        "record_id": "1000",
+        "status": "submitted"
+    }
+    assert "Metered billing record already added" in caplog.records[0].msg
 
 
 @patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
@@ -372,13 +464,22 @@ def test_get_csp_name():
 @patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
 def test_get_account_info(mock_urlopen):
     """Test getting account info"""
-    urlopen = MagicMock()
-    urlopen.read.side_effect = [
-        b'{"compute": "info", "network": "info"}',
-        b'{"signature": "signature", "pkcs7": "pkcs7"}'
-    ]
-    urlopen.__enter__.return_value = urlopen
-    mock_urlopen.return_value = urlopen
+    documents = {
+        'instance': b'{"compute": "info", "network": "info"}',
+        'attested': b'{"signature": "signature", "pkcs7": "pkcs7"}'
+    }
+
+    def _urlopen(request, timeout=None):
+        # Both documents are requested concurrently, answer by url
+        urlopen = MagicMock()
+        urlopen.__enter__.return_value = urlopen
+        urlopen.read.return_value = next(
+            document for name, document in documents.items()
+            if name in request.full_url
+        )
+        return urlopen
+
+    mock_urlopen.side_effect = _urlopen
 
     info = plugin.get_account_info(config)
     assert info == {
@@ -393,14 +494,13 @@ def test_get_account_info(mock_urlopen):
 def test_fetch_metadata_fail(mock_urlopen):
     """Test unable to reach metadata service"""
     urlopen = MagicMock()
-    urlopen.read.side_effect = [
-        urllib.error.URLError('Cannot get metadata!')
-    ]
+    urlopen.read.side_effect = urllib.error.URLError('Cannot get metadata!')
     urlopen.__enter__.return_value = urlopen
     mock_urlopen.return_value = urlopen
 
     metadata = plugin._fetch_metadata('http://foo.abc.org')
     assert metadata == "{}"
+    assert mock_urlopen.call_count == 3
 
 
 @patch('csp_billing_adapter_microsoft.plugin._get_instance_metadata')
@@ -633,9 +733,9 @@ def test_get_managed_identity_request_failed(
     }
     mock_get_msi_token.return_value = "Bearer 123456789"
     urlopen = MagicMock()
-    urlopen.read.side_effect = [
-        urllib.error.URLError('Cannot get managed_identity!')
-    ]
+    urlopen.read.side_effect = urllib.error.URLError(
+        'Cannot get managed_identity!'
+    )
     urlopen.__enter__.return_value = urlopen
     mock_urlopen.return_value = urlopen
     assert plugin._get_managed_identity() == {}
@@ -666,3 +766,1547 @@ def test_get_resource_uri_error(
         'missing managedBy'
     )
     assert message in caplog.records[0].msg
+
+
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_msi_token_cached(mock_urlopen):
+    """Test a valid token is reused until it nears expiry"""
+    urlopen = MagicMock()
+    urlopen.read.side_effect = [
+        json.dumps({
+            "access_token": "123456789",
+            "token_type": "Bearer",
+            "expires_on": str(int(time.time()) + 3600)
+        }).encode("utf-8")
+    ]
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+
+    config_vm = {'api': 'foo'}
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+    assert mock_urlopen.call_count == 1
+
+
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_msi_token_refresh_before_expiry(mock_urlopen):
+    """Test a token within the expiry margin is refreshed"""
+    urlopen = MagicMock()
+    urlopen.read.side_effect = [
+        json.dumps({
+            "access_token": "123456789",
+            "token_type": "Bearer",
+            "expires_in": "60"
+        }).encode("utf-8"),
+        json.dumps({
+            "access_token": "987654321",
+            "token_type": "Bearer",
+            "expires_in": "3600"
+        }).encode("utf-8")
+    ]
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+
+    config_vm = {'api': 'foo'}
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+    assert plugin._get_msi_token(config_vm) == "Bearer 987654321"
+    assert plugin._get_msi_token(config_vm) == "Bearer 987654321"
+    assert mock_urlopen.call_count == 2
+
+
+@patch.dict(os.environ, {'CLIENT_ID': 'client'})
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_msi_token_cached_per_identity(mock_urlopen):
+    """Test the VM and k8s identities do not share a token"""
+    urlopen = MagicMock()
+    urlopen.read.side_effect = [
+        json.dumps({
+            "access_token": "vm",
+            "token_type": "Bearer",
+            "expires_in": "3600"
+        }).encode("utf-8"),
+        json.dumps({
+            "access_token": "k8s",
+            "token_type": "Bearer",
+            "expires_in": "3600"
+        }).encode("utf-8")
+    ]
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+
+    assert plugin._get_msi_token({'api': 'foo'}) == "Bearer vm"
+    assert plugin._get_msi_token({}) == "Bearer k8s"
+    assert plugin._get_msi_token({'api': 'foo'}) == "Bearer vm"
+    assert 'client_id=client' in mock_urlopen.call_args[0][0].full_url
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._invalidate_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_unauthorized_refreshes_token(
+    mock_urlopen,
+    mock_get_msi_token,
+    mock_invalidate_msi_token
+):
+    """Test a 401 drops the cached token and retries with a new one"""
+    urlopen = MagicMock()
+    urlopen.read.side_effect = [
+        urllib.error.HTTPError(
+            'https://marketplaceapi.microsoft.com', 401,
+            'Unauthorized', {}, None
+        ),
+        json.dumps({
+            "count": 1,
+            "result": [
+                {
+                    "usageEventId": "1000",
+                    "resourceUri": "foo",
+                    "quantity": 10,
+                    "dimension": "tier_1",
+                    "planId": "foo",
+                    "status": "Accepted"
+                }
+            ]
+        }).encode("utf-8")
+    ]
+    mock_get_msi_token.side_effect = ["Bearer old", "Bearer new"]
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status["tier_1"] == {"record_id": "1000", "status": "submitted"}
+    mock_invalidate_msi_token.assert_called_once_with(config)
+    request = mock_urlopen.call_args[0][0]
+    assert request.get_header('Authorization') == "Bearer new"
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_resource_uri')
+def test_get_metering_context_vm_cached(mock_get_resource_uri):
+    """Test the VM resource uri is only resolved once"""
+    mock_get_resource_uri.return_value = "super_resource_id"
+
+    assert plugin._get_metering_context(config) == (
+        "super_resource_id", "foobar"
+    )
+    assert plugin._get_metering_context(config) == (
+        "super_resource_id", "foobar"
+    )
+    assert mock_get_resource_uri.call_count == 1
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_resource_uri')
+def test_get_metering_context_not_cached_on_failure(mock_get_resource_uri):
+    """Test an unresolved resource uri is tried again"""
+    mock_get_resource_uri.side_effect = [None, "super_resource_id"]
+
+    assert plugin._get_metering_context(config) == (None, "foobar")
+    assert plugin._get_metering_context(config) == (
+        "super_resource_id", "foobar"
+    )
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'bar'})
+@patch('csp_billing_adapter_microsoft.plugin._get_resource_uri')
+def test_get_metering_context_extension(mock_get_resource_uri):
+    """Test the context comes from the environment for extensions"""
+    assert plugin._get_metering_context(config) == ("foo", "bar")
+    mock_get_resource_uri.assert_not_called()
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_resource_uri')
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_resource_not_found_invalidates_context(
+    mock_urlopen,
+    mock_get_msi_token,
+    mock_get_resource_uri
+):
+    """Test a resource error resolves the resource uri again"""
+    mock_get_resource_uri.side_effect = ["old_resource", "new_resource"]
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    urlopen = MagicMock()
+    urlopen.read.side_effect = [
+        json.dumps({
+            "count": 1,
+            "result": [
+                {
+                    "status": "ResourceNotFound",
+                    "error": {"message": "Resource not found."},
+                    "resourceUri": "old_resource",
+                    "quantity": 10.0,
+                    "dimension": "tier_1",
+                    "planId": "foobar"
+                }
+            ]
+        }).encode("utf-8")
+    ]
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status["tier_1"]["status"] == "failed"
+    assert plugin._get_metering_context(config) == (
+        "new_resource", "foobar"
+    )
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_client_error_not_retried(
+    mock_urlopen,
+    mock_get_msi_token
+):
+    """Test a 400 response fails without retrying"""
+    mock_urlopen.side_effect = urllib.error.HTTPError(
+        'https://marketplaceapi.microsoft.com', 400,
+        'Bad Request', {}, None
+    )
+    mock_get_msi_token.return_value = "Bearer 123456789"
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status["tier_1"]["status"] == "failed"
+    assert "HTTP Error 400" in status["tier_1"]["error"]
+    assert mock_urlopen.call_count == 1
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.retry.time.sleep')
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_throttled_retried(
+    mock_urlopen,
+    mock_get_msi_token,
+    mock_sleep
+):
+    """Test a 429 response is retried after the Retry-After delay"""
+    urlopen = MagicMock()
+    urlopen.read.return_value = json.dumps({
+        "count": 1,
+        "result": [
+            {
+                "usageEventId": "1000",
+                "dimension": "tier_1",
+                "status": "Accepted"
+            }
+        ]
+    }).encode("utf-8")
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.side_effect = [
+        urllib.error.HTTPError(
+            'https://marketplaceapi.microsoft.com', 429,
+            'Too Many Requests', {'Retry-After': '7'}, None
+        ),
+        urlopen
+    ]
+    mock_get_msi_token.return_value = "Bearer 123456789"
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status["tier_1"] == {"record_id": "1000", "status": "submitted"}
+    mock_sleep.assert_called_once_with(7.0)
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_deadline_exceeded(mock_urlopen, mock_get_msi_token):
+    """Test the failed status is returned once the deadline runs out"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    plugin._billing_deadline = 0
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status["tier_1"]["status"] == "failed"
+    assert "Deadline exceeded" in status["tier_1"]["error"]
+    mock_urlopen.assert_not_called()
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_deadline_keeps_accepted(
+    mock_urlopen,
+    mock_get_msi_token
+):
+    """Test accepted usage is reported when the deadline stops retries"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    plugin._billing_deadline = 1
+    plugin._retry_policy = retry.RetryPolicy(backoff=5)
+    mock_urlopen.return_value = _usage_response(
+        {"dimension": "tier_1", "status": "Accepted",
+         "usageEventId": "1000"},
+        {"dimension": "tier_2", "status": "Error",
+         "error": {"code": "TooManyRequests", "message": "Slow down"}}
+    )
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 1, 'tier_2': 2},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status["tier_1"] == {"record_id": "1000", "status": "submitted"}
+    assert status["tier_2"]["status"] == "failed"
+    assert "Deadline exceeded" in status["tier_2"]["error"]
+    assert mock_urlopen.call_count == 1
+
+
+def test_settle_attempt():
+    """Test rejected usage is submitted again while attempts are left"""
+    plugin._retry_policy = retry.RetryPolicy(attempts=2, backoff=0)
+    usage = [
+        _pending_event('tier_1'),
+        _pending_event('tier_2')
+    ]
+    response = {'count': 2, 'result': [
+        {"dimension": "tier_1", "status": "Accepted", "usageEventId": "1"},
+        {"dimension": "tier_2", "status": "Error",
+         "error": {"code": "TooManyRequests", "message": "Slow down"}}
+    ]}
+
+    status, retry_usage, delay = plugin._settle_attempt(usage, response, 1)
+    assert status == {'tier_1': {'record_id': '1', 'status': 'submitted'}}
+    assert retry_usage == usage[1:]
+    assert delay == 0
+
+    status, retry_usage, delay = plugin._settle_attempt(usage, response, 2)
+    assert status['tier_2']['status'] == 'failed'
+    assert (retry_usage, delay) == ([], None)
+
+
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_urlopen_timeout_limited_by_deadline(mock_urlopen):
+    """Test the endpoint timeout is shortened to the deadline"""
+    request = urllib.request.Request('http://169.254.169.254/metadata/')
+
+    plugin._urlopen(request, 'imds')
+    mock_urlopen.assert_called_with(request, timeout=10)
+
+    with retry.deadline(1):
+        plugin._urlopen(request, 'imds')
+    assert mock_urlopen.call_args[1]['timeout'] <= 1
+
+
+def _accept_usage(request, timeout=None):
+    """Return a batchUsageEvent response accepting every usage event."""
+    usage = json.loads(request.data)['request']
+    if any(event['dimension'] == 'reject' for event in usage):
+        raise urllib.error.HTTPError(
+            request.full_url, 400, 'Bad Request', {}, None
+        )
+
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.read.return_value = json.dumps({
+        "count": len(usage),
+        "result": [
+            dict(
+                event,
+                usageEventId=f"id-{event['dimension']}",
+                status="Accepted"
+            )
+            for event in usage
+        ]
+    }).encode("utf-8")
+    return response
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_batches(mock_urlopen, mock_get_msi_token):
+    """Test large usage lists are split into batches"""
+    mock_urlopen.side_effect = _accept_usage
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    dimensions = {f'dim_{index}': index + 1 for index in range(60)}
+
+    status = plugin.meter_billing(
+        config,
+        dimensions,
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert mock_urlopen.call_count == 3
+    assert mock_get_msi_token.call_count == 1
+    assert sorted(
+        len(json.loads(call[0][0].data)['request'])
+        for call in mock_urlopen.call_args_list
+    ) == [10, 25, 25]
+    assert status == {
+        name: {"record_id": f"id-{name}", "status": "submitted"}
+        for name in dimensions
+    }
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_batch_failure(mock_urlopen, mock_get_msi_token):
+    """Test a failed batch only fails its own dimensions"""
+    mock_urlopen.side_effect = _accept_usage
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    plugin._batch_size = 2
+    dimensions = {'tier_1': 1, 'tier_2': 2, 'reject': 3, 'tier_3': 4}
+
+    status = plugin.meter_billing(
+        config,
+        dimensions,
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status['tier_1']['status'] == 'submitted'
+    assert status['tier_2']['status'] == 'submitted'
+    assert status['reject']['status'] == 'failed'
+    assert status['tier_3']['status'] == 'failed'
+    assert "{'reject': 3, 'tier_3': 4}" in status['tier_3']['error']
+
+
+def _usage_response(*results):
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.read.return_value = json.dumps({
+        "count": len(results),
+        "result": list(results)
+    }).encode("utf-8")
+    return response
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_resubmits_retriable_events(
+    mock_urlopen,
+    mock_get_msi_token
+):
+    """Test only the usage events rejected with retriable errors are sent"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    mock_urlopen.side_effect = [
+        _usage_response(
+            {"dimension": "tier_1", "status": "Accepted",
+             "usageEventId": "1000"},
+            {"dimension": "tier_2", "status": "Error",
+             "error": {"code": "InternalServerError", "message": "Oops"}},
+            {"dimension": "tier_3", "status": "InvalidDimension",
+             "error": {"code": "BadArgument", "message": "Invalid"}}
+        ),
+        _usage_response(
+            {"dimension": "tier_2", "status": "Accepted",
+             "usageEventId": "1001"}
+        )
+    ]
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 1, 'tier_2': 2, 'tier_3': 3},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert mock_urlopen.call_count == 2
+    resubmitted = json.loads(mock_urlopen.call_args[0][0].data)['request']
+    assert [event['dimension'] for event in resubmitted] == ['tier_2']
+    assert status['tier_1'] == {"record_id": "1000", "status": "submitted"}
+    assert status['tier_2'] == {"record_id": "1001", "status": "submitted"}
+    assert status['tier_3']['status'] == 'failed'
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_resubmit_gives_up(mock_urlopen, mock_get_msi_token):
+    """Test retriable usage events fail once the attempts are used up"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    mock_urlopen.side_effect = [
+        _usage_response(
+            {"dimension": "tier_1", "status": "Error",
+             "error": {"code": "ServiceUnavailable", "message": "Busy"}}
+        )
+        for _ in range(3)
+    ]
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 1},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert mock_urlopen.call_count == 3
+    assert status['tier_1'] == {
+        "status": "failed",
+        "error": 'Failed to meter bill dimensions: Status: Error '
+                 'Message: Busy'
+    }
+
+
+def _pending_event(dimension, timestamp=None, resource_uri='foo'):
+    timestamp = timestamp or datetime.datetime.now(datetime.timezone.utc)
+    return {
+        'resourceUri': resource_uri,
+        'quantity': 10,
+        'dimension': dimension,
+        'effectiveStartTime': idempotency.get_hour_bucket(timestamp),
+        'planId': 'foo'
+    }
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_outbox(mock_urlopen, mock_get_msi_token, tmp_path):
+    """Test usage left by an interrupted call is replayed later"""
+    plugin._outbox = outbox.Outbox(str(tmp_path / 'outbox'))
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    interrupted = _pending_event('tier_1', timestamp)
+    # Usage of past hours is reported again by the adapter
+    stale = _pending_event(
+        'tier_3',
+        timestamp - datetime.timedelta(hours=1)
+    )
+    plugin._outbox.add([interrupted, stale])
+
+    mock_urlopen.side_effect = _accept_usage
+    status = plugin.meter_billing(
+        config, {'tier_2': 5}, timestamp, dry_run=False
+    )
+
+    assert status == {
+        'tier_2': {'record_id': 'id-tier_2', 'status': 'submitted'}
+    }
+    assert mock_urlopen.call_count == 2
+    replayed = json.loads(mock_urlopen.call_args[0][0].data)['request']
+    assert replayed == [interrupted]
+    assert list(plugin._outbox.iter_pending(25)) == []
+    assert not plugin._in_flight
+
+
+@patch('csp_billing_adapter_microsoft.plugin._submit_batches')
+def test_replay_outbox_in_flight(mock_submit_batches, tmp_path):
+    """Test usage another call is submitting is not replayed"""
+    plugin._outbox = outbox.Outbox(str(tmp_path / 'outbox'))
+    usage = [_pending_event('tier_1')]
+    plugin._set_in_flight(usage, True)
+    plugin._outbox.add(usage)
+    try:
+        plugin._replay_outbox(config)
+    finally:
+        plugin._set_in_flight(usage, False)
+
+    mock_submit_batches.assert_not_called()
+    assert list(plugin._outbox.iter_pending(25)) == [usage]
+    assert not plugin._in_flight
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_replay_outbox_resources(mock_urlopen, mock_get_msi_token, tmp_path):
+    """Test the replayed resources of a dimension are settled separately"""
+    plugin._outbox = outbox.Outbox(str(tmp_path / 'outbox'))
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    events = [
+        _pending_event('tier_1', resource_uri=resource_uri)
+        for resource_uri in ('foo', 'bar')
+    ]
+    plugin._outbox.add(events)
+    mock_urlopen.side_effect = [
+        _usage_response(
+            dict(events[0], status='Accepted', usageEventId='1000'),
+            dict(
+                events[1],
+                status='Error',
+                error={'code': 'TooManyRequests', 'message': 'Slow down'}
+            )
+        ),
+        _usage_response(
+            dict(events[1], status='Accepted', usageEventId='1100')
+        )
+    ]
+
+    plugin._replay_outbox(config)
+
+    resent = json.loads(mock_urlopen.call_args[0][0].data)['request']
+    assert resent == [events[1]]
+    assert plugin._accepted_index.get(events[0]) == '1000'
+    assert plugin._accepted_index.get(events[1]) == '1100'
+    assert list(plugin._outbox.iter_pending(25)) == []
+
+
+@pytest.mark.parametrize('hours', [0, 1])
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_outbox_failed_usage(
+    mock_urlopen,
+    mock_get_msi_token,
+    hours,
+    tmp_path
+):
+    """Test failed usage resent by the adapter is billed once"""
+    plugin._outbox = outbox.Outbox(str(tmp_path / 'outbox'))
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    timestamp = datetime.datetime(
+        2024, 1, 1, 10, 10, tzinfo=datetime.timezone.utc
+    )
+
+    mock_urlopen.side_effect = urllib.error.URLError('Connection refused')
+    status = plugin.meter_billing(
+        config, {'tier_1': 10}, timestamp, dry_run=False
+    )
+    assert status['tier_1']['status'] == 'failed'
+    assert list(plugin._outbox.iter_pending(25)) == []
+
+    mock_urlopen.side_effect = _accept_usage
+    mock_urlopen.reset_mock()
+    plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        timestamp + datetime.timedelta(hours=hours),
+        dry_run=False
+    )
+
+    assert mock_urlopen.call_count == 1
+    usage = json.loads(mock_urlopen.call_args[0][0].data)['request']
+    assert [event['quantity'] for event in usage] == [10]
+
+
+@patch('csp_billing_adapter_microsoft.plugin._submit_batches')
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+def test_replay_outbox_token_failure(
+    mock_get_msi_token,
+    mock_submit_batches,
+    tmp_path,
+    caplog
+):
+    """Test a replay that can not get a token keeps the events pending"""
+    plugin._outbox = outbox.Outbox(str(tmp_path / 'outbox'))
+    plugin._outbox.add([_pending_event('tier_1')])
+    mock_get_msi_token.side_effect = cba_exceptions.CSPBillingAdapterException
+
+    plugin._replay_outbox(config)
+
+    mock_submit_batches.assert_not_called()
+    assert "Unable to replay pending usage events" in caplog.text
+    assert len(list(plugin._outbox.iter_pending(25))) == 1
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_skips_accepted_usage(
+    mock_urlopen,
+    mock_get_msi_token
+):
+    """Test usage accepted in the same hour is not sent again"""
+    mock_urlopen.side_effect = _accept_usage
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    timestamp = datetime.datetime.now(datetime.timezone.utc).replace(
+        minute=10
+    )
+
+    first = plugin.meter_billing(
+        config, {'tier_1': 10}, timestamp, dry_run=False
+    )
+    second = plugin.meter_billing(
+        config,
+        {'tier_1': 10, 'tier_2': 5},
+        timestamp + datetime.timedelta(seconds=1),
+        dry_run=False
+    )
+
+    assert first['tier_1'] == {'record_id': 'id-tier_1', 'status': 'submitted'}
+    assert second['tier_1'] == first['tier_1']
+    assert second['tier_2'] == {
+        'record_id': 'id-tier_2',
+        'status': 'submitted'
+    }
+    assert mock_urlopen.call_count == 2
+    resent = json.loads(mock_urlopen.call_args[0][0].data)['request']
+    assert [event['dimension'] for event in resent] == ['tier_2']
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_indexes_duplicates(mock_urlopen, mock_get_msi_token):
+    """Test a duplicate result is remembered with the accepted id"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    mock_urlopen.return_value = _usage_response({
+        "dimension": "tier_1",
+        "status": "Duplicate",
+        "error": {
+            "additionalInfo": {
+                "acceptedMessage": {"usageEventId": "1000"}
+            }
+        }
+    })
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    for _ in range(2):
+        status = plugin.meter_billing(
+            config, {'tier_1': 10}, timestamp, dry_run=False
+        )
+        assert status['tier_1'] == {'record_id': '1000', 'status': 'submitted'}
+
+    assert mock_urlopen.call_count == 1
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_metering_context')
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin._get_signature')
+@patch('csp_billing_adapter_microsoft.plugin._get_instance_metadata')
+@patch(
+    'csp_billing_adapter_microsoft.plugin.'
+    '_is_required_metadata_version_available'
+)
+def test_setup_prefetch(
+    mock_check_metadata_version,
+    mock_get_instance_metadata,
+    mock_get_signature,
+    mock_get_msi_token,
+    mock_get_metering_context,
+    caplog
+):
+    """Test setup warms the caches and tolerates failures"""
+    mock_check_metadata_version.return_value = True
+    mock_get_signature.side_effect = ValueError('bad document')
+    config_prefetch = dict(config)
+    config_prefetch['microsoft'] = {'prefetch': True}
+
+    plugin.setup_adapter(config_prefetch)
+
+    mock_get_instance_metadata.assert_called_once_with()
+    mock_get_signature.assert_called_once_with()
+    mock_get_msi_token.assert_called_once_with(config_prefetch)
+    mock_get_metering_context.assert_called_once_with(config_prefetch)
+    assert 'Unable to prefetch attested document' in caplog.text
+
+
+@patch('csp_billing_adapter_microsoft.plugin._prefetch')
+@patch(
+    'csp_billing_adapter_microsoft.plugin.'
+    '_is_required_metadata_version_available'
+)
+def test_setup_prefetch_version_check_fails(
+    mock_check_metadata_version,
+    mock_prefetch
+):
+    """Test the version check fails setup before prefetching"""
+    mock_check_metadata_version.return_value = False
+    config_prefetch = dict(config)
+    config_prefetch['microsoft'] = {'prefetch': True}
+
+    with pytest.raises(cba_exceptions.CSPMetadataRetrievalError):
+        plugin.setup_adapter(config_prefetch)
+    mock_prefetch.assert_not_called()
+
+
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_instance_metadata_cached(mock_urlopen):
+    """Test the metadata is fetched once and copies are returned"""
+    urlopen = MagicMock()
+    urlopen.read.side_effect = [
+        b'{"compute": {"vmId": "1"}, "network": "info"}'
+    ]
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+
+    metadata = plugin._get_instance_metadata()
+    metadata['attestedData'] = {}
+
+    assert plugin._get_instance_metadata() == {
+        "compute": {"vmId": "1"},
+        "network": "info"
+    }
+    assert mock_urlopen.call_count == 1
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_instance_metadata')
+@patch('csp_billing_adapter_microsoft.plugin._get_signature')
+def test_get_metadata_signature_fail(
+    mock_get_signature,
+    mock_get_instance_metadata
+):
+    """Test the compute data is kept when the signature fails"""
+    mock_get_instance_metadata.return_value = {
+        'compute': 'info',
+        'network': 'info'
+    }
+    mock_get_signature.side_effect = ValueError('foo')
+
+    assert plugin._get_metadata() == {
+        'compute': 'info',
+        'network': 'info',
+        'attestedData': {}
+    }
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_instance_metadata')
+@patch('csp_billing_adapter_microsoft.plugin._get_signature')
+def test_get_metadata_instance_fail(
+    mock_get_signature,
+    mock_get_instance_metadata
+):
+    """Test the signature is kept when the instance metadata fails"""
+    mock_get_instance_metadata.side_effect = ValueError('foo')
+    mock_get_signature.return_value = {'signature': 'signature'}
+
+    assert plugin._get_metadata() == {
+        'compute': {},
+        'network': {},
+        'attestedData': {'signature': 'signature'}
+    }
+
+
+def _attested_document(expires_on: datetime.datetime):
+    signed = (
+        b'0\x82\x01garbage{"nonce":"1","timeStamp":{"createdOn":'
+        b'"01/01/24 10:00:00 -0000","expiresOn":"' +
+        expires_on.strftime('%m/%d/%y %H:%M:%S -0000').encode('utf-8') +
+        b'"},"vmId":"1"}more garbage'
+    )
+    return {
+        'encoding': 'pkcs7',
+        'signature': base64.b64encode(signed).decode('utf-8')
+    }
+
+
+def test_get_attested_data_lifetime():
+    """Test the lifetime comes from the signed expiresOn time"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    lifetime = plugin._get_attested_data_lifetime(
+        _attested_document(now + datetime.timedelta(hours=1))
+    )
+    assert 3500 - plugin.ATTESTED_EXPIRY_MARGIN < lifetime <= \
+        3600 - plugin.ATTESTED_EXPIRY_MARGIN
+
+    assert plugin._get_attested_data_lifetime(
+        _attested_document(now - datetime.timedelta(hours=1))
+    ) == 0
+    assert plugin._get_attested_data_lifetime({'signature': 'x'}) is None
+    assert plugin._get_attested_data_lifetime({}) is None
+
+
+@patch('csp_billing_adapter_microsoft.plugin._fetch_metadata')
+def test_get_signature_expired_not_reused(mock_fetch_metadata):
+    """Test an attested document past its validity is fetched again"""
+    expired = _attested_document(
+        datetime.datetime.now(datetime.timezone.utc)
+    )
+    mock_fetch_metadata.return_value = json.dumps(expired)
+
+    assert plugin._get_signature() == expired
+    assert plugin._get_signature() == expired
+    assert mock_fetch_metadata.call_count == 2
+
+
+@patch('csp_billing_adapter_microsoft.plugin._fetch_metadata')
+def test_metadata_ttls(mock_fetch_metadata):
+    """Test instance metadata and attested data have their own TTL"""
+    mock_fetch_metadata.side_effect = lambda url: (
+        '{"compute": {"vmId": "1"}}' if 'instance' in url
+        else '{"signature": "signature"}'
+    )
+    plugin._attested_data_ttl = 0
+
+    for _ in range(2):
+        plugin._get_instance_metadata()
+        plugin._get_signature()
+
+    urls = [call[0][0] for call in mock_fetch_metadata.call_args_list]
+    assert len([url for url in urls if 'instance' in url]) == 1
+    assert len([url for url in urls if 'attested' in url]) == 2
+
+
+def test_has_compute_changed():
+    """Test only the compute identity is compared"""
+    metadata = {
+        'compute': {
+            'vmId': '1',
+            'resourceId': '/subscriptions/foo',
+            'plan': {'name': 'plan'},
+            'tags': 'a'
+        }
+    }
+    assert plugin.has_compute_changed(metadata) is True
+    plugin._check_compute(metadata)
+    assert plugin.has_compute_changed(metadata) is False
+
+    metadata['compute']['tags'] = 'b'
+    assert plugin.has_compute_changed(metadata) is False
+
+    # The check does not record the new identity
+    fingerprint = plugin.get_compute_fingerprint(metadata)
+    metadata['compute']['vmId'] = '2'
+    assert plugin.has_compute_changed(metadata) is True
+    assert plugin.has_compute_changed(metadata) is True
+    assert plugin.has_compute_changed(metadata, fingerprint) is True
+    assert plugin.has_compute_changed(
+        metadata,
+        plugin.get_compute_fingerprint(metadata)
+    ) is False
+
+
+@patch('csp_billing_adapter_microsoft.plugin._fetch_metadata')
+def test_compute_change_invalidates_metering_context(mock_fetch_metadata):
+    """Test a new compute identity drops the metering context"""
+    mock_fetch_metadata.side_effect = [
+        '{"compute": {"vmId": "1"}}',
+        '{"compute": {"vmId": "2"}}'
+    ]
+    plugin._instance_metadata_ttl = 0
+
+    plugin._get_instance_metadata()
+    plugin._metering_context['source'] = ('resource', 'plan')
+    plugin._get_instance_metadata()
+
+    assert plugin._metering_context == {}
+
+
+@patch('csp_billing_adapter_microsoft.plugin._fetch_metadata')
+def test_metadata_disk_cache_warm_start(mock_fetch_metadata, tmp_path):
+    """Test metadata cached on disk is reused after a restart"""
+    mock_fetch_metadata.side_effect = lambda url: (
+        '{"apiVersions": ["2020-09-01"]}' if 'versions' in url
+        else '{"compute": {"vmId": "1"}}'
+    )
+    plugin._disk_cache = disk_cache.DiskCache(str(tmp_path))
+
+    assert plugin._is_required_metadata_version_available()
+    assert plugin._get_instance_metadata() == {'compute': {'vmId': '1'}}
+
+    # A new process starts with empty memory caches
+    plugin._metadata_cache.clear()
+    plugin._compute_fingerprint = None
+
+    assert plugin._is_required_metadata_version_available()
+    assert plugin._get_instance_metadata() == {'compute': {'vmId': '1'}}
+    assert mock_fetch_metadata.call_count == 2
+
+
+@patch('csp_billing_adapter_microsoft.plugin._fetch_metadata')
+def test_metadata_disk_cache_expired(mock_fetch_metadata, tmp_path):
+    """Test expired disk entries are fetched again"""
+    mock_fetch_metadata.return_value = '{"compute": {"vmId": "1"}}'
+    plugin._disk_cache = disk_cache.DiskCache(str(tmp_path))
+
+    plugin._get_instance_metadata()
+    plugin._metadata_cache.clear()
+    with patch('time.time', return_value=time.time() + 3600):
+        plugin._get_instance_metadata()
+
+    assert mock_fetch_metadata.call_count == 2
+
+
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_msi_token_disk_cache(mock_urlopen, tmp_path):
+    """Test a token cached on disk is shared and dropped on invalidation"""
+    urlopen = MagicMock()
+    urlopen.read.side_effect = lambda: json.dumps({
+        "access_token": "123456789",
+        "token_type": "Bearer",
+        "expires_on": str(int(time.time()) + 3600)
+    }).encode("utf-8")
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+    plugin._disk_cache = disk_cache.DiskCache(str(tmp_path))
+
+    config_vm = {'api': 'foo'}
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+    plugin._token_cache.clear()
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+    assert mock_urlopen.call_count == 1
+
+    plugin._invalidate_msi_token(config_vm)
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+    assert mock_urlopen.call_count == 2
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin._get_instance_metadata')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_managed_identity_disk_cache(
+    mock_urlopen,
+    mock_get_instance_metadata,
+    mock_get_msi_token,
+    tmp_path
+):
+    """Test the managed identity is cached on disk until invalidated"""
+    mock_get_instance_metadata.return_value = {
+        'compute': {'subscriptionId': '1', 'resourceGroupName': 'group'}
+    }
+    mock_get_msi_token.return_value = 'Bearer 123456789'
+    urlopen = MagicMock()
+    urlopen.read.side_effect = lambda: b'{"managedBy": "/subscriptions/1"}'
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+    plugin._disk_cache = disk_cache.DiskCache(str(tmp_path))
+
+    assert plugin._get_resource_uri() == '/subscriptions/1'
+    assert plugin._get_resource_uri() == '/subscriptions/1'
+    assert mock_urlopen.call_count == 1
+
+    plugin._invalidate_metering_context()
+    assert plugin._get_resource_uri() == '/subscriptions/1'
+    assert mock_urlopen.call_count == 2
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin._fetch_metadata')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_managed_identity_disk_cache_cold_start(
+    mock_urlopen,
+    mock_fetch_metadata,
+    mock_get_msi_token,
+    tmp_path
+):
+    """Test a new process reuses the managed identity cached on disk"""
+    mock_fetch_metadata.return_value = json.dumps({
+        'compute': {
+            'vmId': '1',
+            'subscriptionId': '1',
+            'resourceGroupName': 'group'
+        }
+    })
+    mock_get_msi_token.return_value = 'Bearer 123456789'
+    urlopen = MagicMock()
+    urlopen.read.side_effect = lambda: b'{"managedBy": "/subscriptions/1"}'
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+
+    for _ in range(2):
+        # Each process starts with empty memory caches
+        plugin._disk_cache = disk_cache.DiskCache(str(tmp_path))
+        plugin._metadata_cache.clear()
+        plugin._compute_fingerprint = None
+        assert plugin._get_resource_uri() == '/subscriptions/1'
+
+    assert mock_urlopen.call_count == 1
+
+
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_msi_token_token_store(mock_urlopen, tmp_path):
+    """Test a token in the shared store is reused by other processes"""
+    urlopen = MagicMock()
+    urlopen.read.side_effect = lambda: json.dumps({
+        "access_token": "123456789",
+        "token_type": "Bearer",
+        "expires_on": str(int(time.time()) + 3600)
+    }).encode("utf-8")
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+    plugin._token_store = token_store.TokenStore(str(tmp_path / 'tokens'))
+
+    config_vm = {'api': 'foo'}
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+
+    # Another process starts with an empty token cache
+    plugin._token_cache.clear()
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+    assert mock_urlopen.call_count == 1
+
+    plugin._invalidate_msi_token(config_vm)
+    assert plugin._get_msi_token(config_vm) == "Bearer 123456789"
+    assert mock_urlopen.call_count == 2
+
+
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_msi_token_token_store_error(mock_urlopen, tmp_path):
+    """Test the token is fetched directly if the store is unusable"""
+    urlopen = MagicMock()
+    urlopen.read.side_effect = lambda: json.dumps({
+        "access_token": "123456789",
+        "token_type": "Bearer",
+        "expires_on": str(int(time.time()) + 3600)
+    }).encode("utf-8")
+    urlopen.__enter__.return_value = urlopen
+    mock_urlopen.return_value = urlopen
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    plugin._token_store = token_store.TokenStore(str(blocker / 'tokens'))
+
+    assert plugin._get_msi_token({'api': 'foo'}) == "Bearer 123456789"
+
+
+def _run_concurrently(func, callers=4):
+    """
+    Call func from several threads while its first request is held.
+
+    The request is released once every other caller waits on it.
+    Return the results and the number of requests sent.
+    """
+    started = threading.Event()
+    release = threading.Event()
+    waiting = threading.Semaphore(0)
+    requests = []
+
+    def _urlopen(request, timeout=None):
+        requests.append(request.full_url)
+        started.set()
+        release.wait(5)
+        return _urlopen_response(request.full_url)
+
+    def _get_remaining():
+        # Called by a caller about to wait on the request in flight
+        waiting.release()
+        return None
+
+    with patch(
+        'csp_billing_adapter_microsoft.plugin.urllib.request.urlopen',
+        side_effect=_urlopen
+    ), patch(
+        'csp_billing_adapter_microsoft.single_flight.retry.get_remaining',
+        side_effect=_get_remaining
+    ), ThreadPoolExecutor(max_workers=callers) as executor:
+        futures = [executor.submit(func)]
+        started.wait(5)
+        futures += [executor.submit(func) for _ in range(callers - 1)]
+        for _ in range(callers - 1):
+            waiting.acquire(timeout=5)
+        release.set()
+        results = [future.result() for future in futures]
+
+    return results, requests
+
+
+def _urlopen_response(url):
+    if 'oauth2/token' in url:
+        body = {
+            "access_token": "123456789",
+            "token_type": "Bearer",
+            "expires_on": str(int(time.time()) + 3600)
+        }
+    else:
+        body = {'compute': {'vmId': '1'}}
+
+    response = MagicMock()
+    response.read.return_value = json.dumps(body).encode('utf-8')
+    response.__enter__.return_value = response
+    return response
+
+
+def test_fetch_metadata_concurrent():
+    """Test concurrent identical metadata requests are sent once"""
+    url = f'{plugin.METADATA_URL}instance'
+    results, requests = _run_concurrently(
+        lambda: plugin._fetch_metadata(url)
+    )
+
+    assert results == ['{"compute": {"vmId": "1"}}'] * 4
+    assert requests == [url]
+
+
+def test_get_msi_token_concurrent():
+    """Test concurrent token refreshes for an identity are sent once"""
+    results, requests = _run_concurrently(
+        lambda: plugin._get_msi_token({'api': 'foo'})
+    )
+
+    assert results == ['Bearer 123456789'] * 4
+    assert len(requests) == 1
+    assert plugin._get_msi_token({'api': 'foo'}) == 'Bearer 123456789'
+
+
+def test_get_instance_metadata_concurrent():
+    """Test concurrent callers share the metadata request and cache"""
+    results, requests = _run_concurrently(plugin._get_instance_metadata)
+
+    assert results == [{'compute': {'vmId': '1'}}] * 4
+    assert len(requests) == 1
+    assert plugin._metadata_cache
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_bulk(mock_urlopen, mock_get_msi_token):
+    """Test the usage of many resources is packed in few requests"""
+    mock_urlopen.side_effect = _accept_usage
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    records = [
+        plugin.UsageRecord(
+            f'/subscriptions/{resource}',
+            'plan',
+            {f'dim_{index}': index + 1 for index in range(10)},
+            timestamp
+        )
+        for resource in range(3)
+    ] + [('/subscriptions/idle', 'plan', {'dim_0': 0}, timestamp)]
+
+    status = plugin.meter_billing_bulk(config, records)
+
+    assert mock_urlopen.call_count == 2
+    assert mock_get_msi_token.call_count == 1
+    assert sorted(
+        len(json.loads(call[0][0].data)['request'])
+        for call in mock_urlopen.call_args_list
+    ) == [5, 25]
+    hour = idempotency.get_hour_bucket(timestamp)
+    assert status == {
+        f'/subscriptions/{resource}': {
+            f'dim_{index}': {
+                hour: {"record_id": f"id-dim_{index}", "status": "submitted"}
+            }
+            for index in range(10)
+        }
+        for resource in range(3)
+    }
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_bulk_resubmits_by_resource(
+    mock_urlopen,
+    mock_get_msi_token
+):
+    """Test results are matched to usage by resource and dimension"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    hour = idempotency.get_hour_bucket(timestamp)
+    event = {'planId': 'plan', 'dimension': 'tier_1',
+             'effectiveStartTime': hour}
+    mock_urlopen.side_effect = [
+        _usage_response(
+            dict(event, resourceUri="/a", status="Accepted",
+                 usageEventId="1"),
+            dict(event, resourceUri="/b", status="Error",
+                 error={"code": "ServiceUnavailable", "message": "Busy"})
+        ),
+        _usage_response(
+            dict(event, resourceUri="/b", status="Accepted",
+                 usageEventId="2")
+        )
+    ]
+
+    status = plugin.meter_billing_bulk(config, [
+        ('/a', 'plan', {'tier_1': 1}, timestamp),
+        ('/b', 'plan', {'tier_1': 2}, timestamp)
+    ])
+
+    resubmitted = json.loads(mock_urlopen.call_args_list[1][0][0].data)
+    assert [event['resourceUri'] for event in resubmitted['request']] == [
+        '/b'
+    ]
+    assert status == {
+        '/a': {'tier_1': {hour: {"record_id": "1", "status": "submitted"}}},
+        '/b': {'tier_1': {hour: {"record_id": "2", "status": "submitted"}}}
+    }
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_bulk_hours(mock_urlopen, mock_get_msi_token):
+    """Test the usage of several hours of a dimension is submitted"""
+    mock_urlopen.side_effect = _accept_usage
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    timestamp = datetime.datetime(
+        2024, 1, 1, 10, 5, tzinfo=datetime.timezone.utc
+    )
+
+    status = plugin.meter_billing_bulk(config, [
+        ('/a', 'plan', {'tier_1': 1}, timestamp),
+        ('/a', 'plan', {'tier_1': 2}, timestamp + datetime.timedelta(
+            hours=1
+        ))
+    ])
+
+    usage = json.loads(mock_urlopen.call_args[0][0].data)['request']
+    assert [
+        (event['effectiveStartTime'], event['quantity']) for event in usage
+    ] == [('2024-01-01T10:00:00Z', 1), ('2024-01-01T11:00:00Z', 2)]
+    submitted = {'record_id': 'id-tier_1', 'status': 'submitted'}
+    assert status == {'/a': {'tier_1': {
+        '2024-01-01T10:00:00Z': submitted,
+        '2024-01-01T11:00:00Z': submitted
+    }}}
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_bulk_coalesces_hour(mock_urlopen, mock_get_msi_token):
+    """Test usage reported twice in an hour is merged by policy"""
+    mock_urlopen.side_effect = _accept_usage
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    plugin._merge_policies = {'tier_2': 'max', 'tier_3': 'last'}
+    timestamp = datetime.datetime(
+        2024, 1, 1, 10, 5, tzinfo=datetime.timezone.utc
+    )
+    later = timestamp + datetime.timedelta(minutes=30)
+
+    plugin.meter_billing_bulk(config, [
+        ('/a', 'plan', {'tier_1': 1, 'tier_2': 5, 'tier_3': 5}, timestamp),
+        ('/a', 'plan', {'tier_1': 2, 'tier_2': 3, 'tier_3': 3}, later)
+    ])
+
+    usage = json.loads(mock_urlopen.call_args[0][0].data)['request']
+    assert {event['dimension']: event['quantity'] for event in usage} == {
+        'tier_1': 3,
+        'tier_2': 5,
+        'tier_3': 3
+    }
+    assert {event['effectiveStartTime'] for event in usage} == {
+        '2024-01-01T10:00:00Z'
+    }
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_replaces_pending_usage(
+    mock_urlopen,
+    mock_get_msi_token,
+    tmp_path
+):
+    """Test usage left pending earlier in the hour is replaced"""
+    plugin._outbox = outbox.Outbox(str(tmp_path / 'outbox'))
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    timestamp = datetime.datetime.now(datetime.timezone.utc).replace(
+        minute=10
+    )
+    plugin._outbox.add(plugin._create_usage_list(
+        {'tier_1': 10},
+        timestamp,
+        config
+    ))
+
+    mock_urlopen.side_effect = _accept_usage
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 10},
+        timestamp + datetime.timedelta(minutes=30),
+        dry_run=False
+    )
+
+    assert status == {
+        'tier_1': {'record_id': 'id-tier_1', 'status': 'submitted'}
+    }
+    assert mock_urlopen.call_count == 1
+    usage = json.loads(mock_urlopen.call_args[0][0].data)['request']
+    assert usage[0]['quantity'] == 10
+    assert list(plugin._outbox.iter_pending(25)) == []
+
+
+def test_get_merge_policies():
+    assert plugin._get_merge_policies(
+        {'microsoft': {'merge_policies': {'tier_1': 'max'}}}
+    ) == {'tier_1': 'max'}
+    with pytest.raises(cba_exceptions.CSPBillingAdapterException):
+        plugin._get_merge_policies(
+            {'microsoft': {'merge_policies': {'tier_1': 'avg'}}}
+        )
+
+
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+def test_meter_billing_bulk_deadline_exceeded(mock_get_msi_token):
+    mock_get_msi_token.side_effect = retry.DeadlineExceeded('Deadline')
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing_bulk(config, [
+        ('/a', 'plan', {'tier_1': 1}, timestamp)
+    ])
+    hour = idempotency.get_hour_bucket(timestamp)
+    assert status['/a']['tier_1'][hour]['status'] == 'failed'
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_rate_limited(mock_urlopen, mock_get_msi_token):
+    """Test throttling lowers the rate and successes raise it again"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    plugin._rate_limiter = rate_limit.RateLimiter(rate=1000, burst=10)
+    mock_urlopen.side_effect = [
+        urllib.error.HTTPError(
+            'https://marketplaceapi.microsoft.com', 429, 'Too Many Requests',
+            {'Retry-After': '0'}, None
+        ),
+        _usage_response(
+            {"dimension": "tier_1", "status": "Error",
+             "error": {"code": "TooManyRequests", "message": "Slow down"}}
+        ),
+        _usage_response(
+            {"dimension": "tier_1", "status": "Accepted",
+             "usageEventId": "1000"}
+        )
+    ]
+
+    status = plugin.meter_billing(
+        config,
+        {'tier_1': 1},
+        datetime.datetime.now(datetime.timezone.utc),
+        dry_run=False
+    )
+
+    assert status == {
+        'tier_1': {'record_id': '1000', 'status': 'submitted'}
+    }
+    state = plugin.get_rate_limit_state()
+    assert state['throttled'] == 2
+    assert state['rate'] == 350
+
+
+def test_get_rate_limit_state_disabled():
+    assert plugin.get_rate_limit_state() is None
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_circuit_open(mock_urlopen, mock_get_msi_token):
+    """Test requests fail fast once the marketplace circuit opened"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    plugin._circuit_breakers = plugin._get_circuit_breakers(
+        {'microsoft': {'circuit_breaker': {'minimum_calls': 3}}}
+    )
+    mock_urlopen.side_effect = urllib.error.HTTPError(
+        'https://marketplaceapi.microsoft.com', 503, 'Unavailable', {}, None
+    )
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+    status = plugin.meter_billing(config, {'tier_1': 1}, timestamp, False)
+    assert status['tier_1']['status'] == 'failed'
+    assert mock_urlopen.call_count == 3
+    assert plugin.get_circuit_state()['marketplace']['state'] == 'open'
+
+    status = plugin.meter_billing(config, {'tier_1': 1}, timestamp, False)
+    assert status['tier_1']['status'] == 'failed'
+    assert 'Circuit for marketplace is open' in status['tier_1']['error']
+    assert mock_urlopen.call_count == 3
+    assert plugin.get_circuit_state()['imds']['state'] == 'closed'
+
+
+def test_get_circuit_state_disabled():
+    assert plugin.get_circuit_state() == {}
+
+
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_get_account_info_circuit_open(mock_urlopen):
+    plugin._circuit_breakers = plugin._get_circuit_breakers(
+        {'microsoft': {'circuit_breaker': {'minimum_calls': 1}}}
+    )
+    plugin._circuit_breakers['imds'].on_failure()
+
+    info = plugin.get_account_info(config)
+
+    assert info == {'attestedData': {}, 'cloud_provider': 'microsoft'}
+    mock_urlopen.assert_not_called()
+
+
+@patch.dict(os.environ, {'EXTENSION_RESOURCE_ID': 'foo', 'PLAN_ID': 'foo'})
+@patch('csp_billing_adapter_microsoft.plugin._get_msi_token')
+@patch('csp_billing_adapter_microsoft.plugin.urllib.request.urlopen')
+def test_meter_billing_traced(mock_urlopen, mock_get_msi_token):
+    """Test a batch keeps its correlation id across retries"""
+    mock_get_msi_token.return_value = "Bearer 123456789"
+    exporter = tracing.InMemoryExporter()
+    plugin.set_trace_exporter(exporter)
+    mock_urlopen.side_effect = [
+        urllib.error.HTTPError(
+            'https://marketplaceapi.microsoft.com', 503, 'Unavailable',
+            {}, None
+        ),
+        _usage_response(
+            {"dimension": "tier_1", "status": "Error",
+             "error": {"code": "TooManyRequests", "message": "Slow down"}},
+            {"dimension": "tier_2", "status": "Accepted",
+             "usageEventId": "2000"}
+        ),
+        _usage_response(
+            {"dimension": "tier_1", "status": "Accepted",
+             "usageEventId": "1000"}
+        )
+    ]
+
+    try:
+        plugin.meter_billing(
+            config,
+            {'tier_1': 1, 'tier_2': 2},
+            datetime.datetime.now(datetime.timezone.utc),
+            dry_run=False
+        )
+    finally:
+        plugin.set_trace_exporter(None)
+
+    root = exporter.get_spans('meter_billing')[0]
+    batch = exporter.get_spans('submit_batch')[0]
+    requests = exporter.get_spans('http_request')
+    correlation_id = batch.attributes['correlation_id']
+
+    assert batch.parent_id == root.span_id
+    assert batch.attributes['attempts'] == 2
+    assert len(requests) == 3
+    assert requests[0].error == 'HTTPError: HTTP Error 503: Unavailable'
+    for span in requests:
+        assert span.parent_id == batch.span_id
+        assert span.trace_id == root.trace_id
+        assert span.attributes['correlation_id'] == correlation_id
+    assert {
+        call.args[0].get_header('X-ms-correlationid')
+        for call in mock_urlopen.call_args_list
+    } == {correlation_id}
+
+
+def test_get_trace_exporter(tmp_path):
+    path = str(tmp_path / 'spans')
+    exporter = plugin._get_trace_exporter(
+        {'microsoft': {'tracing': {'exporter': 'json_lines', 'path': path}}}
+    )
+    assert exporter.path == path
+    assert plugin._get_trace_exporter({}) is None
+    assert isinstance(
+        plugin._get_trace_exporter(
+            {'microsoft': {'tracing': {'exporter': 'memory'}}}
+        ),
+        tracing.InMemoryExporter
+    )
+
+    for settings in ({'exporter': 'json_lines'}, {'exporter': 'zipkin'}):
+        with pytest.raises(cba_exceptions.CSPBillingAdapterException):
+            plugin._get_trace_exporter({'microsoft': {'tracing': settings}})
+
+
+def test_get_profiler(tmp_path):
+    assert plugin._get_profiler({}) is None
+    profiler = plugin._get_profiler({'microsoft': {'profiling': {
+        'directory': str(tmp_path),
+        'interval': 10,
+        'memory_frames': 0
+    }}})
+    profiler.close()
+    assert profiler.interval == 10
+
+    with pytest.raises(cba_exceptions.CSPBillingAdapterException):
+        plugin._get_profiler({'microsoft': {'profiling': {'interval': 10}}})
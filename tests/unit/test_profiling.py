@@ -0,0 +1,203 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import asyncio
+import json
+import os
+import threading
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from csp_billing_adapter_microsoft import profiling
+
+
+def _busy(duration):
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        pass
+
+
+def _read_report(path):
+    with open(path) as report:
+        return json.load(report)
+
+
+def test_profiler_reports(tmp_path):
+    profiler = profiling.Profiler(
+        str(tmp_path),
+        interval=2,
+        sample_interval=0.001
+    )
+    busy = profiler.wrap('busy', _busy)
+
+    def _outer():
+        busy(0.05)
+
+    outer = profiler.wrap('outer', _outer)
+
+    try:
+        outer()
+        assert not os.listdir(tmp_path)
+        busy(0.05)
+        first = sorted(os.listdir(tmp_path))
+        outer()
+        busy(0)
+    finally:
+        profiler.close()
+
+    pid = os.getpid()
+    assert first == [f'profile-{pid}-0001.folded', f'profile-{pid}-0001.json']
+    report = _read_report(tmp_path / f'profile-{pid}-0001.json')
+    assert report['invocations'] == 2
+    assert report['functions']['busy']['calls'] == 2
+    assert report['functions']['outer']['calls'] == 1
+    assert report['functions']['busy']['total_seconds'] >= 0.1
+    assert report['functions']['busy']['cpu_seconds'] > 0
+    assert report['cpu']['samples'] > 0
+    assert any(
+        entry['function'].startswith('_busy (test_profiling.py')
+        for entry in report['cpu']['top_functions']
+    )
+    assert report['memory']['current'] > 0
+
+    stacks = (tmp_path / f'profile-{pid}-0001.folded').read_text()
+    assert '_outer (test_profiling.py' in stacks
+    assert '_busy (test_profiling.py' in stacks
+
+    # Statistics start over with each report
+    report = _read_report(tmp_path / f'profile-{pid}-0002.json')
+    assert report['invocations'] == 4
+    assert report['functions']['busy']['calls'] == 2
+    assert isinstance(report['memory']['growth'], list)
+
+
+def test_profiler_samples_profiled_threads(tmp_path):
+    """Test only profiled threads using CPU time are sampled"""
+    profiler = profiling.Profiler(
+        str(tmp_path),
+        interval=1,
+        sample_interval=0.001,
+        memory_frames=0
+    )
+    done = threading.Event()
+
+    def _spin():
+        while not done.is_set():
+            pass
+
+    def _wait():
+        time.sleep(0.1)
+
+    spinning = threading.Thread(target=_spin)
+    spinning.start()
+    try:
+        profiler.wrap('wait', _wait)()
+    finally:
+        done.set()
+        spinning.join()
+        profiler.close()
+
+    report = _read_report(tmp_path / f'profile-{os.getpid()}-0001.json')
+    stacks = (tmp_path / f'profile-{os.getpid()}-0001.folded').read_text()
+    assert report['cpu']['samples'] > 0
+    assert '_spin' not in stacks
+    if hasattr(time, 'pthread_getcpuclockid'):
+        # At most the samples taken before the thread went to sleep
+        assert sum(
+            entry['samples'] for entry in report['cpu']['top_functions']
+        ) <= 2
+
+
+def test_profiler_coroutine(tmp_path):
+    profiler = profiling.Profiler(str(tmp_path), interval=1, memory_frames=0)
+
+    async def _sleep(value):
+        await asyncio.sleep(0.01)
+        return value
+
+    try:
+        assert asyncio.run(profiler.wrap('sleep', _sleep)(1)) == 1
+    finally:
+        profiler.close()
+
+    report = _read_report(tmp_path / f'profile-{os.getpid()}-0001.json')
+    assert report['functions']['sleep']['total_seconds'] >= 0.01
+    assert report['memory'] is None
+
+
+def test_profiler_memory_tracing():
+    """Test tracemalloc is only stopped by the profiler that started it"""
+    profiler = profiling.Profiler('unused')
+    assert tracemalloc.is_tracing()
+    profiler.close()
+    assert not tracemalloc.is_tracing()
+
+    tracemalloc.start()
+    try:
+        profiling.Profiler('unused').close()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_profiler_write_error(tmp_path, caplog):
+    path = tmp_path / 'file'
+    path.write_text('')
+    profiler = profiling.Profiler(str(path), interval=1, memory_frames=0)
+    try:
+        assert profiler.dump() is None
+    finally:
+        profiler.close()
+    assert 'Unable to write profile' in caplog.text
+
+
+def test_profiler_without_reset_peak(tmp_path):
+    """Test memory is reported without tracemalloc.reset_peak"""
+    profiler = profiling.Profiler(str(tmp_path), interval=1)
+    try:
+        with patch.object(profiling, 'tracemalloc') as mock_tracemalloc:
+            del mock_tracemalloc.reset_peak
+            mock_tracemalloc.is_tracing.return_value = True
+            mock_tracemalloc.get_traced_memory.return_value = (1, 2)
+            snapshot = mock_tracemalloc.take_snapshot.return_value
+            snapshot.filter_traces.return_value.statistics.return_value = []
+            path = profiler.dump()
+    finally:
+        profiler.close()
+    assert not tracemalloc.is_tracing()
+
+    report = _read_report(path)
+    assert report['memory']['current'] == 1
+    assert report['memory']['peak'] == 2
+
+
+def test_profiler_report_error(tmp_path, caplog):
+    """Test a failure to create a report does not reach the caller"""
+    profiler = profiling.Profiler(str(tmp_path), interval=1)
+    wrapped = profiler.wrap('add', lambda a, b: a + b)
+    with patch.object(
+        profiler,
+        '_get_memory_report',
+        side_effect=AttributeError('reset_peak')
+    ):
+        try:
+            assert wrapped(1, 2) == 3
+        finally:
+            profiler.close()
+    assert not os.listdir(tmp_path)
+    assert 'Unable to create profile' in caplog.text
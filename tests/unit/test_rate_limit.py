@@ -0,0 +1,111 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import pytest
+
+from unittest.mock import patch
+
+from csp_billing_adapter_microsoft import rate_limit, retry
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    with patch.object(rate_limit, 'time', clock):
+        yield clock
+
+
+def test_burst_then_rate(clock):
+    """Test the burst is sent right away and the rest at the rate"""
+    limiter = rate_limit.RateLimiter(rate=2, burst=3)
+
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.now == 1000.0
+
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.now == pytest.approx(1001.0)
+
+
+def test_throttled_lowers_rate(clock):
+    """Test throttling halves the rate and honors Retry-After"""
+    limiter = rate_limit.RateLimiter(rate=10, burst=1)
+    limiter.acquire()
+
+    limiter.on_throttled(retry_after=5)
+    state = limiter.get_state()
+    assert state['rate'] == 5
+    assert state['blocked_for'] == 5
+    assert state['throttled'] == 1
+
+    limiter.acquire()
+    assert clock.now == pytest.approx(1005.0)
+
+
+def test_rate_bounds(clock):
+    """Test the rate stays between its minimum and the configured rate"""
+    limiter = rate_limit.RateLimiter(rate=10, burst=1)
+    for _ in range(20):
+        limiter.on_throttled()
+    assert limiter.rate == limiter.min_rate == 0.5
+
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.rate == 10
+
+
+def test_acquire_deadline(clock):
+    """Test a wait past the deadline raises without taking a token"""
+    limiter = rate_limit.RateLimiter(rate=1, burst=1)
+    limiter.acquire()
+
+    with patch.object(retry, 'time', clock):
+        with retry.deadline(0.5):
+            with pytest.raises(retry.DeadlineExceeded):
+                limiter.acquire()
+
+    assert limiter.get_state()['tokens'] == pytest.approx(0)
+
+
+def test_acquire_async():
+    limiter = rate_limit.RateLimiter(rate=100, burst=1)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await limiter.acquire_async()
+        await limiter.acquire_async()
+        return loop.time() - start
+
+    assert asyncio.run(run()) >= 0.009
+
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        rate_limit.RateLimiter(rate=0)
@@ -0,0 +1,189 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import email.utils
+import asyncio
+import pytest
+import time
+import urllib.error
+
+from unittest.mock import Mock, patch
+
+from csp_billing_adapter_microsoft import retry
+
+
+def _http_error(code, headers=None):
+    return urllib.error.HTTPError(
+        'https://marketplaceapi.microsoft.com', code, 'error',
+        headers or {}, None
+    )
+
+
+@pytest.mark.parametrize('error,expected', [
+    (urllib.error.URLError('connection refused'), True),
+    (_http_error(408), True),
+    (_http_error(429), True),
+    (_http_error(500), True),
+    (_http_error(503), True),
+    (_http_error(400), False),
+    (_http_error(403), False),
+    (_http_error(404), False),
+])
+def test_is_retriable(error, expected):
+    assert retry.is_retriable(error) is expected
+
+
+def test_get_retry_after_seconds():
+    assert retry.get_retry_after(_http_error(429, {'Retry-After': '5'})) \
+        == 5.0
+
+
+def test_get_retry_after_date():
+    retry_at = email.utils.formatdate(time.time() + 60, usegmt=True)
+    delay = retry.get_retry_after(
+        _http_error(503, {'Retry-After': retry_at})
+    )
+    assert 55 < delay <= 60
+
+
+def test_get_retry_after_missing_or_invalid():
+    assert retry.get_retry_after(_http_error(429)) is None
+    assert retry.get_retry_after(
+        _http_error(429, {'Retry-After': 'soon'})
+    ) is None
+    assert retry.get_retry_after(urllib.error.URLError('reset')) is None
+
+
+def test_get_delay_backoff_with_jitter():
+    policy = retry.RetryPolicy(backoff=2, backoff_factor=2, max_backoff=5)
+    assert 1 <= policy.get_delay(1) <= 2
+    assert 2 <= policy.get_delay(2) <= 4
+    assert 2.5 <= policy.get_delay(3) <= 5
+
+
+def test_get_delay_retry_after():
+    policy = retry.RetryPolicy(max_backoff=10)
+    assert policy.get_delay(1, _http_error(429, {'Retry-After': '3'})) == 3
+    assert policy.get_delay(
+        1, _http_error(429, {'Retry-After': '60'})
+    ) is None
+
+
+@patch('csp_billing_adapter_microsoft.retry.time.sleep')
+def test_call_retries_until_success(mock_sleep):
+    func = Mock(side_effect=[_http_error(503), _http_error(502), 'ok'])
+    policy = retry.RetryPolicy(attempts=3, backoff=1)
+
+    assert policy.call(func) == 'ok'
+    assert func.call_count == 3
+    assert mock_sleep.call_count == 2
+
+
+@patch('csp_billing_adapter_microsoft.retry.time.sleep')
+def test_call_gives_up(mock_sleep):
+    func = Mock(side_effect=urllib.error.URLError('reset'))
+    policy = retry.RetryPolicy(attempts=2)
+
+    with pytest.raises(urllib.error.URLError):
+        policy.call(func)
+    assert func.call_count == 2
+
+
+@patch('csp_billing_adapter_microsoft.retry.time.sleep')
+def test_call_fails_fast_on_client_error(mock_sleep):
+    func = Mock(side_effect=_http_error(400))
+
+    with pytest.raises(urllib.error.HTTPError):
+        retry.RetryPolicy().call(func)
+    assert func.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+@patch('csp_billing_adapter_microsoft.retry.time.sleep')
+def test_call_refreshes_credentials_once(mock_sleep):
+    func = Mock(side_effect=[_http_error(401), _http_error(401)])
+    on_unauthorized = Mock()
+
+    with pytest.raises(urllib.error.HTTPError):
+        retry.RetryPolicy().call(func, on_unauthorized=on_unauthorized)
+    on_unauthorized.assert_called_once_with()
+    assert func.call_count == 2
+    mock_sleep.assert_not_called()
+
+
+def test_deadline():
+    assert retry.get_remaining() is None
+    with retry.deadline(10):
+        assert 9 < retry.get_remaining() <= 10
+        with retry.deadline(60):
+            # A nested deadline can not extend the outer one
+            assert retry.get_remaining() <= 10
+        with retry.deadline(0):
+            with pytest.raises(retry.DeadlineExceeded):
+                retry.get_remaining()
+    assert retry.get_remaining() is None
+
+
+@patch('csp_billing_adapter_microsoft.retry.time.sleep')
+def test_call_stops_at_deadline(mock_sleep):
+    func = Mock(side_effect=_http_error(503))
+    policy = retry.RetryPolicy(attempts=5, backoff=10)
+
+    with retry.deadline(1):
+        with pytest.raises(retry.DeadlineExceeded):
+            policy.call(func)
+    assert func.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+@patch('csp_billing_adapter_microsoft.retry.time.sleep')
+def test_wait(mock_sleep):
+    policy = retry.RetryPolicy(attempts=2, backoff=1)
+
+    assert policy.wait(1, 'rejected') is True
+    assert policy.wait(2, 'rejected') is False
+    assert mock_sleep.call_count == 1
+
+
+def test_call_async_retries_until_success():
+    """Test coroutines are retried like functions"""
+    responses = [_http_error(401), _http_error(503), 'ok']
+    refreshed = []
+
+    async def func():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def on_unauthorized():
+        refreshed.append(True)
+
+    policy = retry.RetryPolicy(attempts=3, backoff=0)
+
+    assert asyncio.run(
+        policy.call_async(func, on_unauthorized=on_unauthorized)
+    ) == 'ok'
+    assert refreshed == [True]
+    assert responses == []
+
+
+def test_call_async_fails_fast_on_client_error():
+    async def func():
+        raise _http_error(400)
+
+    with pytest.raises(urllib.error.HTTPError):
+        asyncio.run(retry.RetryPolicy().call_async(func))
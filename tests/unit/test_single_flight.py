@@ -0,0 +1,173 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import pytest
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from csp_billing_adapter_microsoft import retry
+from csp_billing_adapter_microsoft.single_flight import (
+    AsyncSingleFlight,
+    SingleFlight
+)
+
+
+def test_do_coalesces_concurrent_calls():
+    """Test concurrent callers of a key share one call"""
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    waiting = threading.Semaphore(0)
+    calls = []
+
+    def func():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    def get_remaining():
+        waiting.release()
+        return None
+
+    with patch(
+        'csp_billing_adapter_microsoft.single_flight.retry.get_remaining',
+        side_effect=get_remaining
+    ), ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(flight.do, 'key', func)]
+        started.wait(5)
+        futures += [executor.submit(flight.do, 'key', func) for _ in range(3)]
+        for _ in range(3):
+            waiting.acquire(timeout=5)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+    assert len(flight) == 0
+
+
+def test_do_shares_exception():
+    """Test waiting callers get the exception of the call"""
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def func():
+        started.set()
+        release.wait(5)
+        raise ValueError('failed')
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(flight.do, 'key', func)
+        started.wait(5)
+        follower = executor.submit(flight.do, 'key', func)
+        release.set()
+
+        with pytest.raises(ValueError):
+            leader.result()
+        with pytest.raises(ValueError):
+            follower.result()
+
+
+def test_do_not_cached():
+    """Test calls that do not overlap run separately"""
+    flight = SingleFlight()
+    assert flight.do('key', lambda: 1) == 1
+    assert flight.do('key', lambda: 2) == 2
+    assert flight.do('other', lambda: 3) == 3
+
+
+def test_do_wait_deadline():
+    """Test waiting for another thread stops at the deadline"""
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def func():
+        started.set()
+        release.wait(5)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(flight.do, 'key', func)
+        started.wait(5)
+        try:
+            with retry.deadline(0.05):
+                with pytest.raises(retry.DeadlineExceeded):
+                    flight.do('key', func)
+        finally:
+            release.set()
+
+
+def test_async_do_coalesces_concurrent_calls():
+    """Test concurrent tasks share one coroutine"""
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    async def run():
+        return await asyncio.gather(
+            *(flight.do('key', func) for _ in range(4))
+        )
+
+    assert asyncio.run(run()) == ['result'] * 4
+    assert len(calls) == 1
+    assert len(flight) == 0
+
+
+def test_async_do_shares_exception():
+    flight = AsyncSingleFlight()
+
+    async def func():
+        await asyncio.sleep(0.01)
+        raise ValueError('failed')
+
+    async def run():
+        return await asyncio.gather(
+            *(flight.do('key', func) for _ in range(2)),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_async_do_wait_deadline():
+    """Test waiting tasks stop at the deadline"""
+    flight = AsyncSingleFlight()
+
+    async def func():
+        await asyncio.sleep(0.5)
+
+    async def wait():
+        with retry.deadline(0.05):
+            await flight.do('key', func)
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do('key', func))
+        await asyncio.sleep(0)
+        with pytest.raises(retry.DeadlineExceeded):
+            await wait()
+        leader.cancel()
+
+    asyncio.run(run())
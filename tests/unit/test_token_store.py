@@ -0,0 +1,130 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import fcntl
+import json
+import multiprocessing
+import os
+import pytest
+import stat
+import time
+
+from unittest.mock import Mock
+
+from csp_billing_adapter_microsoft import retry
+from csp_billing_adapter_microsoft.token_store import TokenStore
+
+
+def _fetch_token(path, counter_path):
+    """Refresh the token in a separate process, counting the fetches"""
+    def fetch():
+        with open(counter_path, 'a') as counter:
+            counter.write('x')
+        time.sleep(0.2)
+        return 'Bearer shared', time.time() + 3600
+
+    return TokenStore(path).get('vm', fetch, 300)
+
+
+def test_get_stores_token(tmp_path):
+    """Test a fetched token is stored and reused"""
+    path = str(tmp_path / 'store' / 'tokens')
+    store = TokenStore(path)
+    expires_on = time.time() + 3600
+    fetch = Mock(return_value=('Bearer 123', expires_on))
+
+    assert store.get('vm', fetch, 300) == ('Bearer 123', expires_on)
+    assert TokenStore(path).get('vm', fetch, 300) == (
+        'Bearer 123',
+        expires_on
+    )
+    assert fetch.call_count == 1
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(f'{path}.lock').st_mode) == 0o600
+
+
+def test_get_refreshes_near_expiry(tmp_path):
+    """Test a token within the margin is refreshed"""
+    store = TokenStore(str(tmp_path / 'tokens'))
+    fetch = Mock(side_effect=[
+        ('Bearer old', time.time() + 100),
+        ('Bearer new', time.time() + 3600)
+    ])
+
+    assert store.get('vm', fetch, 300)[0] == 'Bearer old'
+    assert store.get('vm', fetch, 300)[0] == 'Bearer new'
+
+
+def test_get_without_expiry_not_stored(tmp_path):
+    store = TokenStore(str(tmp_path / 'tokens'))
+    fetch = Mock(return_value=('Bearer 123', None))
+
+    store.get('vm', fetch)
+    store.get('vm', fetch)
+    assert fetch.call_count == 2
+
+
+def test_get_invalid_store(tmp_path):
+    """Test a corrupt store file is replaced"""
+    path = tmp_path / 'tokens'
+    path.write_text('{"vm": ')
+    store = TokenStore(str(path))
+
+    store.get('vm', Mock(return_value=('Bearer 123', time.time() + 3600)))
+    assert json.loads(path.read_text())['vm']['token'] == 'Bearer 123'
+
+
+def test_invalidate(tmp_path):
+    """Test only the rejected token is removed"""
+    store = TokenStore(str(tmp_path / 'tokens'))
+    fetch = Mock(side_effect=[
+        ('Bearer 1', time.time() + 3600),
+        ('Bearer 2', time.time() + 3600)
+    ])
+    store.get('vm', fetch)
+
+    store.invalidate('vm', 'Bearer 0')
+    assert store.get('vm', fetch)[0] == 'Bearer 1'
+
+    store.invalidate('vm', 'Bearer 1')
+    assert store.get('vm', fetch)[0] == 'Bearer 2'
+
+
+def test_lock_wait_deadline(tmp_path):
+    """Test waiting for the lock stops at the deadline"""
+    store = TokenStore(str(tmp_path / 'tokens'))
+    fd = os.open(store.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        with retry.deadline(0.1):
+            with pytest.raises(retry.DeadlineExceeded):
+                store.get('vm', Mock())
+    finally:
+        os.close(fd)
+
+
+def test_single_writer_across_processes(tmp_path):
+    """Test concurrent processes share a single refresh"""
+    path = str(tmp_path / 'tokens')
+    counter_path = str(tmp_path / 'counter')
+    context = multiprocessing.get_context('fork')
+
+    with context.Pool(4) as pool:
+        results = pool.starmap(_fetch_token, [(path, counter_path)] * 4)
+
+    assert {token for token, _ in results} == {'Bearer shared'}
+    with open(counter_path) as counter:
+        assert counter.read() == 'x'
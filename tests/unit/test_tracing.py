@@ -0,0 +1,122 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import contextvars
+import json
+import pytest
+import threading
+
+from csp_billing_adapter_microsoft import tracing
+
+
+def test_nested_spans():
+    exporter = tracing.InMemoryExporter()
+    tracer = tracing.Tracer(exporter)
+
+    with tracer.span('meter_billing', dimensions=2) as root:
+        with tracer.span('submit_batch') as child:
+            child.set_attribute('attempts', 1)
+            assert tracing.get_current_span() is child
+        assert tracing.get_current_span() is root
+    assert tracing.get_current_span() is None
+
+    child, root = exporter.spans
+    assert child.trace_id == root.trace_id
+    assert child.parent_id == root.span_id
+    assert root.parent_id is None
+    assert child.attributes == {'attempts': 1}
+    assert root.to_dict()['attributes'] == {'dimensions': 2}
+    assert root.duration >= child.duration
+
+
+def test_span_error():
+    exporter = tracing.InMemoryExporter()
+    tracer = tracing.Tracer(exporter)
+
+    with pytest.raises(ValueError):
+        with tracer.span('msi_token'):
+            raise ValueError('bad token')
+
+    span = exporter.get_spans('msi_token')[0].to_dict()
+    assert span['status'] == 'error'
+    assert span['error'] == 'ValueError: bad token'
+
+
+def test_span_propagation():
+    """Test threads with a copied context and tasks share the trace"""
+    exporter = tracing.InMemoryExporter()
+    tracer = tracing.Tracer(exporter)
+
+    def _child(name):
+        with tracer.span(name):
+            pass
+
+    async def _run():
+        await asyncio.gather(
+            asyncio.ensure_future(_async_child('task_1')),
+            asyncio.ensure_future(_async_child('task_2'))
+        )
+
+    async def _async_child(name):
+        with tracer.span(name):
+            await asyncio.sleep(0)
+
+    with tracer.span('root') as root:
+        thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(_child, 'thread')
+        )
+        thread.start()
+        thread.join()
+        asyncio.run(_run())
+
+    children = [span for span in exporter.spans if span is not root]
+    assert {span.name for span in children} == {'thread', 'task_1', 'task_2'}
+    assert {span.parent_id for span in children} == {root.span_id}
+
+
+def test_json_lines_exporter(tmp_path):
+    path = tmp_path / 'spans.jsonl'
+    tracer = tracing.Tracer(tracing.JsonLinesExporter(str(path)))
+
+    with tracer.span('get_account_info'):
+        pass
+    with tracer.span('meter_billing', dry_run=True):
+        pass
+    tracer.exporter.close()
+
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [span['name'] for span in spans] == [
+        'get_account_info',
+        'meter_billing'
+    ]
+    assert spans[1]['attributes'] == {'dry_run': True}
+    assert spans[1]['status'] == 'ok'
+
+
+def test_json_lines_exporter_error(tmp_path, caplog):
+    exporter = tracing.JsonLinesExporter(str(tmp_path / 'missing' / 'file'))
+    with tracing.Tracer(exporter).span('meter_billing'):
+        pass
+    assert 'Unable to write span' in caplog.text
+
+
+def test_noop():
+    tracer = tracing.Tracer()
+    with tracer.span('meter_billing'):
+        pass
+    tracing.NOOP_SPAN.set_attribute('ignored', True)
@@ -0,0 +1,353 @@
+#
+# Copyright 2023 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import json
+import pytest
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock, patch
+
+from csp_billing_adapter_microsoft import transport
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.ports.add(self.client_address[1])
+        if self.path == '/slow':
+            time.sleep(0.5)
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in (b'{"chunked": ', b'true}'):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        if self.path == '/missing':
+            self._reply(404, {'error': 'missing'})
+        else:
+            self._reply(
+                200,
+                {'path': self.path, 'metadata': self.headers['Metadata']}
+            )
+
+    def do_POST(self):
+        self.server.ports.add(self.client_address[1])
+        length = int(self.headers['Content-Length'])
+        self._reply(200, json.loads(self.rfile.read(length)))
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.ports = set()
+    thread = threading.Thread(
+        target=httpd.serve_forever,
+        args=(0.05,),
+        daemon=True
+    )
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _url(server, path):
+    return f'http://127.0.0.1:{server.server_address[1]}{path}'
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_pooled_transport_reuses_connection(server):
+    """Test requests to one host share a kept alive connection"""
+    pooled = transport.PooledTransport()
+    for _ in range(3):
+        request = urllib.request.Request(
+            _url(server, '/metadata/versions'),
+            headers={'Metadata': 'True'}
+        )
+        with pooled.open(request) as response:
+            assert json.loads(response.read()) == {
+                'path': '/metadata/versions',
+                'metadata': 'True'
+            }
+
+    assert len(server.ports) == 1
+    pooled.close()
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_pooled_transport_post(server):
+    """Test the request body is sent"""
+    pooled = transport.PooledTransport()
+    request = urllib.request.Request(
+        _url(server, '/api/batchUsageEvent'),
+        data=json.dumps({'request': []}).encode('utf-8'),
+        headers={'Content-type': 'application/json'},
+        method='POST'
+    )
+    with pooled.open(request) as response:
+        assert response.getcode() == 200
+        assert json.loads(response.read()) == {'request': []}
+    pooled.close()
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_pooled_transport_http_error(server):
+    """Test error statuses are raised as HTTPError"""
+    pooled = transport.PooledTransport()
+    request = urllib.request.Request(_url(server, '/missing'))
+    with pytest.raises(urllib.error.HTTPError) as error:
+        pooled.open(request)
+
+    assert error.value.code == 404
+    assert json.loads(error.value.read()) == {'error': 'missing'}
+
+    # The connection is still usable after an error status
+    with pooled.open(urllib.request.Request(_url(server, '/'))):
+        pass
+    assert len(server.ports) == 1
+    pooled.close()
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_pooled_transport_connection_error():
+    """Test connection failures are raised as URLError"""
+    pooled = transport.PooledTransport()
+    request = urllib.request.Request('http://127.0.0.1:1/')
+    with pytest.raises(urllib.error.URLError):
+        pooled.open(request)
+
+
+def test_pooled_transport_unsupported_scheme():
+    pooled = transport.PooledTransport()
+    with pytest.raises(urllib.error.URLError):
+        pooled.open(urllib.request.Request('ftp://127.0.0.1/'))
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_pooled_transport_retries_stale_connection(server):
+    """Test a connection closed while idle is replaced"""
+    pooled = transport.PooledTransport()
+    with pooled.open(urllib.request.Request(_url(server, '/'))):
+        pass
+
+    pool = next(iter(pooled._pools.values()))
+    connection, _ = pool._idle[0]
+    connection.sock.close()
+    connection.sock = Mock()
+    connection.sock.sendall.side_effect = BrokenPipeError()
+
+    with pooled.open(urllib.request.Request(_url(server, '/'))) as response:
+        assert response.status == 200
+    pooled.close()
+
+
+def test_connection_pool_discards_idle_connections():
+    """Test expired and excess idle connections are closed"""
+    pool = transport.ConnectionPool(
+        'http', '127.0.0.1', 80, pool_size=1, idle_timeout=0
+    )
+    first = Mock()
+    second = Mock()
+    pool.put(first)
+    pool.put(second)
+    second.close.assert_called_once_with()
+
+    connection, reused = pool.get()
+    first.close.assert_called_once_with()
+    assert reused is False
+    assert connection is not first
+
+
+@patch.dict('os.environ', {'https_proxy': 'http://proxy:3128'})
+@patch.object(transport.UrllibTransport, 'open')
+def test_pooled_transport_proxy_fallback(mock_open):
+    """Test proxied requests are handed to urllib"""
+    pooled = transport.PooledTransport()
+    request = urllib.request.Request('https://management.azure.com/')
+    pooled.open(request)
+    mock_open.assert_called_once_with(request, None)
+
+
+def test_set_transport_closes_previous():
+    previous = Mock()
+    transport.set_transport(previous)
+    stand_in = transport.UrllibTransport()
+    transport.set_transport(stand_in)
+
+    previous.close.assert_called_once_with()
+    assert transport.get_transport() is stand_in
+    transport.set_transport(None)
+    assert isinstance(transport.get_transport(), transport.PooledTransport)
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_pooled_transport_read_timeout(server):
+    """Test a slow response fails once the read timeout passes"""
+    pooled = transport.PooledTransport()
+    request = urllib.request.Request(_url(server, '/slow'))
+    with pytest.raises(urllib.error.URLError):
+        pooled.open(request, transport.Timeout(1, 0.1))
+
+    with pooled.open(
+        urllib.request.Request(_url(server, '/')),
+        transport.Timeout(1, 1)
+    ) as response:
+        assert response.status == 200
+    pooled.close()
+
+
+@patch('csp_billing_adapter_microsoft.transport.urllib.request.urlopen')
+def test_urllib_transport_timeout(mock_urlopen):
+    """Test urllib gets the larger of the two timeouts"""
+    request = urllib.request.Request('http://127.0.0.1/')
+    transport.UrllibTransport().open(request, transport.Timeout(2, 10))
+    mock_urlopen.assert_called_once_with(request, timeout=10)
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_async_transport_reuses_connection(server):
+    """Test async requests to one host share a kept alive connection"""
+    async_transport = transport.AsyncTransport()
+
+    async def _open():
+        results = []
+        for path in ('/metadata/versions', '/chunked', '/'):
+            request = urllib.request.Request(
+                _url(server, path),
+                headers={'Metadata': 'True'}
+            )
+            response = await async_transport.open(
+                request,
+                transport.Timeout(1, 1)
+            )
+            with response:
+                results.append(json.loads(response.read()))
+        return results
+
+    assert asyncio.run(_open()) == [
+        {'path': '/metadata/versions', 'metadata': 'True'},
+        {'chunked': True},
+        {'path': '/', 'metadata': 'True'}
+    ]
+    assert len(server.ports) == 1
+    async_transport.close()
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_async_transport_post(server):
+    async_transport = transport.AsyncTransport()
+    request = urllib.request.Request(
+        _url(server, '/api'),
+        data=b'{"request": []}',
+        headers={'Content-type': 'application/json'},
+        method='POST'
+    )
+
+    response = asyncio.run(async_transport.open(request))
+    assert json.loads(response.read()) == {'request': []}
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_async_transport_errors(server):
+    """Test failures are raised like urllib does"""
+    async_transport = transport.AsyncTransport()
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        asyncio.run(async_transport.open(
+            urllib.request.Request(_url(server, '/missing'))
+        ))
+    assert error.value.code == 404
+    assert json.loads(error.value.read()) == {'error': 'missing'}
+
+    with pytest.raises(urllib.error.URLError):
+        asyncio.run(async_transport.open(
+            urllib.request.Request(_url(server, '/slow')),
+            transport.Timeout(1, 0.1)
+        ))
+
+    with pytest.raises(urllib.error.URLError):
+        asyncio.run(async_transport.open(
+            urllib.request.Request('ftp://127.0.0.1/')
+        ))
+
+
+def test_async_transport_connection_error():
+    async_transport = transport.AsyncTransport()
+    with pytest.raises(urllib.error.URLError):
+        asyncio.run(async_transport.open(
+            urllib.request.Request('http://127.0.0.1:1/'),
+            transport.Timeout(1, 1)
+        ))
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_async_transport_retries_stale_connection(server):
+    """Test an idle connection closed by the server is replaced"""
+    async_transport = transport.AsyncTransport()
+
+    async def _open():
+        request = urllib.request.Request(_url(server, '/'))
+        await async_transport.open(request)
+        for connections in async_transport._idle.values():
+            for _, writer, _ in connections:
+                writer.transport.abort()
+        return await async_transport.open(request)
+
+    assert asyncio.run(_open()).status == 200
+    assert len(server.ports) == 2
+
+
+@patch.dict('os.environ', {'no_proxy': '*'})
+def test_async_transport_drops_closed_loops(server):
+    """Test the idle connections of closed event loops are not kept"""
+    async_transport = transport.AsyncTransport()
+    request = urllib.request.Request(_url(server, '/'))
+
+    for _ in range(3):
+        asyncio.run(async_transport.open(request))
+        assert len(async_transport._idle) == 1
+
+    # Connections are not shared across event loops
+    assert len(server.ports) == 3
+    async_transport.close()
+
+
+@patch.object(transport.UrllibTransport, 'open')
+def test_async_transport_proxy_fallback(mock_open):
+    """Test requests through a proxy are sent with urllib"""
+    request = urllib.request.Request('http://example.com/')
+    with patch.dict('os.environ', {'http_proxy': 'http://proxy:3128'}):
+        asyncio.run(transport.AsyncTransport().open(request))
+    mock_open.assert_called_once_with(request, None)